@@ -0,0 +1,69 @@
+# approvals.py
+import time
+
+from storage import JsonFile
+
+
+class ApprovalQueue:
+    # 承認待ちの購入リクエスト。再起動後も承認ボタンが使えるようファイルに保存する
+    def __init__(self, path, flush_delay=1.0):
+        self.file = JsonFile(path, {"next_id": 1, "pending": {}}, flush_delay=flush_delay)
+
+    def load(self):
+        self.file.load()
+
+    @property
+    def pending(self):
+        return self.file.data["pending"]
+
+    def add(self, jihanki_name, item, user_id, paypay_link, ttl):
+        approval_id = str(self.file.data["next_id"])
+        self.file.data["next_id"] += 1
+        now = time.time()
+        self.pending[approval_id] = {
+            "jihanki": jihanki_name,
+            "item": item,
+            "user_id": user_id,
+            "paypay_link": paypay_link,
+            "created_at": now,
+            "expires_at": now + ttl,
+            "message": None
+        }
+        self.file.mark_dirty()
+        return approval_id
+
+    def sorted_ids(self):
+        return sorted(self.pending, key=int)
+
+    def expired(self, now, ttl):
+        # 期限を記録していない古いリクエストは作成時刻から数える
+        return [
+            approval_id for approval_id, entry in self.pending.items()
+            if entry.get("expires_at", entry["created_at"] + ttl) <= now
+        ]
+
+    def get(self, approval_id):
+        return self.pending.get(approval_id)
+
+    def pop(self, approval_id):
+        # 取り出した時点で処理済み扱いになる（二重処理の防止）
+        entry = self.pending.pop(approval_id, None)
+        if entry is not None:
+            self.file.mark_dirty()
+        return entry
+
+    def restore(self, approval_id, entry):
+        self.pending[approval_id] = entry
+        self.file.mark_dirty()
+
+    def set_message(self, approval_id, channel_id, message_id):
+        entry = self.pending.get(approval_id)
+        if entry is not None:
+            entry["message"] = {"channel_id": channel_id, "message_id": message_id}
+            self.file.mark_dirty()
+
+    async def flush(self):
+        await self.file.flush()
+
+    async def close(self):
+        await self.file.close()
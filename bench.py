@@ -0,0 +1,349 @@
+# bench.py
+# Discord に接続せずに、購入・承認・商品追加・メッセージ更新の処理を負荷試験する
+#   python bench.py --buyers 500 --machines 5 --items 20 --stock 10 --latency 0.05 --rate-limit 0.02 --out bench.json
+# main.py の実際のハンドラーを、REST 呼び出しを模した偽のオブジェクト越しに動かす
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import discord
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_GUILD_ID = 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="自販機ボットのオフライン負荷試験")
+    parser.add_argument("--buyers", type=int, default=200, help="購入者の数")
+    parser.add_argument("--concurrency", type=int, default=50, help="同時に操作する購入者の数")
+    parser.add_argument("--machines", type=int, default=3, help="自販機の数")
+    parser.add_argument("--items", type=int, default=10, help="自販機ごとの商品数")
+    parser.add_argument("--stock", type=int, default=5, help="商品ごとの初期在庫")
+    parser.add_argument("--paid-ratio", type=float, default=0.5, help="有料（承認が必要な）商品の割合")
+    parser.add_argument("--messages", type=int, default=3, help="自販機ごとの投稿済みメッセージ数")
+    parser.add_argument("--latency", type=float, default=0.05, help="REST 呼び出し 1 回あたりの平均遅延（秒）")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="REST 呼び出しが 429 になる確率")
+    parser.add_argument("--backoff", type=float, default=0.05, help="配送キューの再送待ちの基準（秒）")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="結果の JSON の出力先（省略時は標準出力）")
+    return parser.parse_args()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(samples):
+    return {
+        handler: {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": max(values) * 1000
+        }
+        for handler, values in samples.items() if values
+    }
+
+
+# ---- 偽の Discord ----
+
+class FakeHTTPResponse:
+    def __init__(self, status, reason, retry_after=None):
+        self.status = status
+        self.reason = reason
+        self.headers = {} if retry_after is None else {"Retry-After": str(retry_after)}
+
+
+class FakeREST:
+    # 遅延と 429 を注入する。429 は discord.py と同じ HTTPException として Retry-After 付きで投げる
+    def __init__(self, latency, rate_limit, rng, retry_after=0.1):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = rng
+        self.calls = {}
+        self.rate_limited = 0
+
+    async def call(self, kind, rate_limited=True):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        if rate_limited and self.rng.random() < self.rate_limit:
+            self.rate_limited += 1
+            raise discord.HTTPException(FakeHTTPResponse(429, "Too Many Requests", self.retry_after), "You are being rate limited.")
+
+
+class FakeMessage:
+    def __init__(self, rest, channel_id, message_id):
+        self.rest = rest
+        self.channel_id = channel_id
+        self.id = message_id
+
+    async def edit(self, **kwargs):
+        await self.rest.call("edit_message")
+        return self
+
+
+class FakeChannel:
+    def __init__(self, rest, channel_id, ids):
+        self.rest = rest
+        self.id = channel_id
+        self.ids = ids
+
+    async def send(self, *args, **kwargs):
+        await self.rest.call("send_message")
+        return FakeMessage(self.rest, self.id, next(self.ids))
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self.rest, self.id, message_id)
+
+
+class FakeHandles:
+    # main.handles の代わり。すべて ID だけで作れる偽のチャンネル・メッセージを返す
+    def __init__(self, rest, ids):
+        self.rest = rest
+        self.ids = ids
+
+    async def channel(self, channel_id):
+        return FakeChannel(self.rest, channel_id, self.ids)
+
+    def messageable(self, channel_id):
+        return FakeChannel(self.rest, channel_id, self.ids)
+
+    def partial_message(self, channel_id, message_id):
+        return FakeMessage(self.rest, channel_id, message_id)
+
+    async def send_dm(self, user_id, *args, **kwargs):
+        await self.rest.call("dm")
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+
+
+class FakeResponse:
+    # InteractionResponse の代わり。インタラクションの応答は 429 にならないので遅延だけ入れる
+    def __init__(self, rest):
+        self.rest = rest
+        self.content = None
+        self.modal = None
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def _respond(self, kind, content=None):
+        if self._done:
+            raise RuntimeError("このインタラクションには応答済みです")
+        self._done = True
+        self.content = content
+        await self.rest.call(kind, rate_limited=False)
+
+    async def send_message(self, content=None, **kwargs):
+        await self._respond("interaction_response", content)
+
+    async def edit_message(self, content=None, **kwargs):
+        await self._respond("interaction_response", content)
+
+    async def send_modal(self, modal):
+        self.modal = modal
+        await self._respond("interaction_response")
+
+    async def defer(self, **kwargs):
+        await self._respond("interaction_response")
+
+
+class FakeInteraction:
+    # インタラクションごとに別の ID を振る（同じ ID は重複として捨てられる）
+    ids = itertools.count(1)
+
+    def __init__(self, rest, user):
+        self.id = next(self.ids)
+        self.user = user
+        self.response = FakeResponse(rest)
+        self.guild_id = BENCH_GUILD_ID
+        self.data = {}
+
+    async def edit_original_response(self, **kwargs):
+        await self.response.rest.call("edit_original_response", rate_limited=False)
+
+
+def fill(modal, **values):
+    # テキスト入力の値を直接入れる（実際には Discord から送られてくる値）
+    for name, value in values.items():
+        getattr(modal, name)._value = value
+
+
+# ---- シナリオ ----
+
+async def run(app, args):
+    from metrics import STORAGE_BYTES, STORAGE_SECONDS
+
+    rng = random.Random(args.seed)
+    rest = FakeREST(args.latency, args.rate_limit, rng)
+    ids = itertools.count(10 ** 6)
+    app.handles = FakeHandles(rest, ids)
+    app.deliveries.backoff = args.backoff
+    app.deliveries.start()
+
+    samples = {"add_item": [], "purchase": [], "paypay_modal": [], "approve": [], "refresh": []}
+
+    async def timed(handler, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            samples[handler].append(time.perf_counter() - start)
+
+    # 自販機メッセージの更新は配送キュー経由で呼ばれるので、関数を包んで時間を測る
+    update = app.update_jihanki_messages
+    app.update_jihanki_messages = lambda guild_id, name: timed("refresh", update(guild_id, name))
+    guild = await app.guilds.get(BENCH_GUILD_ID)
+
+    admin = FakeUser(1)
+    initial = {}
+    for m in range(args.machines):
+        machine = f"bench-{m}"
+        guild.store.add_machine(machine)
+        for _ in range(args.messages):
+            guild.store.add_message(machine, 100 + m, next(ids))
+        for i in range(args.items):
+            price = 0 if rng.random() >= args.paid_ratio else 100 * rng.randint(1, 10)
+            modal = app.AddItemModal(machine)
+            fill(modal, name=f"item-{i}", stock=str(args.stock), price=str(price), dm_content="")
+            await timed("add_item", modal.on_submit(FakeInteraction(rest, admin)))
+            initial[(machine, f"item-{i}")] = args.stock
+
+    sold = {key: 0 for key in initial}
+    outcome = {"completed": 0, "pending_approval": 0, "approved": 0, "sold_out": 0, "rejected": 0}
+    gate = asyncio.Semaphore(args.concurrency)
+
+    async def buyer(user_id):
+        machine, item = rng.choice(list(initial))
+        async with gate:
+            interaction = FakeInteraction(rest, FakeUser(user_id))
+            select = app.SelectItemToPurchase(guild, machine)
+            select._values = [item]
+            await timed("purchase", select.callback(interaction))
+            modal = interaction.response.modal
+            if modal is None:
+                if (interaction.response.content or "").startswith("✅"):
+                    sold[(machine, item)] += 1
+                    outcome["completed"] += 1
+                else:
+                    outcome["sold_out"] += 1
+                return
+            fill(modal, paypay_link=f"https://pay.paypay.ne.jp/bench{user_id}")
+            interaction = FakeInteraction(rest, FakeUser(user_id))
+            await timed("paypay_modal", modal.on_submit(interaction))
+            if (interaction.response.content or "").startswith("✅"):
+                outcome["pending_approval"] += 1
+            else:
+                outcome["sold_out"] += 1
+
+    async def approve(approval_id):
+        entry = guild.approvals.get(approval_id)
+        async with gate:
+            interaction = FakeInteraction(rest, admin)
+            await timed("approve", app.ApprovalView(approval_id).approve(interaction))
+            if (interaction.response.content or "").startswith("✅"):
+                sold[(entry["jihanki"], entry["item"])] += 1
+                outcome["approved"] += 1
+            else:
+                outcome["rejected"] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(buyer(10_000 + n) for n in range(args.buyers)))
+    await asyncio.gather(*(approve(approval_id) for approval_id in guild.approvals.sorted_ids()))
+    handled = time.perf_counter() - start
+
+    # 後回しにした更新・DM・保存がすべて終わるまで待つ
+    while app.refresher.pending:
+        await asyncio.sleep(app.REFRESH_DELAY)
+    await app.deliveries.close(timeout=60)
+    await app.guilds.close()
+    duration = time.perf_counter() - start
+
+    oversell = 0
+    for key, stock in initial.items():
+        info = guild.store.get_item(*key)
+        oversell += max(0, sold[key] - stock) + max(0, -info.stock)
+
+    dead_letters = 0
+    if os.path.exists(app.DEAD_LETTER_FILE):
+        with open(app.DEAD_LETTER_FILE, 'r', encoding='utf-8') as f:
+            dead_letters = sum(1 for _ in f)
+
+    storage = {}
+    for labels, value in STORAGE_BYTES.values.items():
+        labels = dict(labels)
+        storage.setdefault(f"{labels['target']}:{labels['op']}", {})["bytes"] = value
+    for labels, (_, total, count) in STORAGE_SECONDS.values.items():
+        labels = dict(labels)
+        entry = storage.setdefault(f"{labels['target']}:{labels['op']}", {})
+        entry["count"] = count
+        entry["seconds"] = total
+
+    return {
+        "config": vars(args),
+        "duration_s": duration,
+        "handled_s": handled,
+        "throughput": {
+            "interactions_per_s": sum(len(samples[h]) for h in ("purchase", "paypay_modal", "approve")) / handled,
+            "sales_per_s": (outcome["completed"] + outcome["approved"]) / duration
+        },
+        "latency": summarize(samples),
+        "outcome": outcome,
+        "oversell": oversell,
+        "rest": {"calls": rest.calls, "total": sum(rest.calls.values()), "rate_limited": rest.rate_limited},
+        "dead_letters": dead_letters,
+        "storage": storage
+    }
+
+
+def main():
+    args = parse_args()
+    out = os.path.abspath(args.out) if args.out else None
+
+    # main.py は読み込んだ時点でデータファイルを開くので、空の作業ディレクトリに移ってから読み込む
+    os.chdir(tempfile.mkdtemp(prefix="jihanki-bench-"))
+    os.environ.update({
+        "DISCORD_TOKEN": "bench",
+        # 以前の単一サーバー用の設定（承認・実績チャンネル）をそのまま使う
+        "LEGACY_GUILD_ID": str(BENCH_GUILD_ID),
+        "STORAGE_BACKEND": args.backend,
+        "APPROVAL_CHANNEL_ID": "1",
+        "ACHIEVEMENT_CHANNEL_ID": "2",
+        "SAVE_DELAY": "0.2",
+        "REFRESH_DELAY": "0.2",
+        # 多数の購入者を同時に流すので連打制限は切っておく
+        "THROTTLE_USER_RATE": "0",
+        "THROTTLE_MACHINE_RATE": "0",
+    })
+    sys.path.insert(0, REPO_DIR)
+    import main as app
+
+    result = asyncio.run(run(app, args))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            f.write(text)
+        print(f"✅ {out} に書き出しました")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# bulk.py
+# 在庫の一括登録・補充・書き出し
+#   CSV / JSON Lines: machine,item,price,stock,dm_content の列（1 行 1 商品）
+#   JSON: jihanki.json と同じ形、または上と同じキーを持つオブジェクトの配列
+#   stock は "10" なら在庫数の指定、"+10" / "-2" なら現在の在庫からの増減
+import csv
+import io
+import json
+from contextlib import AsyncExitStack
+
+from models import Item
+
+COLUMNS = ["machine", "item", "price", "stock", "dm_content"]
+
+
+class BulkError(Exception):
+    def __init__(self, errors):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+def _parse_int(value):
+    if value is None or value == "":
+        return None
+    return int(str(value).strip())
+
+
+def _parse_row(line, record):
+    if not isinstance(record, dict):
+        raise ValueError(f"{line}行目: 形式が正しくありません")
+    machine = str(record.get("machine") or "").strip()
+    item = str(record.get("item") or "").strip()
+    if not machine or not item:
+        raise ValueError(f"{line}行目: machine と item は必須です")
+
+    stock = record.get("stock")
+    stock_text = "" if stock is None else str(stock).strip()
+    try:
+        price = _parse_int(record.get("price"))
+        if stock_text[:1] in ("+", "-"):
+            stock_value, stock_delta = None, int(stock_text)
+        else:
+            stock_value, stock_delta = _parse_int(stock_text), None
+    except ValueError:
+        raise ValueError(f"{line}行目: price と stock は整数で指定してください")
+
+    dm_content = record.get("dm_content")
+    return {
+        "line": line,
+        "machine": machine,
+        "item": item,
+        "price": price,
+        "stock": stock_value,
+        "delta": stock_delta,
+        "dm_content": None if dm_content is None or dm_content == "" else str(dm_content)
+    }
+
+
+def _records(filename, raw):
+    # 行ごとに読み進め、ファイル全体の文字列やリストを作らない
+    name = filename.lower()
+    if name.endswith(".csv"):
+        reader = csv.DictReader(io.TextIOWrapper(io.BytesIO(raw), encoding='utf-8-sig', newline=''))
+        for record in reader:
+            yield reader.line_num, record
+    elif name.endswith(".jsonl"):
+        for line, text in enumerate(io.TextIOWrapper(io.BytesIO(raw), encoding='utf-8-sig'), start=1):
+            if text.strip():
+                yield line, json.loads(text)
+    elif name.endswith(".json"):
+        data = json.loads(raw.decode('utf-8-sig'))
+        if isinstance(data, list):
+            yield from enumerate(data, start=1)
+        elif isinstance(data, dict):
+            line = 0
+            for machine, items in data.items():
+                if not isinstance(items, dict):
+                    # 自販機の値がオブジェクトでなければその自販機を 1 行として形式エラーにする
+                    line += 1
+                    yield line, items
+                    continue
+                for item, info in items.items():
+                    if item == "message_ids" or not isinstance(info, dict):
+                        continue
+                    line += 1
+                    yield line, {"machine": machine, "item": item, **info}
+        else:
+            raise ValueError("JSON はオブジェクトか配列で指定してください")
+    else:
+        raise BulkError(["CSV (.csv)、JSON (.json)、JSON Lines (.jsonl) のいずれかを指定してください"])
+
+
+def parse(filename, raw):
+    rows, errors = [], []
+    try:
+        for line, record in _records(filename, raw):
+            try:
+                rows.append(_parse_row(line, record))
+            except ValueError as e:
+                errors.append(str(e))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        errors.append(f"ファイルを読み込めません: {e}")
+    if errors:
+        raise BulkError(errors)
+    return rows
+
+
+async def apply(store, rows, **event):
+    # 対象の自販機をすべてロックしてから検証し、問題がなければまとめて反映する
+    machines = sorted({row["machine"] for row in rows})
+    async with AsyncExitStack() as stack:
+        for name in machines:
+            await stack.enter_async_context(store.lock(name))
+
+        planned = {}
+        errors = []
+        for row in rows:
+            key = (row["machine"], row["item"])
+            current = planned.get(key) or store.get_item(*key)
+            price = row["price"] if row["price"] is not None else getattr(current, "price", None)
+            dm_content = row["dm_content"] if row["dm_content"] is not None else getattr(current, "dm_content", "")
+            if row["delta"] is not None:
+                if current is None:
+                    errors.append(f"{row['line']}行目: '{row['item']}' は存在しないため増減できません")
+                    continue
+                # 共有時は store がこの増減のままデータベースに書き込むので、他のプロセスの販売を上書きしない
+                stock = current.stock + row["delta"]
+            else:
+                stock = row["stock"] if row["stock"] is not None else getattr(current, "stock", None)
+            if price is None or stock is None:
+                errors.append(f"{row['line']}行目: 新しい商品には price と stock が必要です")
+                continue
+            if stock < 0:
+                errors.append(f"{row['line']}行目: 在庫がマイナスになります")
+                continue
+            planned[key] = Item(stock, price, dm_content)
+        if errors:
+            raise BulkError(errors)
+
+        # ここから先は await しないので、途中で他の処理が割り込むことはない
+        for (machine, item), info in planned.items():
+            store.add_machine(machine)
+            current = store.get_item(machine, item)
+            if current is not None and current.price == info.price and current.dm_content == info.dm_content:
+                if current.stock != info.stock:
+                    store.set_stock(machine, item, info.stock, reason="restock", **event)
+            else:
+                store.set_item(machine, item, info.stock, info.price, info.dm_content)
+    return machines, len(planned)
+
+
+def export(store, fmt="csv"):
+    if fmt == "json":
+        data = {}
+        for machine in store.machine_names():
+            data[machine] = {item: info.to_dict() for item, info in store.items(machine)}
+        return json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for machine in store.machine_names():
+        for item, info in store.items(machine):
+            writer.writerow([machine, item, info.price, info.stock, info.dm_content])
+    # Excel でも文字化けしないよう BOM を付ける
+    return buffer.getvalue().encode('utf-8-sig')
@@ -0,0 +1,132 @@
+# bus.py
+# 複数のプロセスで同じ在庫データベースを使うときの変更通知
+# 変更したプロセスが変更箇所のキー（storage.py の changes と同じ形）を流し、
+# 他のプロセスはそれを受けてメモリ上のデータと表示キャッシュを読み直す
+#
+# 通知先は subscribe(callback) で登録する。callback は変更箇所のキーのリストを受け取る async 関数
+import asyncio
+import sqlite3
+import threading
+import time
+
+
+class LocalBus:
+    # 同じプロセス内だけで通知を配る（テストや動作確認用）。同じ hub を渡した LocalBus 同士で届く
+    def __init__(self, hub=None, origin=None):
+        self.hub = hub if hub is not None else []
+        self.hub.append(self)
+        self.origin = origin if origin is not None else f"local-{len(self.hub)}"
+        self._callback = None
+
+    def subscribe(self, callback):
+        self._callback = callback
+
+    def start(self):
+        pass
+
+    def publish(self, keys):
+        loop = asyncio.get_running_loop()
+        for bus in self.hub:
+            if bus is not self and bus._callback is not None:
+                loop.create_task(bus._callback(list(keys)))
+
+    async def close(self):
+        if self in self.hub:
+            self.hub.remove(self)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    machine TEXT NOT NULL,
+    item TEXT,
+    created_at REAL NOT NULL
+);
+"""
+
+
+class SqliteBus:
+    # 在庫と同じデータベースの changes テーブルに変更を追記し、他のプロセスの追記を定期的に読む
+    def __init__(self, path, origin, poll_interval=0.5, retention=3600):
+        self.origin = origin
+        self.poll_interval = poll_interval
+        # 長く止まっていたプロセスは起動時に全体を読み直すので、古い通知は消してよい
+        self.retention = retention
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        # これより前の変更は読み込み時のデータに含まれている
+        self.last_seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        self._conn_lock = threading.Lock()
+        self._outbox = []
+        self._callback = None
+        self._task = None
+        self._last_prune = time.monotonic()
+
+    def subscribe(self, callback):
+        self._callback = callback
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._poll_loop())
+
+    def publish(self, keys):
+        # 次の周回でまとめて書き込む
+        self._outbox.extend(keys)
+
+    def _insert(self, keys):
+        now = time.time()
+        rows = [(self.origin, key[0], key[1], key[2] if len(key) > 2 else None, now) for key in keys]
+        with self._conn_lock:
+            self.conn.executemany(
+                "INSERT INTO changes (origin, kind, machine, item, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _fetch(self):
+        with self._conn_lock:
+            rows = self.conn.execute(
+                "SELECT seq, origin, kind, machine, item FROM changes WHERE seq > ? ORDER BY seq",
+                (self.last_seq,)).fetchall()
+            if time.monotonic() - self._last_prune >= self.retention / 10:
+                self._last_prune = time.monotonic()
+                self.conn.execute("DELETE FROM changes WHERE created_at < ?", (time.time() - self.retention,))
+        keys = []
+        for seq, origin, kind, machine, item in rows:
+            self.last_seq = seq
+            if origin == self.origin:
+                continue
+            key = (kind, machine, item) if kind == "item" else (kind, machine)
+            if key not in keys:
+                keys.append(key)
+        return keys
+
+    async def _send(self):
+        if not self._outbox:
+            return
+        keys, self._outbox = self._outbox, []
+        try:
+            await asyncio.to_thread(self._insert, keys)
+        except Exception as e:
+            self._outbox = keys + self._outbox
+            print(f"変更通知の書き込みエラー: {e}")
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self._send()
+            try:
+                keys = await asyncio.to_thread(self._fetch)
+            except Exception as e:
+                print(f"変更通知の読み込みエラー: {e}")
+                continue
+            if keys and self._callback is not None:
+                try:
+                    await self._callback(keys)
+                except Exception as e:
+                    print(f"変更通知の反映エラー: {e}")
+
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        await self._send()
+        self.conn.close()
@@ -0,0 +1,50 @@
+# dedup.py
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+
+def normalize_link(link):
+    # 大文字小文字の違い・末尾の / ・クエリなどを除いて、同じ決済リンクを同じ文字列にする
+    parts = urlsplit(link.strip())
+    return f"{parts.netloc.lower()}{parts.path.rstrip('/')}"
+
+
+class DedupTable:
+    # 処理済みのキー（承認 ID・インタラクション ID・決済リンクなど）を ttl 秒だけ覚えておく
+    # 件数は maxsize までで、超えたら古いものから忘れる
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._expires = OrderedDict()
+
+    def __len__(self):
+        return len(self._expires)
+
+    def __contains__(self, key):
+        self.evict_expired()
+        return key in self._expires
+
+    def claim(self, key, now=None):
+        # 初めてのキーなら覚えて True、処理中・処理済みなら False を返す
+        now = time.monotonic() if now is None else now
+        self.evict_expired(now)
+        if key in self._expires:
+            return False
+        # ttl はどのキーも同じなので、追加順がそのまま期限順になる
+        self._expires[key] = now + self.ttl
+        while len(self._expires) > self.maxsize:
+            self._expires.popitem(last=False)
+        return True
+
+    def release(self, key):
+        # 処理が失敗したときに呼び、同じ操作をやり直せるようにする
+        self._expires.pop(key, None)
+
+    def evict_expired(self, now=None):
+        now = time.monotonic() if now is None else now
+        while self._expires:
+            key, expires = next(iter(self._expires.items()))
+            if expires > now:
+                break
+            del self._expires[key]
@@ -0,0 +1,259 @@
+# delivery.py
+import asyncio
+import json
+import random
+import time
+from collections import deque
+
+import discord
+
+from metrics import DELIVERY_DROPPED, DELIVERY_WAIT_SECONDS
+
+# 優先度の高い順。購入者に届くものを先に送り、メッセージ更新や実績投稿は後回しにする
+PRIORITIES = ("high", "normal", "low")
+KIND_PRIORITY = {
+    "dm": "high",
+    "approval_request": "normal",
+    "approval_message": "normal",
+    "achievement": "low",
+    "refresh": "low",
+}
+
+
+def is_retryable(error):
+    # DM 拒否や削除済みチャンネルは何度送っても失敗するので再送しない
+    if isinstance(error, (discord.Forbidden, discord.NotFound)):
+        return False
+    if isinstance(error, discord.HTTPException):
+        return error.status == 429 or error.status >= 500
+    return True
+
+
+def retry_after(error):
+    # 429 の待ち時間（秒）。Retry-After がなければ None
+    value = getattr(error, "retry_after", None)
+    if value is None:
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        value = headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class _Job:
+    __slots__ = ("kind", "send", "record", "priority", "key", "route", "queued_at")
+
+    def __init__(self, kind, send, record, priority, key, route):
+        self.kind = kind
+        self.send = send
+        self.record = record
+        self.priority = priority
+        self.key = key
+        self.route = route
+        self.queued_at = time.monotonic()
+
+
+class DeliveryQueue:
+    # DM・実績投稿・メッセージ更新を応答の後でまとめて送るワーカー
+    # 優先度ごとに同時に送る数（budgets）とルートごとに同時に送る数（route_limit）を制限する
+    def __init__(self, workers=4, retries=5, backoff=1.0, dead_letter_path="dead_letter.jsonl",
+                 budgets=None, route_limit=2, pressure_window=1.0):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.dead_letter_path = dead_letter_path
+        # 低優先度は半分までにして、残りのワーカーを購入者向けの送信に空けておく
+        self.budgets = budgets or {"high": workers, "normal": workers, "low": max(1, workers // 2)}
+        self.route_limit = route_limit
+        # 429 を受けたら Retry-After の秒数（なければこの秒数）だけ、そのルートへの低優先度の送信を待たせる
+        # 全体のレート制限（discord.py のログ）のときは低優先度を 1 件ずつにする
+        self.pressure_window = pressure_window
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._keys = {}
+        self._in_flight = {priority: 0 for priority in PRIORITIES}
+        self._routes = {}
+        self._unfinished = 0
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._limited_until = 0.0
+        # ルート -> 429 による待ちが明ける時刻
+        self._route_limited_until = {}
+        # 送信中の送信（終了時に送り切れなかった分をデッドレターに残すため）
+        self._active = set()
+        self._closing = False
+        self._tasks = []
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    @property
+    def depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def depth_of(self, priority):
+        return len(self._queues[priority])
+
+    @property
+    def under_pressure(self):
+        return time.monotonic() < self._limited_until
+
+    def note_rate_limit(self, route=None, retry_after=None):
+        # route を指定しなければ全体のレート制限として扱う
+        # 待っている間に 429 を受けても待ちを延ばすだけで、短くはしない
+        # 終了中は残りを送り切るために待たせない
+        if self._closing:
+            return
+        until = time.monotonic() + (self.pressure_window if retry_after is None else retry_after)
+        if route is None:
+            self._limited_until = max(self._limited_until, until)
+        else:
+            self._route_limited_until[route] = max(self._route_limited_until.get(route, 0.0), until)
+
+    def _route_limited(self, route, now):
+        until = self._route_limited_until.get(route)
+        if until is None:
+            return False
+        if until <= now:
+            del self._route_limited_until[route]
+            return False
+        return True
+
+    def submit(self, kind, send, key=None, route=None, **record):
+        # send は呼ぶたびに新しいコルーチンを返す関数（再送で使うため）
+        # key が同じ送信がまだ待っていれば、新しい内容で置き換えて 1 回にまとめる
+        # route は同じ送信先への送信を数えるためのキー（チャンネルなど）
+        if key is not None:
+            job = self._keys.get(key)
+            if job is not None:
+                job.send = send
+                job.record = record
+                DELIVERY_DROPPED.inc(kind=kind, reason="coalesced")
+                return
+        job = _Job(kind, send, record, KIND_PRIORITY.get(kind, "normal"), key, route)
+        if key is not None:
+            self._keys[key] = job
+        self._queues[job.priority].append(job)
+        self._unfinished += 1
+        self._idle.clear()
+        self._ready.set()
+
+    def _budget(self, priority):
+        if priority == "low" and self.under_pressure:
+            return 1
+        return self.budgets.get(priority, self.workers)
+
+    def _next(self):
+        # 優先度の高いキューから、予算とルートの上限に収まる最初の送信を取り出す
+        # 低優先度の送信は、429 を受けたルートの待ちが明けるまで取り出さない（捨てずに後で送る）
+        now = time.monotonic()
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            if not queue or self._in_flight[priority] >= self._budget(priority):
+                continue
+            for index, job in enumerate(queue):
+                if job.route is None:
+                    available = True
+                else:
+                    available = self._routes.get(job.route, 0) < self.route_limit and not (
+                        priority == "low" and self._route_limited(job.route, now))
+                if available:
+                    del queue[index]
+                    if job.key is not None:
+                        self._keys.pop(job.key, None)
+                    return job
+        return None
+
+    def _wakeup(self):
+        # 待たせているルートがあれば、最初に待ちが明けるまでの秒数（なければ None で送信が来るまで待つ）
+        now = time.monotonic()
+        pending = [until - now for until in self._route_limited_until.values() if until > now]
+        return min(pending) if pending else None
+
+    async def _worker(self):
+        while True:
+            job = self._next()
+            if job is None:
+                self._ready.clear()
+                try:
+                    await asyncio.wait_for(self._ready.wait(), self._wakeup())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            DELIVERY_WAIT_SECONDS.observe(time.monotonic() - job.queued_at, priority=job.priority)
+            self._active.add(job)
+            self._in_flight[job.priority] += 1
+            if job.route is not None:
+                self._routes[job.route] = self._routes.get(job.route, 0) + 1
+            try:
+                await self._deliver(job.kind, job.send, job.record, job.route)
+            finally:
+                self._active.discard(job)
+                self._in_flight[job.priority] -= 1
+                if job.route is not None:
+                    count = self._routes.pop(job.route) - 1
+                    if count:
+                        self._routes[job.route] = count
+                self._unfinished -= 1
+                if not self._unfinished:
+                    self._idle.set()
+                # 予算が空いたので待っているワーカーを起こす
+                self._ready.set()
+
+    async def _deliver(self, kind, send, record, route=None):
+        for attempt in range(1, self.retries + 1):
+            try:
+                await send()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                wait = None
+                if isinstance(e, discord.HTTPException) and e.status == 429:
+                    wait = retry_after(e)
+                    # ルートのない送信（DM など）の 429 は他の送信を待たせない
+                    if route is not None:
+                        self.note_rate_limit(route, wait)
+                if not is_retryable(e) or attempt == self.retries:
+                    await self._dead_letter(kind, record, e, attempt)
+                    return
+                # 指数バックオフ（同時に再送が集中しないよう揺らぎを入れる）。429 は Retry-After より早く再送しない
+                delay = self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                await asyncio.sleep(max(delay, wait or 0))
+
+    def _append(self, line):
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+    async def _dead_letter(self, kind, record, error, attempts):
+        print(f"配送失敗 ({kind}): {error}")
+        entry = {"ts": time.time(), "kind": kind, "attempts": attempts, "error": repr(error), **record}
+        try:
+            await asyncio.to_thread(self._append, json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        except Exception as e:
+            print(f"デッドレター書き込みエラー: {e}")
+
+    async def close(self, timeout=10):
+        # 残っている配送をできるだけ送ってから止める（429 で待たせているルートも待たずに送る）
+        self._closing = True
+        self._route_limited_until.clear()
+        self._limited_until = 0.0
+        self._ready.set()
+        leftover = []
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            # 送り切れなかった分は捨てずにデッドレターに残す（送信中の分も止めてから残す）
+            leftover = list(self._active) + [job for priority in PRIORITIES for job in self._queues[priority]]
+            print(f"未配送のまま終了: {len(leftover)} 件")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job in leftover:
+            await self._dead_letter(job.kind, job.record, asyncio.TimeoutError(f"{timeout}s 以内に送れませんでした"), 0)
+        for queue in self._queues.values():
+            queue.clear()
+        self._keys.clear()
@@ -0,0 +1,143 @@
+# guilds.py
+# サーバーごとの在庫・承認待ち・設定。使われたサーバーだけ読み込み、しばらく使われなければ閉じる
+import asyncio
+import time
+
+from dedup import normalize_link
+
+
+class GuildData:
+    def __init__(self, guild_id, store, render_cache, approvals, settings, stats, dedup, defaults=None):
+        self.id = guild_id
+        self.store = store
+        self.render_cache = render_cache
+        self.approvals = approvals
+        # settings は承認・実績チャンネルなどを保存する JsonFile
+        self.settings = settings
+        self.stats = stats
+        # 処理済みの承認 ID と送信済みの決済リンク
+        self.dedup = dedup
+        self.defaults = defaults or {}
+        self.last_used = time.monotonic()
+
+    def load(self):
+        self.store.load()
+        self.approvals.load()
+        self.settings.load()
+        self.stats.load()
+        # 承認待ちのリクエストは在庫を 1 つずつ確保していて、その決済リンクは送信済み
+        pending = list(self.approvals.pending.values())
+        self.store.restore_holds((entry["jihanki"], entry["item"]) for entry in pending)
+        for entry in pending:
+            if entry.get("paypay_link"):
+                self.dedup.claim(("link", normalize_link(entry["paypay_link"])))
+
+    def start(self):
+        self.store.start()
+
+    def setting(self, key):
+        return self.settings.data.get(key) or self.defaults.get(key, 0)
+
+    def set_setting(self, key, value):
+        self.settings.data[key] = value
+        self.settings.mark_dirty()
+
+    @property
+    def approval_channel_id(self):
+        return self.setting("approval_channel_id")
+
+    @property
+    def achievement_channel_id(self):
+        return self.setting("achievement_channel_id")
+
+    async def flush(self):
+        await self.store.flush()
+        if self.store.ledger is not None:
+            await self.store.ledger.flush()
+        await self.approvals.flush()
+        await self.settings.flush()
+        await self.stats.flush()
+
+    async def close(self):
+        await self.store.close()
+        await self.approvals.close()
+        await self.settings.close()
+        await self.stats.close()
+
+
+class GuildRegistry:
+    # open_guild(guild_id) は読み込み前の GuildData を返す関数
+    def __init__(self, open_guild, idle_timeout=1800, check_interval=60):
+        self.open_guild = open_guild
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._guilds = {}
+        self._loading = {}
+        self._task = None
+
+    def __len__(self):
+        return len(self._guilds)
+
+    async def get(self, guild_id):
+        # 初めて使われたときに読み込む。ファイルの読み書きはイベントループを止めないように別スレッドで行う
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            # 読み込み中に同じサーバーが使われたら同じ読み込みを待つ
+            task = self._loading.get(guild_id)
+            if task is None:
+                task = self._loading[guild_id] = asyncio.ensure_future(self._load(guild_id))
+            guild = await asyncio.shield(task)
+        guild.last_used = time.monotonic()
+        return guild
+
+    async def _load(self, guild_id):
+        try:
+            guild = self.open_guild(guild_id)
+            try:
+                await asyncio.to_thread(guild.load)
+                guild.start()
+            except Exception:
+                # 読み込めなかったサーバーは開いたファイル・接続を閉じ、次に使われたときに読み直す
+                await guild.close()
+                raise
+            self._guilds[guild_id] = guild
+            return guild
+        finally:
+            del self._loading[guild_id]
+
+    def loaded(self):
+        return list(self._guilds.values())
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._evict_loop())
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.evict_idle()
+
+    async def evict_idle(self):
+        # 未保存の変更を書き出してからメモリから外す。次に使われたときにまた読み込む
+        for guild_id, guild in list(self._guilds.items()):
+            last_used = guild.last_used
+            if time.monotonic() - last_used < self.idle_timeout:
+                continue
+            try:
+                await guild.flush()
+            except Exception as e:
+                print(f"サーバーデータの保存エラー ({guild_id}): {e}")
+                continue
+            # 書き出している間に使われたら残す（外した後に読み込み直しても古いデータにならないように）
+            if guild.last_used != last_used or self._guilds.get(guild_id) is not guild:
+                continue
+            del self._guilds[guild_id]
+            await guild.close()
+
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+        # 読み込み中のサーバーも読み込み終わってから閉じる
+        await asyncio.gather(*self._loading.values(), return_exceptions=True)
+        for guild in list(self._guilds.values()):
+            await guild.close()
+        self._guilds.clear()
@@ -0,0 +1,75 @@
+# handles.py
+from collections import OrderedDict
+
+import discord
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        return self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class HandleCache:
+    # チャンネル・ユーザー・DM チャンネルを覚えておき、同じ相手への fetch を繰り返さない
+    def __init__(self, bot, maxsize=1000):
+        self.bot = bot
+        self._channels = LRUCache(maxsize)
+        self._users = LRUCache(maxsize)
+        self._dm_channels = LRUCache(maxsize)
+
+    async def channel(self, channel_id):
+        channel = self.bot.get_channel(channel_id) or self._channels.get(channel_id)
+        if channel is None:
+            try:
+                channel = await self.bot.fetch_channel(channel_id)
+            except (discord.NotFound, discord.Forbidden):
+                return None
+            self._channels.put(channel_id, channel)
+        return channel
+
+    async def user(self, user_id):
+        user = self.bot.get_user(user_id) or self._users.get(user_id)
+        if user is None:
+            user = await self.bot.fetch_user(user_id)
+            self._users.put(user_id, user)
+        return user
+
+    async def dm_channel(self, user_id):
+        # DM チャンネルは ID だけ覚えておけば、以降はユーザー取得も create_dm も不要
+        dm_channel_id = self._dm_channels.get(user_id)
+        if dm_channel_id is None:
+            user = await self.user(user_id)
+            dm = user.dm_channel or await user.create_dm()
+            dm_channel_id = dm.id
+            self._dm_channels.put(user_id, dm_channel_id)
+        return self.bot.get_partial_messageable(dm_channel_id, type=discord.ChannelType.private)
+
+    async def send_dm(self, user_id, *args, **kwargs):
+        dm = await self.dm_channel(user_id)
+        return await dm.send(*args, **kwargs)
+
+    def messageable(self, channel_id):
+        # 送信・編集だけなら ID から作る部分オブジェクトで足りる
+        return self.bot.get_partial_messageable(channel_id)
+
+    def partial_message(self, channel_id, message_id):
+        return self.messageable(channel_id).get_partial_message(message_id)
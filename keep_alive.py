@@ -1,16 +1,58 @@
 # keep_alive.py
-from flask import Flask
-from threading import Thread
+# ボットと同じイベントループで動く死活監視用の HTTP サーバー
+#   /         稼働確認（従来の keep_alive と同じ応答）
+#   /healthz  プロセスとイベントループが動いていれば 200
+#   /readyz   ゲートウェイ接続・コマンド同期・データ読み込みが済んでいれば 200、まだなら 503
+#   /metrics  Prometheus 形式のメトリクス
+import json
 
-app = Flask('')
+from aiohttp import web
 
-@app.route('/')
-def home():
-    return "I'm alive"
+from metrics import REGISTRY
 
-def run():
-    app.run(host='0.0.0.0', port=8080)
 
-def keep_alive():
-    t = Thread(target=run)
-    t.start()
+class KeepAliveServer:
+    def __init__(self, checks, host="0.0.0.0", port=8080):
+        # checks は {名前: 真偽を返す関数}。すべて真なら準備完了とする
+        self.checks = checks
+        self.host = host
+        self.port = port
+        self._runner = None
+        self.app = web.Application()
+        self.app.add_routes([
+            web.get("/", self.home),
+            web.get("/healthz", self.healthz),
+            web.get("/readyz", self.readyz),
+            web.get("/metrics", self.metrics),
+        ])
+
+    async def home(self, request):
+        return web.Response(text="I'm alive")
+
+    async def healthz(self, request):
+        return web.Response(text="ok")
+
+    async def readyz(self, request):
+        results = {}
+        for name, check in self.checks.items():
+            try:
+                results[name] = bool(check())
+            except Exception:
+                results[name] = False
+        status = 200 if all(results.values()) else 503
+        return web.Response(status=status, text=json.dumps(results), content_type="application/json")
+
+    async def metrics(self, request):
+        return web.Response(body=REGISTRY.render().encode('utf-8'),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"✅ Keep-alive server listening on {self.host}:{self.port}")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,225 @@
+# ledger.py
+# 在庫の変更を 1 行 1 イベントの JSON で追記していく台帳
+#   python ledger.py rebuild [出力先.json]   スナップショット + 台帳から現在の状態を復元する
+# SHARED_STORE=1 で複数のプロセスが在庫を共有しているときは、台帳はプロセスごとのファイルに分かれ、
+# 各プロセスの台帳には自分の変更しか残らない。その場合の現在の状態は SQLite のデータベースが正で、
+# rebuild はそのプロセスが行った変更の確認にしか使えない
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+from metrics import STORAGE_BYTES, STORAGE_SECONDS
+from storage import atomic_write
+
+
+def apply_event(data, event):
+    # イベントには変更後の値を記録しているので、同じイベントを何度適用しても結果は変わらない
+    kind = event["type"]
+    name = event["machine"]
+    machine = data.get(name)
+    if kind in ("add_machine", "set_item") and not isinstance(machine, dict):
+        machine = data[name] = {}
+    if kind == "set_item":
+        machine[event["item"]] = {
+            "stock": event["stock"],
+            "price": event["price"],
+            "dm_content": event.get("dm_content", "")
+        }
+    elif kind == "remove_item" and isinstance(machine, dict):
+        machine.pop(event["item"], None)
+    elif kind != "add_machine" and isinstance(machine, dict):
+        # purchase / approve / set_stock などの在庫変更
+        info = machine.get(event["item"])
+        if isinstance(info, dict):
+            info["stock"] = event["stock"]
+
+
+class Ledger:
+    def __init__(self, path, snapshot_path, batch_delay=0.2, compact_every=10000):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.batch_delay = batch_delay
+        self.compact_every = compact_every
+        self.seq = 0
+        self._since_snapshot = 0
+        self._buffer = []
+        self._flush_task = None
+        self._compact_task = None
+        self._lock = asyncio.Lock()
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _snapshot_seq(self):
+        # スナップショットは {"seq": ..., "data": ...} の順に書いているので、先頭だけ読めば seq が分かる
+        if not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+            match = re.match(r'\{"seq": (\d+)', f.read(64))
+        if match:
+            return int(match.group(1))
+        return self._read_snapshot()["seq"]
+
+    def _last_seq(self):
+        # 台帳の末尾から読み、最後の完全な行の seq を返す（書き込み途中で落ちた行は飛ばす）
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            size = 4096
+            while True:
+                start = max(0, end - size)
+                f.seek(start)
+                lines = f.read(end - start).split(b"\n")
+                # 途中から読んだ先頭の行は不完全なので使わない
+                for line in reversed(lines if start == 0 else lines[1:]):
+                    try:
+                        return json.loads(line)["seq"]
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                if start == 0:
+                    return None
+                size *= 2
+
+    def _read_events(self, after_seq):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で落ちた最後の行は捨てる
+                    continue
+                if event["seq"] > after_seq:
+                    yield event
+
+    def replay(self, data):
+        # スナップショットより後のイベントを data（保存形式の辞書）に適用し、適用したイベントを返す
+        # ストアは台帳を書いてから保存するので、保存前に落ちて保存先に残らなかった変更もこれで戻る
+        # 既に保存先に書かれているイベントも、変更後の値を記録しているので重ねて適用してよい
+        events = []
+        for event in self._read_events(self._snapshot_seq() or 0):
+            apply_event(data, event)
+            events.append(event)
+        return events
+
+    def open(self, data):
+        # 読み込み時に呼ぶ。スナップショットがなければ現在の状態を起点として書き出す
+        # イベントループ上で呼ばれるので、台帳全体は読まずに末尾の seq だけ確認する
+        snapshot_seq = self._snapshot_seq()
+        if snapshot_seq is None:
+            atomic_write(self.snapshot_path, json.dumps({"seq": 0, "data": data}, ensure_ascii=False))
+            snapshot_seq = 0
+        # seq は 1 ずつ増えるので、スナップショット後のイベント数は seq の差で分かる
+        self.seq = max(snapshot_seq, self._last_seq() or 0)
+        self._since_snapshot = self.seq - snapshot_seq
+
+    def rebuild(self):
+        snapshot = self._read_snapshot() or {"seq": 0, "data": {}}
+        data = snapshot["data"]
+        for event in self._read_events(snapshot["seq"]):
+            apply_event(data, event)
+        return data
+
+    # ---- 追記 ----
+
+    def append(self, event):
+        self.seq += 1
+        self._since_snapshot += 1
+        event = {"seq": self.seq, "ts": time.time(), **event}
+        self._buffer.append(json.dumps(event, ensure_ascii=False) + "\n")
+        # fsync はまとめて行う
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+    def needs_compaction(self):
+        return self._since_snapshot >= self.compact_every and (
+            self._compact_task is None or self._compact_task.done())
+
+    async def _flush_later(self):
+        while self._buffer:
+            await asyncio.sleep(self.batch_delay)
+            await self.flush()
+
+    def _write_lines(self, lines):
+        target = os.path.basename(self.path)
+        with STORAGE_SECONDS.time(target=target, op="write"):
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        STORAGE_BYTES.inc(sum(len(line.encode('utf-8')) for line in lines), target=target, op="write")
+
+    async def flush(self):
+        # 書き込めなかった場合は False を返す（残りは次の flush で書く）
+        async with self._lock:
+            return await self._flush_locked()
+
+    async def _flush_locked(self):
+        if not self._buffer:
+            return True
+        lines, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write_lines, lines)
+        except Exception as e:
+            self._buffer = lines + self._buffer
+            print(f"台帳書き込みエラー: {e}")
+            return False
+        return True
+
+    # ---- スナップショットと圧縮 ----
+
+    def schedule_compaction(self, snapshot):
+        # snapshot は保存形式の辞書を返す関数
+        self._compact_task = asyncio.get_running_loop().create_task(self.compact(snapshot))
+
+    def _replace_files(self, snapshot_text):
+        # スナップショットを先に書くので、台帳を消す前に落ちても古いイベントは seq で読み飛ばされる
+        atomic_write(self.snapshot_path, snapshot_text)
+        atomic_write(self.path, "")
+
+    async def compact(self, snapshot):
+        async with self._lock:
+            await self._flush_locked()
+            if self._buffer:
+                return
+            # ここまでのイベントはすべてファイルに書かれているので、この時点の状態と seq を対にして保存する
+            snapshot_text = json.dumps({"seq": self.seq, "data": snapshot()}, ensure_ascii=False)
+            self._since_snapshot = 0
+            try:
+                await asyncio.to_thread(self._replace_files, snapshot_text)
+            except Exception as e:
+                print(f"台帳圧縮エラー: {e}")
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("usage: python ledger.py rebuild [出力先.json]")
+        return
+    out_path = sys.argv[2] if len(sys.argv) > 2 else "jihanki.rebuilt.json"
+    ledger = Ledger(os.getenv("LEDGER_FILE", "ledger.jsonl"), os.getenv("LEDGER_SNAPSHOT_FILE", "ledger_snapshot.json"))
+    data = ledger.rebuild()
+    atomic_write(out_path, json.dumps(data, indent=2, ensure_ascii=False))
+    print(f"✅ {out_path} に復元しました")
+
+if __name__ == "__main__":
+    main()
@@ -1,157 +1,421 @@
 import discord
 from discord.ext import commands
 from discord import app_commands
-import json
+import asyncio
+import io
 import os
-from dotenv import load_dotenv
-from keep_alive import keep_alive
+import socket
+import sys
+import time
+
+# 起動にかかった時間を表示するため、読み込み開始時刻を覚えておく
+STARTED_AT = time.perf_counter()
 
-keep_alive()  
+from dotenv import load_dotenv
+from bus import SqliteBus
+from keep_alive import KeepAliveServer
+from ledger import Ledger
+from metrics import GATEWAY_LATENCY, GUILDS_LOADED, HANDLER_SECONDS, QUEUE_DEPTH, THROTTLED, DEDUP_DROPPED, install_rate_limit_counter, instrument_http, timed
+from storage import JsonFile, open_backend
+from refresh import RefreshScheduler
+from render import RenderCache
+from approvals import ApprovalQueue
+from delivery import PRIORITIES, DeliveryQueue
+import bulk
+from handles import HandleCache
+from search import ItemIndex
+from guilds import GuildData, GuildRegistry
+from stats import SalesStats
+from throttle import Throttle, acquire
+from dedup import DedupTable, normalize_link
+from store import JihankiStore, machine_key
+from treesync import sync_tree
 
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
-GUILD_ID = int(os.getenv("GUILD_ID"))
+# 以前の単一サーバー用のファイルをそのままデータとして使うサーバー（以前の GUILD_ID も読む）
+LEGACY_GUILD_ID = int(os.getenv("LEGACY_GUILD_ID", os.getenv("GUILD_ID", 0)))
+# 開発用。コマンドを全体に同期したうえで、このサーバーにも同期してすぐ反映させる
+DEV_GUILD_ID = int(os.getenv("DEV_GUILD_ID", 0))
+# 以前はコマンドをこのサーバーだけに同期していた。全体に同期したコマンドと二重に出ないよう、一度だけ空にする
+OLD_COMMAND_GUILD_ID = int(os.getenv("GUILD_ID", 0))
+GUILD_DATA_DIR = os.getenv("GUILD_DATA_DIR", "guilds")
+GUILD_IDLE_TIMEOUT = float(os.getenv("GUILD_IDLE_TIMEOUT", 1800))
+SHARDED = os.getenv("SHARDED", "0") == "1"
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0))
+# シャードをいくつかのプロセスに分けるときは、プロセスごとに担当するシャードを 0,1,2 のように指定する（SHARD_COUNT も必要）
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(",") if i.strip()]
+# SHARED_STORE=1 で複数のプロセスが同じ SQLite の在庫を使う。在庫の確定はデータベース上で行い、変更を通知し合う
+SHARED_STORE = os.getenv("SHARED_STORE", "0") == "1"
+PROCESS_NAME = os.getenv("PROCESS_NAME") or (f"shards-{'-'.join(map(str, SHARD_IDS))}" if SHARD_IDS else socket.gethostname())
+BUS_POLL_INTERVAL = float(os.getenv("BUS_POLL_INTERVAL", 0.5))
+# コマンド定義のハッシュの保存先。変わっていなければ起動時の同期を省略する（--sync-commands で強制）
+COMMAND_SYNC_FILE = os.getenv("COMMAND_SYNC_FILE", "command_sync.json")
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "0") == "1" or "--sync-commands" in sys.argv
 DATA_FILE = "jihanki.json"
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+DATABASE_FILE = os.getenv("DATABASE_FILE", "jihanki.db")
+LEDGER_FILE = os.getenv("LEDGER_FILE", "ledger.jsonl")
+LEDGER_SNAPSHOT_FILE = os.getenv("LEDGER_SNAPSHOT_FILE", "ledger_snapshot.json")
+LEDGER_COMPACT_EVERY = int(os.getenv("LEDGER_COMPACT_EVERY", 10000))
+APPROVALS_FILE = os.getenv("APPROVALS_FILE", "approvals.json")
+GUILD_SETTINGS_FILE = os.getenv("GUILD_SETTINGS_FILE", "settings.json")
+STATS_FILE = os.getenv("STATS_FILE", "stats.json")
+# LEGACY_GUILD_ID のサーバーの承認・実績チャンネルの初期値（他のサーバーは /jihanki_settings で設定する）
 APPROVAL_CHANNEL_ID = int(os.getenv("APPROVAL_CHANNEL_ID", 0))
 ACHIEVEMENT_CHANNEL_ID = int(os.getenv("ACHIEVEMENT_CHANNEL_ID", 0))
+SAVE_DELAY = float(os.getenv("SAVE_DELAY", 1.0))
+REFRESH_DELAY = float(os.getenv("REFRESH_DELAY", 1.0))
+REFRESH_CONCURRENCY = int(os.getenv("REFRESH_CONCURRENCY", 5))
+HANDLE_CACHE_SIZE = int(os.getenv("HANDLE_CACHE_SIZE", 1000))
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", 4))
+DELIVERY_RETRIES = int(os.getenv("DELIVERY_RETRIES", 5))
+DEAD_LETTER_FILE = os.getenv("DEAD_LETTER_FILE", "dead_letter.jsonl")
+KEEP_ALIVE_HOST = os.getenv("KEEP_ALIVE_HOST", "0.0.0.0")
+KEEP_ALIVE_PORT = int(os.getenv("KEEP_ALIVE_PORT", os.getenv("PORT", 8080)))
+RESERVATION_TTL = float(os.getenv("RESERVATION_TTL", 1800))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv("RESERVATION_SWEEP_INTERVAL", 60))
+# 購入ボタン・決済リンク送信の連打制限（回/秒 と 続けて使える回数）。RATE を 0 にすると制限しない
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", 0.5))
+THROTTLE_USER_BURST = int(os.getenv("THROTTLE_USER_BURST", 5))
+THROTTLE_MACHINE_RATE = float(os.getenv("THROTTLE_MACHINE_RATE", 5))
+THROTTLE_MACHINE_BURST = int(os.getenv("THROTTLE_MACHINE_BURST", 20))
+# 処理済みの承認 ID・決済リンクを覚えておく秒数と件数（サーバーごと）
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", 86400))
+DEDUP_SIZE = int(os.getenv("DEDUP_SIZE", 10000))
+# インタラクションのトークンは 15 分で切れるので、それより長く覚えておく必要はない
+INTERACTION_DEDUP_TTL = float(os.getenv("INTERACTION_DEDUP_TTL", 900))
+PAYPAY_LINK_MAX_LENGTH = int(os.getenv("PAYPAY_LINK_MAX_LENGTH", 200))
 
-if not os.path.exists(DATA_FILE):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump({}, f)
+if SHARED_STORE and STORAGE_BACKEND != "sqlite":
+    raise SystemExit("SHARED_STORE=1 には STORAGE_BACKEND=sqlite が必要です")
 
-def load_data():
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+def process_file(name):
+    # 追記していくファイルはプロセスごとに分ける（同じファイルに複数のプロセスが追記すると連番が壊れる）
+    if not SHARED_STORE:
+        return name
+    root, ext = os.path.splitext(name)
+    return f"{root}.{PROCESS_NAME}{ext}"
+
+def open_guild(guild_id):
+    # LEGACY_GUILD_ID のサーバーは以前と同じ場所のファイルをそのまま使い、他のサーバーはサーバーごとのフォルダに分ける
+    if guild_id == LEGACY_GUILD_ID:
+        path = lambda name: name
+        defaults = {"approval_channel_id": APPROVAL_CHANNEL_ID, "achievement_channel_id": ACHIEVEMENT_CHANNEL_ID}
+    else:
+        directory = os.path.join(GUILD_DATA_DIR, str(guild_id))
+        os.makedirs(directory, exist_ok=True)
+        path = lambda name: os.path.join(directory, os.path.basename(name))
+        defaults = {}
+    
+    # 在庫データは最初に使われたときに一度だけ読み込み、保存はバックグラウンドでまとめて行う
+    data_path = path(DATABASE_FILE if STORAGE_BACKEND == "sqlite" else DATA_FILE)
+    store = JihankiStore(
+        open_backend(STORAGE_BACKEND, data_path),
+        flush_delay=SAVE_DELAY,
+        ledger=Ledger(path(process_file(LEDGER_FILE)), path(process_file(LEDGER_SNAPSHOT_FILE)), compact_every=LEDGER_COMPACT_EVERY),
+        index=ItemIndex(),
+        bus=SqliteBus(data_path, f"{PROCESS_NAME}:{os.getpid()}", poll_interval=BUS_POLL_INTERVAL) if SHARED_STORE else None,
+        # 確保はプロセス名で記録し、再起動したときに前回の分を置き換える
+        owner=PROCESS_NAME
+    )
+    return GuildData(
+        guild_id, store, RenderCache(store),
+        ApprovalQueue(path(APPROVALS_FILE), flush_delay=SAVE_DELAY),
+        JsonFile(path(GUILD_SETTINGS_FILE), {}, flush_delay=SAVE_DELAY),
+        SalesStats(path(STATS_FILE), flush_delay=SAVE_DELAY),
+        DedupTable(DEDUP_TTL, DEDUP_SIZE),
+        defaults
+    )
 
-def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+guilds = GuildRegistry(open_guild, idle_timeout=GUILD_IDLE_TIMEOUT)
 
-class JihankiBot(commands.Bot):
+async def guild_data(interaction):
+    return await guilds.get(interaction.guild_id)
+
+# 多数のサーバーで動かすときは SHARDED=1 で自動シャーディングする
+BotBase = commands.AutoShardedBot if SHARDED else commands.Bot
+
+class JihankiBot(BotBase):
     def __init__(self):
         intents = discord.Intents.default()
         intents.messages = True
         intents.message_content = True
         intents.guilds = True
-        super().__init__(command_prefix="!", intents=intents)
+        options = {}
+        if SHARDED and SHARD_COUNT:
+            options["shard_count"] = SHARD_COUNT
+        if SHARDED and SHARD_IDS:
+            options["shard_ids"] = SHARD_IDS
+        super().__init__(command_prefix="!", intents=intents, **options)
+        self.commands_synced = False
+        self.startup_logged = False
+        # 以前のデータを読み込めたか（/readyz 用。サーバーの一覧が揃う on_ready で読み込む）
+        self.store_ready = not LEGACY_GUILD_ID
+        # setup_hook の途中で失敗しても close() できるように、先に用意しておく
+        self.sweeper = None
 
     async def setup_hook(self):
-        await self.tree.sync(guild=discord.Object(id=GUILD_ID))
-        print("✅ Slash commands synced")
+        # 送信済みの自販機・承認メッセージのボタンを再起動後も受け付ける
+        self.add_dynamic_items(PurchaseButton, LegacyPurchaseButton, CatalogButton, ApproveButton, DenyButton)
+        # REST 呼び出しと 429 を /metrics に出す
+        instrument_http(self.http)
+        install_rate_limit_counter(deliveries.note_rate_limit)
+        deliveries.start()
+        guilds.start()
+        await keep_alive.start()
+        self.sweeper = asyncio.create_task(sweep_reservations())
+        
+        # コマンドは常に全体に同期する（どのサーバーでも使えるように）
+        targets = [None]
+        if DEV_GUILD_ID:
+            # 開発用。全体への同期は反映に時間がかかるので、このサーバーにも同期してすぐ反映させる
+            guild = discord.Object(id=DEV_GUILD_ID)
+            self.tree.copy_global_to(guild=guild)
+            targets.append(guild)
+        if OLD_COMMAND_GUILD_ID and OLD_COMMAND_GUILD_ID != DEV_GUILD_ID:
+            # 何もコピーせずに同期して以前のコマンドを消す（同期済みなら前回と同じなので飛ばされる）
+            targets.append(discord.Object(id=OLD_COMMAND_GUILD_ID))
+        for guild in targets:
+            synced, seconds = await sync_tree(self.tree, guild, self.application_id, COMMAND_SYNC_FILE, force=FORCE_COMMAND_SYNC)
+            target = "global" if guild is None else guild.id
+            if synced:
+                print(f"✅ Slash commands synced to {target} ({seconds:.2f}s)")
+            else:
+                print(f"✅ Slash commands unchanged for {target}, sync skipped (saved ~{seconds:.2f}s)")
+        self.commands_synced = True
+
+    async def on_ready(self):
+        # 再接続のたびに呼ばれるので最初の 1 回だけ表示する
+        if not self.startup_logged:
+            self.startup_logged = True
+            print(f"✅ Ready in {time.perf_counter() - STARTED_AT:.2f}s as {self.user}")
+        if not self.store_ready:
+            # 以前のデータはこのプロセスが受け持つサーバーのときだけ読み込む（他のプロセスと承認待ちを二重に扱わないように）
+            # 読めなければ /readyz に出し、次に再接続したときに読み直す
+            if not serves(LEGACY_GUILD_ID):
+                self.store_ready = True
+                return
+            try:
+                await guilds.get(LEGACY_GUILD_ID)
+                self.store_ready = True
+            except Exception as e:
+                print(f"サーバーデータの読み込みエラー ({LEGACY_GUILD_ID}): {e}")
+
+    async def close(self):
+        # 未送信の配送と未保存の変更を書き出してから終了
+        # 待ち時間中の自販機メッセージの更新は配送キューに回してから、配送キューを送り切る
+        await refresher.close()
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+        await deliveries.close()
+        await guilds.close()
+        await keep_alive.close()
+        await super().close()
 
 bot = JihankiBot()
 
+def serves(guild_id):
+    # シャーディングや SHARED_STORE で分けたとき、このプロセスに接続しているサーバーだけを扱う
+    return bot.get_guild(guild_id) is not None
+
+handles = HandleCache(bot, maxsize=HANDLE_CACHE_SIZE)
+health_checks = {
+    "gateway": lambda: bot.is_ready() and not bot.is_closed(),
+    "commands_synced": lambda: bot.commands_synced,
+}
+if LEGACY_GUILD_ID:
+    # 他のサーバーは使われたときに読み込むので、起動時に読み込む以前のデータだけを確認する
+    health_checks["store_loaded"] = lambda: bot.store_ready
+keep_alive = KeepAliveServer(health_checks, host=KEEP_ALIVE_HOST, port=KEEP_ALIVE_PORT)
+deliveries = DeliveryQueue(
+    workers=DELIVERY_WORKERS,
+    retries=DELIVERY_RETRIES,
+    dead_letter_path=process_file(DEAD_LETTER_FILE)
+)
+
 # 在庫変更時に自販機メッセージを更新する関数
-async def update_jihanki_messages(jihanki_name):
-    data = load_data()
+@timed(HANDLER_SECONDS, handler="refresh")
+async def update_jihanki_messages(guild_id, jihanki_name):
+    guild = await guilds.get(guild_id)
+    store = guild.store
     
     # メッセージIDが保存されていない場合は何もしない
-    if jihanki_name not in data or "message_ids" not in data[jihanki_name]:
+    if not store.has_machine(jihanki_name) or not store.message_ids(jihanki_name):
         return
         
-    for msg_info in data[jihanki_name]["message_ids"]:
-        try:
-            channel_id = msg_info["channel_id"]
-            message_id = msg_info["message_id"]
-            
-            channel = bot.get_channel(channel_id)
-            if not channel:
-                channel = await bot.fetch_channel(channel_id)
-                
-            message = await channel.fetch_message(message_id)
-            
-            # 埋め込みを更新
-            embed = discord.Embed(
-                title=f"🏪 {jihanki_name}",
-                description="下のボタンから商品を購入できます",
-                color=discord.Color.blue()
-            )
-            
-            # 商品情報を価格順にソート
-            items = []
-            for item, info in data[jihanki_name].items():
-                if isinstance(info, dict) and "price" in info:
-                    items.append((item, info))
-            
-            # 価格順に並べ替え
-            items.sort(key=lambda x: x[1]["price"])
-            
-            # 商品を下に表示
-            for item, info in items:
-                # 在庫状況に応じた絵文字
-                if info['stock'] <= 0:
-                    stock_status = "❌ 在庫切れ"
-                elif info['stock'] < 5:
-                    stock_status = f"⚠️ 残り{info['stock']}個"
-                else:
-                    stock_status = f"✅ 在庫あり ({info['stock']}個)"
-                    
-                # 価格表示
-                if info['price'] == 0:
-                    price_display = "🆓 無料"
-                else:
-                    price_display = f"💰 {info['price']}円"
-                    
-                embed.add_field(
-                    name=item,
-                    value=f"{price_display}\n{stock_status}",
-                    inline=True
-                )
-                
-            embed.set_footer(text=f"最終更新: {discord.utils.utcnow().strftime('%Y/%m/%d %H:%M:%S')}")
-            
-            await message.edit(embed=embed)
-        except Exception as e:
-            print(f"メッセージ更新エラー: {e}")
-            continue
+    # 埋め込みは在庫が変わった時だけ作り直す（ページが増えた時のためボタンも付け直す）
+    embed = guild.render_cache.embed(jihanki_name)
+    view = purchase_view(guild, jihanki_name)
+    
+    async def edit(msg_info):
+        channel_id = msg_info.channel_id
+        message_id = msg_info.message_id
+        
+        # 同時に編集するメッセージ数を制限する
+        async with refresh_semaphore:
+            try:
+                # 取得せずに ID だけで編集する
+                await handles.partial_message(channel_id, message_id).edit(embed=embed, view=view)
+            except discord.NotFound:
+                # 削除されたメッセージ・チャンネルは次回から更新しない
+                store.remove_message(jihanki_name, message_id)
+            except Exception as e:
+                print(f"メッセージ更新エラー: {e}")
+                return e
+    
+    # 各チャンネルのメッセージを並行して更新
+    errors = await asyncio.gather(*(edit(msg_info) for msg_info in list(store.message_ids(jihanki_name))))
+    errors = [e for e in errors if e is not None]
+    if errors:
+        # 配送キューに再送させる
+        raise errors[0]
+
+async def enqueue_refresh(key):
+    guild_id, jihanki_name = key
+    # まだ送っていない同じ自販機の更新があれば 1 回にまとめる
+    deliveries.submit(
+        "refresh", lambda: update_jihanki_messages(guild_id, jihanki_name),
+        key=("refresh", guild_id, jihanki_name), route=("guild", guild_id),
+        guild_id=guild_id, jihanki=jihanki_name
+    )
+
+def schedule_refresh(guild, jihanki_name):
+    # 自販機名はサーバーごとなので、サーバー ID と組にして更新をまとめる
+    refresher.schedule((guild.id, jihanki_name))
+
+def queue_dm(user_id, **kwargs):
+    record = {"user_id": user_id, "content": kwargs.get("content")}
+    if "embed" in kwargs:
+        record["embed"] = kwargs["embed"].to_dict()
+    deliveries.submit("dm", lambda: handles.send_dm(user_id, **kwargs), **record)
+
+def queue_achievement(guild, embed):
+    channel_id = guild.achievement_channel_id
+    if not channel_id:
+        return
+    deliveries.submit(
+        "achievement",
+        lambda: handles.messageable(channel_id).send(embed=embed),
+        route=("channel", channel_id), channel_id=channel_id, embed=embed.to_dict()
+    )
+
+user_throttle = Throttle("user", THROTTLE_USER_RATE, THROTTLE_USER_BURST)
+machine_throttle = Throttle("machine", THROTTLE_MACHINE_RATE, THROTTLE_MACHINE_BURST)
+# 購入メニューでの商品の選択（選び直し・無料商品の連続購入）は、ボタンとは別に数える
+step_throttle = Throttle("step", THROTTLE_USER_RATE, THROTTLE_USER_BURST)
+
+handled_interactions = DedupTable(INTERACTION_DEDUP_TTL, DEDUP_SIZE)
+
+def first_delivery(interaction):
+    # 同じインタラクションが二度届いても一度しか処理しない（最初の処理が応答する）
+    if handled_interactions.claim(interaction.id):
+        return True
+    DEDUP_DROPPED.inc(kind="interaction")
+    return False
+
+def claim_approval(guild, approval_id):
+    # 承認 ID ごとに一度だけ取り出す。処理中・処理済みなら None
+    if not guild.dedup.claim(("approval", approval_id)):
+        DEDUP_DROPPED.inc(kind="approval")
+        return None
+    return guild.approvals.pop(approval_id)
+
+def restore_approval(guild, approval_id, entry):
+    # 承認できなかったものは承認待ちに戻し、もう一度処理できるようにする
+    guild.approvals.restore(approval_id, entry)
+    guild.dedup.release(("approval", approval_id))
+
+async def throttled(interaction, jihanki_name, action):
+    # 連打されたら保存データや REST に触る前に断る。断った場合は True を返す
+    # 購入ボタンと /buy で 1 回の購入につき 1 回だけ数える
+    return await refuse_if_limited(
+        interaction, action,
+        (user_throttle, interaction.user.id),
+        (machine_throttle, (interaction.guild_id, jihanki_name))
+    )
+
+async def step_throttled(interaction, action):
+    # 購入の途中の操作は、利用者ごとの別の枠で数える
+    return await refuse_if_limited(interaction, action, (step_throttle, interaction.user.id))
+
+async def refuse_if_limited(interaction, action, *checks):
+    wait, scope = acquire(*checks)
+    if not wait:
+        return False
+    THROTTLED.inc(scope=scope, action=action)
+    await interaction.response.send_message(f"⏳ 操作が多すぎます。{max(1, round(wait))}秒ほど待ってからもう一度お試しください。", ephemeral=True)
+    return True
+
+refresh_semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+refresher = RefreshScheduler(enqueue_refresh, delay=REFRESH_DELAY)
+
+# /metrics で読み出すときに取りに行く値
+QUEUE_DEPTH.set_function(lambda: deliveries.depth, queue="delivery")
+for priority in PRIORITIES:
+    QUEUE_DEPTH.set_function(lambda priority=priority: deliveries.depth_of(priority), queue=f"delivery_{priority}")
+QUEUE_DEPTH.set_function(lambda: refresher.pending, queue="refresh")
+QUEUE_DEPTH.set_function(lambda: sum(len(guild.approvals.pending) for guild in guilds.loaded()), queue="approvals")
+GUILDS_LOADED.set_function(lambda: len(guilds))
+GATEWAY_LATENCY.set_function(lambda: bot.latency)
+
+# 25 件を超える一覧のページ送りボタン
+class PageButton(discord.ui.Button):
+    def __init__(self, label, page, goto, disabled=False):
+        super().__init__(label=label, style=discord.ButtonStyle.secondary, disabled=disabled, row=1)
+        self.page = page
+        self.goto = goto
+
+    async def callback(self, interaction: discord.Interaction):
+        await self.goto(interaction, self.page)
+
+def shorten(text, limit):
+    # 埋め込みの文字数制限に収まるように切り詰める
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def add_page_buttons(view, page, page_count, goto):
+    if page_count <= 1:
+        return
+    view.add_item(PageButton("◀ 前へ", page - 1, goto, disabled=page <= 0))
+    view.add_item(PageButton(f"{page + 1}/{page_count}", page, goto, disabled=True))
+    view.add_item(PageButton("次へ ▶", page + 1, goto, disabled=page >= page_count - 1))
+
+class SearchButton(discord.ui.Button):
+    # make_view(guild, options) は検索結果の選択肢で作り直したビューを返す
+    def __init__(self, jihanki_name, make_view):
+        super().__init__(label="🔍 検索", style=discord.ButtonStyle.secondary, row=1)
+        self.jihanki_name = jihanki_name
+        self.make_view = make_view
+
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.send_modal(ItemSearchModal(self.jihanki_name, self.make_view))
+
+class ItemSearchModal(discord.ui.Modal, title="商品検索"):
+    query = discord.ui.TextInput(label="商品名", placeholder="商品名の一部を入力")
+
+    def __init__(self, jihanki_name, make_view):
+        super().__init__()
+        self.jihanki_name = jihanki_name
+        self.make_view = make_view
+
+    @timed(HANDLER_SECONDS, handler="search_modal")
+    async def on_submit(self, interaction: discord.Interaction):
+        guild = await guild_data(interaction)
+        options = guild.render_cache.search_options(self.jihanki_name, self.query.value.strip())
+        if not options:
+            await interaction.response.send_message("❌ 一致する商品がありません。", ephemeral=True)
+            return
+        await interaction.response.edit_message(view=self.make_view(guild, options))
 
 class SelectItemToPurchase(discord.ui.Select):
-    def __init__(self, jihanki_name):
+    # guild は選択肢を作るためだけに使う。操作されたときはその時点のサーバーデータを引き直す
+    # （しばらく使われずに閉じたデータを変更しないように）
+    def __init__(self, guild, jihanki_name, page=0, options=None):
         self.jihanki_name = jihanki_name
-        data = load_data()
         
-        # 商品ごとに在庫状況に応じた絵文字を追加
-        options = []
-        
-        # データ構造のチェックと商品情報の取得
-        if jihanki_name in data:
-            for item, info in data[jihanki_name].items():
-                # message_idsキーはスキップ
-                if item == "message_ids":
-                    continue
-                    
-                # 辞書かどうか確認し、必要なキーが存在するか確認
-                if isinstance(info, dict) and "stock" in info and "price" in info:
-                    # 在庫状況に応じた絵文字を設定
-                    if info['stock'] <= 0:
-                        emoji = "❌"
-                        description = f"在庫切れ | {info['price']}円"
-                    elif info['stock'] < 5:
-                        emoji = "⚠️"
-                        description = f"残り{info['stock']}個 | {info['price']}円"
-                    else:
-                        emoji = "✅"
-                        description = f"在庫あり ({info['stock']}個) | {info['price']}円"
-                        
-                    options.append(
-                        discord.SelectOption(
-                            label=item,
-                            value=item,
-                            description=description,
-                            emoji=emoji
-                        )
-                    )
-        
-        # オプションが空の場合はダミーオプションを追加
-        if not options:
-            options.append(
-                discord.SelectOption(
-                    label="商品がありません",
-                    value="no_items",
-                    description="この自販機には商品がありません",
-                    emoji="❌"
-                )
-            )
+        # ページごとの選択肢は作成済みのものを使う
+        if options is None:
+            options = guild.render_cache.options(jihanki_name, page)
             
         super().__init__(
             placeholder="🛒 購入する商品を選んでください",
@@ -161,6 +425,8 @@ class SelectItemToPurchase(discord.ui.Select):
         )
 
     async def callback(self, interaction: discord.Interaction):
+        if await step_throttled(interaction, "select_item"):
+            return
         item = self.values[0]
         
         # 商品がない場合の処理
@@ -168,232 +434,478 @@ class SelectItemToPurchase(discord.ui.Select):
             await interaction.response.send_message("❌ この自販機には商品がありません。", ephemeral=True)
             return
             
-        data = load_data()
-        
-        # データ構造の確認
-        if self.jihanki_name not in data or item not in data[self.jihanki_name]:
-            await interaction.response.send_message("❌ 商品情報が見つかりません。", ephemeral=True)
-            return
-            
-        if not isinstance(data[self.jihanki_name][item], dict) or "stock" not in data[self.jihanki_name][item]:
-            await interaction.response.send_message("❌ 商品情報が正しくありません。", ephemeral=True)
-            return
-            
-        stock = data[self.jihanki_name][item]["stock"]
-        
-        if stock <= 0:
-            await interaction.response.send_message("❌ 在庫切れです。", ephemeral=True)
-            return
-            
-        price = data[self.jihanki_name][item]["price"]
-        
-        if price == 0:
-            # 価格が0円の場合は直接DMに送信
-            await self.process_purchase(interaction, item, None)
-        else:
-            # 価格が0円でない場合はPayPayリンク入力モーダルを表示
-            await interaction.response.send_modal(PayPayLinkModal(self.jihanki_name, item))
+        await start_purchase(interaction, await guild_data(interaction), self.jihanki_name, item)
 
-    async def process_purchase(self, interaction, item, paypay_link=None):
-        data = load_data()
-        data[self.jihanki_name][item]["stock"] -= 1
-        save_data(data)
+# 商品選択後の購入処理（購入メニューと /buy で共通）
+@timed(HANDLER_SECONDS, handler="start_purchase")
+async def start_purchase(interaction, guild, jihanki_name, item):
+    # 連打の制限は呼び出し側で 1 回だけ行う（購入メニューの選択・/buy）
+    store = guild.store
+    info = store.get_item(jihanki_name, item)
+    
+    # データ構造の確認
+    if info is None:
+        await interaction.response.send_message("❌ 商品情報が見つかりません。", ephemeral=True)
+        return
         
-        # 自販機メッセージを更新
-        await update_jihanki_messages(self.jihanki_name)
-        
-        # 価格に応じた色を設定
-        if data[self.jihanki_name][item]['price'] == 0:
-            embed_color = discord.Color.green()  # 無料商品は緑色
-        elif data[self.jihanki_name][item]['price'] < 500:
-            embed_color = discord.Color.blue()   # 安価な商品は青色
-        elif data[self.jihanki_name][item]['price'] < 1000:
-            embed_color = discord.Color.gold()   # 中価格帯は金色
-        else:
-            embed_color = discord.Color.purple() # 高価格帯は紫色
+    # 承認待ちで確保されている分は買えない
+    if store.available(jihanki_name, item) <= 0:
+        await interaction.response.send_message("❌ 在庫切れです。", ephemeral=True)
+        return
         
-        # DMに送信する内容
-        embed = discord.Embed(
-            title="🎉 購入完了", 
-            description=f"**{item}** を購入しました！", 
+    price = info.price
+    
+    if price == 0:
+        # 価格が0円の場合は直接DMに送信
+        await process_purchase(interaction, guild, jihanki_name, item, None)
+    else:
+        # 価格が0円でない場合はPayPayリンク入力モーダルを表示
+        await interaction.response.send_modal(PayPayLinkModal(jihanki_name, item))
+
+@timed(HANDLER_SECONDS, handler="purchase")
+async def process_purchase(interaction, guild, jihanki_name, item, paypay_link=None):
+    if not first_delivery(interaction):
+        return
+    store = guild.store
+    # 在庫の確認と減算はロック内でまとめて行う（同時購入での売り越し防止）
+    remaining = await store.decrement_stock(jihanki_name, item, user_id=interaction.user.id)
+    if remaining is None:
+        await interaction.response.send_message("❌ 在庫切れです。", ephemeral=True)
+        return
+    info = store.get_item(jihanki_name, item)
+    guild.stats.record(jihanki_name, item, interaction.user.id, info.price)
+    
+    # 先に応答し、DM と実績投稿は配送キューから送る（応答期限に間に合わせるため）
+    await interaction.response.send_message("✅ 購入しました。DMに購入情報を送ります。", ephemeral=True)
+    
+    # 自販機メッセージを更新
+    schedule_refresh(guild, jihanki_name)
+    
+    # 価格に応じた色を設定
+    if info.price == 0:
+        embed_color = discord.Color.green()  # 無料商品は緑色
+    elif info.price < 500:
+        embed_color = discord.Color.blue()   # 安価な商品は青色
+    elif info.price < 1000:
+        embed_color = discord.Color.gold()   # 中価格帯は金色
+    else:
+        embed_color = discord.Color.purple() # 高価格帯は紫色
+    
+    # DMに送信する内容
+    embed = discord.Embed(
+        title="🎉 購入完了", 
+        description=f"**{item}** を購入しました！", 
+        color=embed_color
+    )
+    embed.add_field(name="💰 価格", value=f"{info.price}円")
+    embed.add_field(name="📦 残り在庫", value=f"{remaining}")
+    
+    # DMに送信する商品情報があれば追加
+    if info.dm_content:
+        embed.add_field(name="📝 商品情報", value=info.dm_content, inline=False)
+    
+    # フッターに購入日時を追加
+    embed.set_footer(text=f"購入日時: {discord.utils.utcnow().strftime('%Y/%m/%d %H:%M:%S')}")
+    
+    queue_dm(interaction.user.id, embed=embed)
+    
+    # 実績チャンネルに送信
+    if guild.achievement_channel_id:
+        achievement_embed = discord.Embed(
+            title="🛍️ 購入実績", 
+            description=f"{interaction.user.mention} が **{item}** を購入しました！", 
             color=embed_color
         )
-        embed.add_field(name="💰 価格", value=f"{data[self.jihanki_name][item]['price']}円")
-        embed.add_field(name="📦 残り在庫", value=f"{data[self.jihanki_name][item]['stock']}")
-        
-        # DMに送信する商品情報があれば追加
-        if "dm_content" in data[self.jihanki_name][item] and data[self.jihanki_name][item]["dm_content"]:
-            embed.add_field(name="📝 商品情報", value=data[self.jihanki_name][item]["dm_content"], inline=False)
-        
-        # フッターに購入日時を追加
-        embed.set_footer(text=f"購入日時: {discord.utils.utcnow().strftime('%Y/%m/%d %H:%M:%S')}")
-        
-        await interaction.user.send(embed=embed)
-        
-        # 実績チャンネルに送信
-        if ACHIEVEMENT_CHANNEL_ID:
-            achievement_channel = bot.get_channel(ACHIEVEMENT_CHANNEL_ID)
-            if achievement_channel:
-                achievement_embed = discord.Embed(
-                    title="🛍️ 購入実績", 
-                    description=f"{interaction.user.mention} が **{item}** を購入しました！", 
-                    color=embed_color
-                )
-                achievement_embed.add_field(name="💰 価格", value=f"{data[self.jihanki_name][item]['price']}円")
-                achievement_embed.add_field(name="📦 残り在庫", value=f"{data[self.jihanki_name][item]['stock']}")
-                await achievement_channel.send(embed=achievement_embed)
-        
-        await interaction.response.send_message("✅ DMに購入情報を送りました。", ephemeral=True)
+        achievement_embed.add_field(name="💰 価格", value=f"{info.price}円")
+        achievement_embed.add_field(name="📦 残り在庫", value=f"{remaining}")
+        queue_achievement(guild, achievement_embed)
 
 class PayPayLinkModal(discord.ui.Modal, title="PayPay決済リンク入力"):
-    paypay_link = discord.ui.TextInput(label="PayPayリンク", placeholder="https://pay.paypay.ne.jp/...")
+    # 承認チャンネルの埋め込み（フィールドは 1024 文字まで）に収まるよう、長いリンクは入力させない
+    paypay_link = discord.ui.TextInput(label="PayPayリンク", placeholder="https://pay.paypay.ne.jp/...", max_length=PAYPAY_LINK_MAX_LENGTH)
     
     def __init__(self, jihanki_name, item):
         super().__init__()
         self.jihanki_name = jihanki_name
         self.item = item
         
+    @timed(HANDLER_SECONDS, handler="paypay_modal")
     async def on_submit(self, interaction: discord.Interaction):
+        # モーダルは商品の選択か /buy で制限を通ったときにだけ開くので、ここでは数えない
+        if not first_delivery(interaction):
+            return
+        guild = await guild_data(interaction)
         link = self.paypay_link.value.strip()
         
         if not link.startswith("https://pay.paypay.ne.jp/"):
             await interaction.response.send_message("❌ 有効なPayPayリンクを入力してください。", ephemeral=True)
             return
-            
-        # 承認チャンネルに送信
-        if APPROVAL_CHANNEL_ID:
-            approval_channel = bot.get_channel(APPROVAL_CHANNEL_ID)
-            if approval_channel:
-                data = load_data()
-                embed = discord.Embed(
-                    title="💳 購入承認リクエスト", 
-                    description=f"{interaction.user.mention} が **{self.item}** を購入しようとしています。", 
-                    color=discord.Color.blue()
-                )
-                embed.add_field(name="💰 価格", value=f"{data[self.jihanki_name][self.item]['price']}円")
-                embed.add_field(name="🔗 PayPayリンク", value=link)
-                
-                view = ApprovalView(self.jihanki_name, self.item, interaction.user.id, link)
-                await approval_channel.send(embed=embed, view=view)
-                await interaction.response.send_message("✅ 決済リクエストを送信しました。承認されるまでお待ちください。", ephemeral=True)
-            else:
-                await interaction.response.send_message("❌ 承認チャンネルが見つかりません。管理者に連絡してください。", ephemeral=True)
-        else:
+        
+        # 同じ決済リンクでの二重の申請を断る（承認待ちにできなかったときは忘れて、やり直せるようにする）
+        link_key = ("link", normalize_link(link))
+        if not guild.dedup.claim(link_key):
+            DEDUP_DROPPED.inc(kind="link")
+            await interaction.response.send_message("❌ このPayPayリンクはすでに送信されています。", ephemeral=True)
+            return
+        
+        try:
+            request = await self.request_approval(interaction, guild, link)
+        except Exception:
+            guild.dedup.release(link_key)
+            if not interaction.response.is_done():
+                await interaction.response.send_message("❌ 決済リクエストを送信できませんでした。もう一度お試しください。", ephemeral=True)
+            raise
+        if request is None:
+            guild.dedup.release(link_key)
+            return
+        approval_id, approval_channel, embed = request
+        approvals = guild.approvals
+        
+        await interaction.response.send_message("✅ 決済リクエストを送信しました。承認されるまでお待ちください。", ephemeral=True)
+        schedule_refresh(guild, self.jihanki_name)
+        
+        # 承認チャンネルへの投稿は応答の後で行う
+        async def post():
+            message = await approval_channel.send(embed=embed, view=ApprovalView(approval_id))
+            approvals.set_message(approval_id, approval_channel.id, message.id)
+        deliveries.submit("approval_request", post, route=("channel", approval_channel.id), approval_id=approval_id, embed=embed.to_dict())
+    
+    async def request_approval(self, interaction, guild, link):
+        # 在庫を確保して承認待ちに加え、(承認 ID, 承認チャンネル, 埋め込み) を返す
+        # 加えられないときは理由を応答して None を返す
+        if not guild.approval_channel_id:
             await interaction.response.send_message("❌ 承認チャンネルが設定されていません。管理者に連絡してください。", ephemeral=True)
+            return None
+        approval_channel = await handles.channel(guild.approval_channel_id)
+        if not approval_channel:
+            await interaction.response.send_message("❌ 承認チャンネルが見つかりません。管理者に連絡してください。", ephemeral=True)
+            return None
+        
+        # モーダルを開いている間に商品が削除されていることがある
+        info = guild.store.get_item(self.jihanki_name, self.item)
+        if info is None:
+            await interaction.response.send_message("❌ 商品情報が見つかりません。", ephemeral=True)
+            return None
+        embed = discord.Embed(
+            title="💳 購入承認リクエスト", 
+            description=f"{interaction.user.mention} が **{self.item}** を購入しようとしています。", 
+            color=discord.Color.blue()
+        )
+        embed.add_field(name="💰 価格", value=f"{info.price}円")
+        embed.add_field(name="🔗 PayPayリンク", value=shorten(link, 1024))
+        
+        # 承認されるまで在庫を 1 つ確保しておく（同じ最後の 1 個に複数の決済が来ないように）
+        if not await guild.store.reserve(self.jihanki_name, self.item):
+            await interaction.response.send_message("❌ 在庫切れです。", ephemeral=True)
+            return None
+        
+        # 承認待ちとして保存し、再起動後もボタンが使えるようにする
+        approval_id = guild.approvals.add(self.jihanki_name, self.item, interaction.user.id, link, RESERVATION_TTL)
+        return approval_id, approval_channel, embed
+
+class ApproveButton(discord.ui.DynamicItem[discord.ui.Button], template=r"jihanki:approve:(?P<id>[0-9]+)"):
+    def __init__(self, approval_id):
+        super().__init__(discord.ui.Button(label="✅ 承認", style=discord.ButtonStyle.success, custom_id=f"jihanki:approve:{approval_id}"))
+        self.approval_id = approval_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["id"])
+
+    async def callback(self, interaction: discord.Interaction):
+        await ApprovalView(self.approval_id).approve(interaction)
+
+class DenyButton(discord.ui.DynamicItem[discord.ui.Button], template=r"jihanki:deny:(?P<id>[0-9]+)"):
+    def __init__(self, approval_id):
+        super().__init__(discord.ui.Button(label="❌ 拒否", style=discord.ButtonStyle.danger, custom_id=f"jihanki:deny:{approval_id}"))
+        self.approval_id = approval_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["id"])
+
+    async def callback(self, interaction: discord.Interaction):
+        await ApprovalView(self.approval_id).deny(interaction)
 
 class ApprovalView(discord.ui.View):
-    def __init__(self, jihanki_name, item, user_id, paypay_link):
+    def __init__(self, approval_id, disabled=False):
         super().__init__(timeout=None)
-        self.jihanki_name = jihanki_name
-        self.item = item
-        self.user_id = user_id
-        self.paypay_link = paypay_link
-        
-    @discord.ui.button(label="✅ 承認", style=discord.ButtonStyle.success)
-    async def approve(self, interaction: discord.Interaction, button: discord.ui.Button):
-        data = load_data()
-        data[self.jihanki_name][self.item]["stock"] -= 1
-        save_data(data)
+        self.approval_id = approval_id
+        self.add_item(ApproveButton(approval_id))
+        self.add_item(DenyButton(approval_id))
         
-        # 自販機メッセージを更新
-        await update_jihanki_messages(self.jihanki_name)
+        # ボタンを無効化
+        if disabled:
+            for child in self.children:
+                child.disabled = True
         
-        user = await bot.fetch_user(self.user_id)
+    @timed(HANDLER_SECONDS, handler="approve")
+    async def approve(self, interaction: discord.Interaction):
+        if not first_delivery(interaction):
+            return
+        guild = await guild_data(interaction)
+        store = guild.store
         
-        # 価格に応じた色を設定
-        if data[self.jihanki_name][self.item]['price'] == 0:
-            embed_color = discord.Color.green()
-        elif data[self.jihanki_name][self.item]['price'] < 500:
-            embed_color = discord.Color.blue()
-        elif data[self.jihanki_name][self.item]['price'] < 1000:
-            embed_color = discord.Color.gold()
-        else:
-            embed_color = discord.Color.purple()
+        # 先に取り出して処理済みにする（同時に押されても一度しか処理しない）
+        entry = claim_approval(guild, self.approval_id)
+        if entry is None:
+            await interaction.response.send_message("❌ このリクエストは処理済みです。", ephemeral=True)
+            return
+        jihanki_name, item, user_id = entry["jihanki"], entry["item"], entry["user_id"]
         
-        # DMに送信
-        embed = discord.Embed(
-            title="🎉 購入完了", 
-            description=f"**{self.item}** を購入しました！", 
-            color=embed_color
+        remaining = await store.decrement_stock(
+            jihanki_name, item, reason="approve", held=True,
+            user_id=user_id, approver_id=interaction.user.id
         )
-        embed.add_field(name="💰 価格", value=f"{data[self.jihanki_name][self.item]['price']}円")
-        embed.add_field(name="📦 残り在庫", value=f"{data[self.jihanki_name][self.item]['stock']}")
-        
-        # DMに送信する商品情報があれば追加
-        if "dm_content" in data[self.jihanki_name][self.item] and data[self.jihanki_name][self.item]["dm_content"]:
-            embed.add_field(name="📝 商品情報", value=data[self.jihanki_name][self.item]["dm_content"], inline=False)
-        
-        # フッターに購入日時を追加
-        embed.set_footer(text=f"購入日時: {discord.utils.utcnow().strftime('%Y/%m/%d %H:%M:%S')}")
-        
-        await user.send(embed=embed)
-        
-        # 実績チャンネルに送信
-        if ACHIEVEMENT_CHANNEL_ID:
-            achievement_channel = bot.get_channel(ACHIEVEMENT_CHANNEL_ID)
-            if achievement_channel:
-                achievement_embed = discord.Embed(
-                    title="🛍️ 購入実績", 
-                    description=f"<@{self.user_id}> が **{self.item}** を購入しました！", 
-                    color=embed_color
-                )
-                achievement_embed.add_field(name="💰 価格", value=f"{data[self.jihanki_name][self.item]['price']}円")
-                achievement_embed.add_field(name="👤 承認者", value=interaction.user.mention)
-                await achievement_channel.send(embed=achievement_embed)
+        if remaining is None:
+            restore_approval(guild, self.approval_id, entry)
+            await interaction.response.send_message("❌ 在庫切れのため承認できません。", ephemeral=True)
+            return
+        info = store.get_item(jihanki_name, item)
         
-        # ボタンを無効化
-        for child in self.children:
-            child.disabled = True
+        # 先に承認メッセージを更新し、DM と実績投稿は配送キューから送る
+        await interaction.response.edit_message(content="✅ 購入が承認されました", view=ApprovalView(self.approval_id, disabled=True))
         
-        await interaction.response.edit_message(content="✅ 購入が承認されました", view=self)
+        # 自販機メッセージを更新
+        schedule_refresh(guild, jihanki_name)
         
-    @discord.ui.button(label="❌ 拒否", style=discord.ButtonStyle.danger)
-    async def deny(self, interaction: discord.Interaction, button: discord.ui.Button):
-        user = await bot.fetch_user(self.user_id)
-        await user.send(f"❌ **{self.item}** の購入が拒否されました。")
+        notify_approved(guild, entry, info, remaining, interaction.user)
         
-        # ボタンを無効化
-        for child in self.children:
-            child.disabled = True
+    @timed(HANDLER_SECONDS, handler="deny")
+    async def deny(self, interaction: discord.Interaction):
+        if not first_delivery(interaction):
+            return
+        guild = await guild_data(interaction)
+        entry = claim_approval(guild, self.approval_id)
+        if entry is None:
+            await interaction.response.send_message("❌ このリクエストは処理済みです。", ephemeral=True)
+            return
+        
+        await interaction.response.edit_message(content="❌ 購入が拒否されました", view=ApprovalView(self.approval_id, disabled=True))
+        
+        # 確保していた在庫を戻す
+        guild.store.release(entry["jihanki"], entry["item"])
+        schedule_refresh(guild, entry["jihanki"])
         
-        await interaction.response.edit_message(content="❌ 購入が拒否されました", view=self)
+        queue_dm(entry["user_id"], content=f"❌ **{entry['item']}** の購入が拒否されました。")
 
-class PurchaseButton(discord.ui.View):
-    def __init__(self, jihanki_name):
-        super().__init__(timeout=None)
+# 承認された購入の DM と実績投稿（単発の承認と一括承認で共通）
+def notify_approved(guild, entry, info, remaining, approver):
+    item, user_id = entry["item"], entry["user_id"]
+    guild.stats.record(entry["jihanki"], item, user_id, info.price)
+    
+    # 価格に応じた色を設定
+    if info.price == 0:
+        embed_color = discord.Color.green()
+    elif info.price < 500:
+        embed_color = discord.Color.blue()
+    elif info.price < 1000:
+        embed_color = discord.Color.gold()
+    else:
+        embed_color = discord.Color.purple()
+    
+    # DMに送信
+    embed = discord.Embed(
+        title="🎉 購入完了", 
+        description=f"**{item}** を購入しました！", 
+        color=embed_color
+    )
+    embed.add_field(name="💰 価格", value=f"{info.price}円")
+    embed.add_field(name="📦 残り在庫", value=f"{remaining}")
+    
+    # DMに送信する商品情報があれば追加
+    if info.dm_content:
+        embed.add_field(name="📝 商品情報", value=info.dm_content, inline=False)
+    
+    # フッターに購入日時を追加
+    embed.set_footer(text=f"購入日時: {discord.utils.utcnow().strftime('%Y/%m/%d %H:%M:%S')}")
+    
+    queue_dm(user_id, embed=embed)
+    
+    # 実績チャンネルに送信
+    if guild.achievement_channel_id:
+        achievement_embed = discord.Embed(
+            title="🛍️ 購入実績", 
+            description=f"<@{user_id}> が **{item}** を購入しました！", 
+            color=embed_color
+        )
+        achievement_embed.add_field(name="💰 価格", value=f"{info.price}円")
+        achievement_embed.add_field(name="👤 承認者", value=approver.mention)
+        queue_achievement(guild, achievement_embed)
+
+def mark_approval_message(approval_id, entry, content):
+    # 一括処理では承認チャンネルのメッセージも処理済み表示にする
+    if not entry.get("message"):
+        return
+    channel_id, message_id = entry["message"]["channel_id"], entry["message"]["message_id"]
+    deliveries.submit(
+        "approval_message",
+        lambda: handles.partial_message(channel_id, message_id).edit(content=content, view=ApprovalView(approval_id, disabled=True)),
+        route=("channel", channel_id), approval_id=approval_id
+    )
+
+async def approve_batch(guild, approval_ids, approver):
+    store = guild.store
+    # 取り出した時点で処理済みになるので、他の承認者と同時に操作しても二重に処理しない
+    entries = [(approval_id, claim_approval(guild, approval_id)) for approval_id in approval_ids]
+    entries = [(approval_id, entry) for approval_id, entry in entries if entry is not None]
+    results = await store.decrement_many(
+        [(entry["jihanki"], entry["item"], {"user_id": entry["user_id"], "approver_id": approver.id}) for _, entry in entries],
+        reason="approve", held=True
+    )
+    
+    approved, failed = [], []
+    for (approval_id, entry), remaining in zip(entries, results):
+        if remaining is None:
+            # 在庫切れのものは承認待ちに戻す
+            restore_approval(guild, approval_id, entry)
+            failed.append(approval_id)
+            continue
+        approved.append(approval_id)
+        notify_approved(guild, entry, store.get_item(entry["jihanki"], entry["item"]), remaining, approver)
+        mark_approval_message(approval_id, entry, "✅ 購入が承認されました")
+    
+    # 在庫はまとめて 1 回で保存し、自販機メッセージも自販機ごとに 1 回だけ更新する
+    await store.flush()
+    for jihanki_name in {entry["jihanki"] for approval_id, entry in entries if approval_id in approved}:
+        schedule_refresh(guild, jihanki_name)
+    return approved, failed
+
+def deny_batch(guild, approval_ids):
+    denied = []
+    for approval_id in approval_ids:
+        entry = claim_approval(guild, approval_id)
+        if entry is None:
+            continue
+        denied.append(approval_id)
+        guild.store.release(entry["jihanki"], entry["item"])
+        schedule_refresh(guild, entry["jihanki"])
+        mark_approval_message(approval_id, entry, "❌ 購入が拒否されました")
+        queue_dm(entry["user_id"], content=f"❌ **{entry['item']}** の購入が拒否されました。")
+    return denied
+
+async def sweep_reservations():
+    # 期限までに承認されなかったリクエストを取り消し、確保していた在庫を戻す
+    # 読み込まれていないサーバーの分は、次に読み込まれたときに取り消される
+    # 他のプロセスが受け持つサーバーの承認待ちは、そのプロセスが取り消す
+    while True:
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL)
+        for guild in guilds.loaded():
+            if not serves(guild.id):
+                continue
+            for approval_id in guild.approvals.expired(time.time(), RESERVATION_TTL):
+                entry = claim_approval(guild, approval_id)
+                if entry is None:
+                    continue
+                guild.store.release(entry["jihanki"], entry["item"])
+                schedule_refresh(guild, entry["jihanki"])
+                mark_approval_message(approval_id, entry, "⌛ 期限切れのため取り消されました")
+                queue_dm(entry["user_id"], content=f"⌛ **{entry['item']}** の購入リクエストは期限までに承認されなかったため取り消されました。")
+
+class PurchaseMenu(discord.ui.View):
+    def __init__(self, guild, jihanki_name, page=0, options=None):
+        super().__init__()
         self.jihanki_name = jihanki_name
-        self.add_item(discord.ui.Button(label="🛒 購入する", style=discord.ButtonStyle.primary, custom_id=f"purchase_{jihanki_name}"))
+        self.add_item(SelectItemToPurchase(guild, jihanki_name, page, options))
         
+        # 検索結果の表示中はページ送りしない
+        page_count = len(guild.render_cache.option_pages(jihanki_name))
+        if options is None:
+            add_page_buttons(self, page, page_count, self.goto)
+        if page_count > 1:
+            self.add_item(SearchButton(jihanki_name, lambda guild, options: PurchaseMenu(guild, jihanki_name, options=options)))
+
+    async def goto(self, interaction, page):
+        await interaction.response.edit_message(view=PurchaseMenu(await guild_data(interaction), self.jihanki_name, page))
+
+async def open_purchase_menu(interaction, jihanki_name):
+    guild = await guild_data(interaction)
+    
+    # データの存在確認
+    if jihanki_name is None or not guild.store.has_machine(jihanki_name):
+        await interaction.response.send_message("❌ この自販機は存在しません。", ephemeral=True)
+        return
+        
+    await interaction.response.send_message("🛒 購入する商品を選んでください：", view=PurchaseMenu(guild, jihanki_name), ephemeral=True)
+
+# 全自販機で共通の購入ボタン。custom_id から自販機を引くので再起動後もそのまま動く
+class PurchaseButton(discord.ui.DynamicItem[discord.ui.Button], template=r"jihanki:buy:(?P<key>[0-9a-f]+)"):
+    def __init__(self, jihanki_name):
+        super().__init__(discord.ui.Button(label="🛒 購入する", style=discord.ButtonStyle.primary, custom_id=f"jihanki:buy:{machine_key(jihanki_name)}"))
+        self.jihanki_name = jihanki_name
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls((await guild_data(interaction)).store.machine_by_key(match["key"]) or "")
+
     async def interaction_check(self, interaction: discord.Interaction):
-        custom_id = interaction.data.get("custom_id", "")
-        if custom_id.startswith("purchase_"):
-            jihanki_name = custom_id.split("_")[1]
-            
-            # データの存在確認
-            data = load_data()
-            if jihanki_name not in data:
-                await interaction.response.send_message("❌ この自販機は存在しません。", ephemeral=True)
-                return True
-                
-            view = discord.ui.View()
-            view.add_item(SelectItemToPurchase(jihanki_name))
-            await interaction.response.send_message("🛒 購入する商品を選んでください：", view=view, ephemeral=True)
-        return True
+        return not await throttled(interaction, self.jihanki_name, "purchase_button")
+
+    async def callback(self, interaction: discord.Interaction):
+        await open_purchase_menu(interaction, self.jihanki_name or None)
+
+# 以前の形式 (purchase_自販機名) で送信済みのメッセージ用
+class LegacyPurchaseButton(discord.ui.DynamicItem[discord.ui.Button], template=r"purchase_(?P<name>.+)"):
+    def __init__(self, jihanki_name):
+        super().__init__(discord.ui.Button(label="🛒 購入する", style=discord.ButtonStyle.primary, custom_id=f"purchase_{jihanki_name}"))
+        self.jihanki_name = jihanki_name
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["name"])
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return not await throttled(interaction, self.jihanki_name, "purchase_button")
+
+    async def callback(self, interaction: discord.Interaction):
+        await open_purchase_menu(interaction, self.jihanki_name)
+
+# 商品が 1 ページに収まらない自販機の一覧表示ボタン
+class CatalogButton(discord.ui.DynamicItem[discord.ui.Button], template=r"jihanki:catalog:(?P<key>[0-9a-f]+)"):
+    def __init__(self, jihanki_name):
+        super().__init__(discord.ui.Button(label="📄 全商品を見る", style=discord.ButtonStyle.secondary, custom_id=f"jihanki:catalog:{machine_key(jihanki_name)}"))
+        self.jihanki_name = jihanki_name
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls((await guild_data(interaction)).store.machine_by_key(match["key"]) or "")
+
+    async def callback(self, interaction: discord.Interaction):
+        guild = await guild_data(interaction)
+        if not guild.store.has_machine(self.jihanki_name):
+            await interaction.response.send_message("❌ この自販機は存在しません。", ephemeral=True)
+            return
+        await interaction.response.send_message(embed=guild.render_cache.embed(self.jihanki_name), view=CatalogView(guild, self.jihanki_name), ephemeral=True)
+
+class CatalogView(discord.ui.View):
+    def __init__(self, guild, jihanki_name, page=0):
+        super().__init__()
+        self.jihanki_name = jihanki_name
+        add_page_buttons(self, page, len(guild.render_cache.embed_pages(jihanki_name)), self.goto)
+
+    async def goto(self, interaction, page):
+        guild = await guild_data(interaction)
+        await interaction.response.edit_message(embed=guild.render_cache.embed(self.jihanki_name, page), view=CatalogView(guild, self.jihanki_name, page))
+
+def purchase_view(guild, jihanki_name):
+    view = discord.ui.View(timeout=None)
+    view.add_item(PurchaseButton(jihanki_name))
+    if len(guild.render_cache.embed_pages(jihanki_name)) > 1:
+        view.add_item(CatalogButton(jihanki_name))
+    return view
 
 class AddJihankiModal(discord.ui.Modal, title="自販機追加"):
     name = discord.ui.TextInput(label="自販機名", placeholder="例: 飲料自販機")
 
+    @timed(HANDLER_SECONDS, handler="add_jihanki_modal")
     async def on_submit(self, interaction: discord.Interaction):
-        data = load_data()
         name = self.name.value.strip()
         if not name:
             await interaction.response.send_message("❌ 名前を入力してください。", ephemeral=True)
             return
-        if name in data:
+        if not (await guild_data(interaction)).store.add_machine(name):
             await interaction.response.send_message("❌ 既に存在します。", ephemeral=True)
         else:
-            data[name] = {}
-            save_data(data)
             await interaction.response.send_message(f"✅ '{name}' を追加しました！", ephemeral=True)
 
 class AddItemModal(discord.ui.Modal, title="商品追加"):
@@ -406,8 +918,8 @@ class AddItemModal(discord.ui.Modal, title="商品追加"):
         super().__init__()
         self.jihanki_name = jihanki_name
 
+    @timed(HANDLER_SECONDS, handler="add_item_modal")
     async def on_submit(self, interaction: discord.Interaction):
-        data = load_data()
         item = self.name.value.strip()
         if not item:
             await interaction.response.send_message("❌ 商品名を入力してください。", ephemeral=True)
@@ -422,15 +934,11 @@ class AddItemModal(discord.ui.Modal, title="商品追加"):
         # DMに送信する商品情報を追加
         dm_content = self.dm_content.value.strip() if self.dm_content.value else ""
         
-        data[self.jihanki_name][item] = {
-            "stock": stock, 
-            "price": price,
-            "dm_content": dm_content
-        }
-        save_data(data)
+        guild = await guild_data(interaction)
+        guild.store.set_item(self.jihanki_name, item, stock, price, dm_content)
         
         # 自販機メッセージを更新
-        await update_jihanki_messages(self.jihanki_name)
+        schedule_refresh(guild, self.jihanki_name)
         
         await interaction.response.send_message(f"✅ '{item}' を '{self.jihanki_name}' に追加しました。", ephemeral=True)
 
@@ -442,90 +950,60 @@ class ChangeStockModal(discord.ui.Modal, title="在庫変更"):
         self.jihanki = jihanki
         self.item = item
 
+    @timed(HANDLER_SECONDS, handler="change_stock_modal")
     async def on_submit(self, interaction: discord.Interaction):
         try:
             new_stock = int(self.stock.value)
         except ValueError:
             await interaction.response.send_message("❌ 有効な数値を入力してください。", ephemeral=True)
             return
-        data = load_data()
-        data[self.jihanki][self.item]["stock"] = new_stock
-        save_data(data)
+        guild = await guild_data(interaction)
+        guild.store.set_stock(self.jihanki, self.item, new_stock, user_id=interaction.user.id)
         
         # 自販機メッセージを更新
-        await update_jihanki_messages(self.jihanki)
+        schedule_refresh(guild, self.jihanki)
         
         await interaction.response.send_message(f"✅ '{self.item}' の在庫を {new_stock} に更新しました。", ephemeral=True)
 
 class SelectItem(discord.ui.View):
-    def __init__(self, jihanki, action):
+    def __init__(self, guild, jihanki, action, page=0, options=None):
         super().__init__()
         self.jihanki = jihanki
         self.action = action
-        data = load_data()
         
-        # 商品ごとに在庫状況に応じた絵文字を追加
-        options = []
-        
-        if jihanki in data:
-            for item, info in data[jihanki].items():
-                # message_idsキーはスキップ
-                if item == "message_ids":
-                    continue
-                    
-                # 辞書かどうか確認し、必要なキーが存在するか確認
-                if isinstance(info, dict) and "stock" in info and "price" in info:
-                    # 在庫状況に応じた絵文字を設定
-                    if info['stock'] <= 0:
-                        emoji = "❌"
-                        description = f"在庫切れ | {info['price']}円"
-                    elif info['stock'] < 5:
-                        emoji = "⚠️"
-                        description = f"残り{info['stock']}個 | {info['price']}円"
-                    else:
-                        emoji = "✅"
-                        description = f"在庫あり ({info['stock']}個) | {info['price']}円"
-                        
-                    options.append(
-                        discord.SelectOption(
-                            label=item,
-                            value=item,
-                            description=description,
-                            emoji=emoji
-                        )
-                    )
-        
-        # オプションが空の場合はダミーオプションを追加
-        if not options:
-            options.append(
-                discord.SelectOption(
-                    label="商品がありません",
-                    value="no_items",
-                    description="この自販機には商品がありません",
-                    emoji="❌"
-                )
-            )
+        if options is None:
+            options = guild.render_cache.options(jihanki, page)
+            add_page_buttons(self, page, len(guild.render_cache.option_pages(jihanki)), self.goto)
             
         select = discord.ui.Select(
             placeholder="商品を選んでください",
             options=options,
             min_values=1,
-            max_values=1
+            max_values=1,
+            row=0
         )
         select.callback = self.item_callback
         self.add_item(select)
+        
+        if len(guild.render_cache.option_pages(jihanki)) > 1:
+            self.add_item(SearchButton(jihanki, lambda guild, options: SelectItem(guild, jihanki, action, options=options)))
+
+    async def goto(self, interaction, page):
+        await interaction.response.edit_message(view=SelectItem(await guild_data(interaction), self.jihanki, self.action, page))
 
     async def item_callback(self, interaction: discord.Interaction):
         item = interaction.data['values'][0]
-        data = load_data()
+        
+        if item == "no_items":
+            await interaction.response.send_message("❌ この自販機には商品がありません。", ephemeral=True)
+            return
 
         if self.action == "remove":
-            if item in data[self.jihanki]:
-                del data[self.jihanki][item]
-                save_data(data)
+            guild = await guild_data(interaction)
+            if guild.store.remove_item(self.jihanki, item):
                 
                 # 自販機メッセージを更新
-                await update_jihanki_messages(self.jihanki)
+                schedule_refresh(guild, self.jihanki)
                 
                 await interaction.response.send_message(f"🗑 '{item}' を削除しました。", ephemeral=True)
             else:
@@ -544,84 +1022,145 @@ class ChannelSelector(discord.ui.View):
 
     async def select_channel(self, interaction: discord.Interaction):
         channel_id = interaction.data['values'][0]
-        channel = await bot.fetch_channel(int(channel_id))
+        channel = handles.messageable(int(channel_id))
         
         # 自販機メッセージを送信し、メッセージIDを保存
-        message = await channel.send(embed=self.build_embed(), view=PurchaseButton(self.jihanki))
+        guild = await guild_data(interaction)
+        message = await channel.send(embed=guild.render_cache.embed(self.jihanki), view=purchase_view(guild, self.jihanki))
         
-        # メッセージIDを保存
-        data = load_data()
-        if "message_ids" not in data[self.jihanki]:
-            data[self.jihanki]["message_ids"] = []
-        
-        data[self.jihanki]["message_ids"].append({
-            "channel_id": channel.id,
-            "message_id": message.id
-        })
-        save_data(data)
+        # 送信している間にサーバーデータが閉じられていることがあるので引き直してから保存する
+        (await guild_data(interaction)).store.add_message(self.jihanki, channel.id, message.id)
         
         await interaction.response.send_message("✅ 自販機を送信しました。在庫変更時に自動更新されます。", ephemeral=True)
 
-    def build_embed(self):
-        data = load_data()[self.jihanki]
-        embed = discord.Embed(
-            title=f"🏪 {self.jihanki}",
-            description="下のボタンから商品を購入できます",
-            color=discord.Color.blue()
-        )
-        
-        # 商品情報を価格順にソート
-        items = []
-        for item, info in data.items():
-            if isinstance(info, dict) and "price" in info:
-                items.append((item, info))
-        
-        # 価格順に並べ替え
-        items.sort(key=lambda x: x[1]["price"])
-        
-        # 商品を下に表示
-        for item, info in items:
-            # 在庫状況に応じた絵文字
-            if info['stock'] <= 0:
-                stock_status = "❌ 在庫切れ"
-            elif info['stock'] < 5:
-                stock_status = f"⚠️ 残り{info['stock']}個"
-            else:
-                stock_status = f"✅ 在庫あり ({info['stock']}個)"
-                
-            # 価格表示
-            if info['price'] == 0:
-                price_display = "🆓 無料"
-            else:
-                price_display = f"💰 {info['price']}円"
-                
-            embed.add_field(
-                name=item,
-                value=f"{price_display}\n{stock_status}",
-                inline=True
-            )
-            
-        embed.set_footer(text=f"最終更新: {discord.utils.utcnow().strftime('%Y/%m/%d %H:%M:%S')}")
-        return embed
-
 class SelectJihanki(discord.ui.Select):
-    def __init__(self, action):
+    def __init__(self, guild, action, page=0):
         self.action = action
-        data = load_data()
-        options = [discord.SelectOption(label=name, emoji="🏪") for name in data.keys()]
-        super().__init__(placeholder="自販機を選んでください", options=options)
+        options = guild.render_cache.machine_options(page)
+        super().__init__(placeholder="自販機を選んでください", options=options, row=0)
 
     async def callback(self, interaction: discord.Interaction):
         jihanki = self.values[0]
+        if jihanki == "no_jihanki":
+            await interaction.response.send_message("❌ 自販機がありません。", ephemeral=True)
+            return
         if self.action == "add_item":
             await interaction.response.send_modal(AddItemModal(jihanki))
         elif self.action == "remove_item":
-            await interaction.response.edit_message(view=SelectItem(jihanki, "remove"), content=f"🗑 '{jihanki}' の商品を選んでください")
+            await interaction.response.edit_message(view=SelectItem(await guild_data(interaction), jihanki, "remove"), content=f"🗑 '{jihanki}' の商品を選んでください")
         elif self.action == "change_stock":
-            await interaction.response.edit_message(view=SelectItem(jihanki, "stock"), content=f"📦 '{jihanki}' の商品を選んでください")
+            await interaction.response.edit_message(view=SelectItem(await guild_data(interaction), jihanki, "stock"), content=f"📦 '{jihanki}' の商品を選んでください")
         elif self.action == "send_embed":
             await interaction.response.edit_message(view=ChannelSelector(jihanki), content="📤 送信先チャンネルを選んでください")
 
+class JihankiPicker(discord.ui.View):
+    def __init__(self, guild, action, page=0):
+        super().__init__()
+        self.action = action
+        self.add_item(SelectJihanki(guild, action, page))
+        add_page_buttons(self, page, len(guild.render_cache.machine_option_pages()), self.goto)
+
+    async def goto(self, interaction, page):
+        await interaction.response.edit_message(view=JihankiPicker(await guild_data(interaction), self.action, page))
+
+APPROVALS_PER_PAGE = 20
+# 一覧では決済リンクをこの文字数までにして、1 ページ分が埋め込みの説明（4096 文字）に収まるようにする
+APPROVAL_LINK_PREVIEW = 100
+
+# 承認待ちの一覧から複数選んでまとめて承認・拒否する
+class ApprovalDashboard(discord.ui.View):
+    def __init__(self, guild, page=0):
+        super().__init__()
+        approvals = guild.approvals
+        ids = approvals.sorted_ids()
+        self.page_count = max(1, (len(ids) + APPROVALS_PER_PAGE - 1) // APPROVALS_PER_PAGE)
+        self.page = max(0, min(page, self.page_count - 1))
+        self.ids = ids[self.page * APPROVALS_PER_PAGE:(self.page + 1) * APPROVALS_PER_PAGE]
+        self.selected = []
+        
+        if self.ids:
+            options = []
+            for approval_id in self.ids:
+                entry = approvals.get(approval_id)
+                options.append(discord.SelectOption(
+                    label=f"#{approval_id} {entry['item']}"[:100],
+                    value=approval_id,
+                    description=f"{entry['jihanki']} / <@{entry['user_id']}>"[:100]
+                ))
+            select = discord.ui.Select(placeholder="処理するリクエストを選んでください", options=options, min_values=1, max_values=len(options), row=0)
+            select.callback = self.select_callback
+            self.add_item(select)
+            
+            approve_button = discord.ui.Button(label="✅ まとめて承認", style=discord.ButtonStyle.success, row=2)
+            approve_button.callback = self.approve_selected
+            self.add_item(approve_button)
+            deny_button = discord.ui.Button(label="❌ まとめて拒否", style=discord.ButtonStyle.danger, row=2)
+            deny_button.callback = self.deny_selected
+            self.add_item(deny_button)
+        
+        add_page_buttons(self, self.page, self.page_count, self.goto)
+
+    def build_embed(self, guild):
+        approvals = guild.approvals
+        embed = discord.Embed(
+            title="💳 承認待ちリクエスト",
+            description=f"{len(approvals.pending)} 件",
+            color=discord.Color.blue()
+        )
+        lines = []
+        for approval_id in self.ids:
+            entry = approvals.get(approval_id)
+            info = guild.store.get_item(entry["jihanki"], entry["item"])
+            price = f"{info.price}円" if info else "商品なし"
+            lines.append(f"**#{approval_id}** <@{entry['user_id']}> {entry['item']} ({entry['jihanki']}) {price}\n{shorten(entry['paypay_link'], APPROVAL_LINK_PREVIEW)}")
+        if lines:
+            # 商品名が長いなどで収まらない分は件数だけ出す（選択メニューからは処理できる）
+            description = embed.description + "\n"
+            for index, line in enumerate(lines):
+                # 最後の行でなければ「ほか N 件」の分も空けておく
+                reserve = len(f"\n…ほか {len(lines)} 件") if index < len(lines) - 1 else 0
+                if len(description) + 1 + len(line) + reserve > 4096:
+                    description += f"\n…ほか {len(lines) - index} 件"
+                    break
+                description += "\n" + line
+            embed.description = description
+        if self.page_count > 1:
+            embed.set_footer(text=f"ページ {self.page + 1}/{self.page_count}")
+        return embed
+
+    async def goto(self, interaction, page):
+        guild = await guild_data(interaction)
+        view = ApprovalDashboard(guild, page)
+        await interaction.response.edit_message(embed=view.build_embed(guild), view=view)
+
+    async def select_callback(self, interaction: discord.Interaction):
+        self.selected = interaction.data["values"]
+        await interaction.response.defer()
+
+    @timed(HANDLER_SECONDS, handler="approve_batch")
+    async def approve_selected(self, interaction: discord.Interaction):
+        if not self.selected:
+            await interaction.response.send_message("❌ リクエストを選んでください。", ephemeral=True)
+            return
+        await interaction.response.defer()
+        guild = await guild_data(interaction)
+        approved, failed = await approve_batch(guild, self.selected, interaction.user)
+        content = f"✅ {len(approved)} 件を承認しました。"
+        if failed:
+            content += f"\n❌ 在庫切れで承認できなかったもの: {', '.join('#' + i for i in failed)}"
+        view = ApprovalDashboard(guild, self.page)
+        await interaction.edit_original_response(content=content, embed=view.build_embed(guild), view=view)
+
+    @timed(HANDLER_SECONDS, handler="deny_batch")
+    async def deny_selected(self, interaction: discord.Interaction):
+        if not self.selected:
+            await interaction.response.send_message("❌ リクエストを選んでください。", ephemeral=True)
+            return
+        guild = await guild_data(interaction)
+        denied = deny_batch(guild, self.selected)
+        view = ApprovalDashboard(guild, self.page)
+        await interaction.response.edit_message(content=f"❌ {len(denied)} 件を拒否しました。", embed=view.build_embed(guild), view=view)
+
 class ManageView(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=None)
@@ -635,33 +1174,25 @@ class ManageView(discord.ui.View):
         def __init__(self):
             super().__init__(label="🎒 商品追加", style=discord.ButtonStyle.success, row=0)
         async def callback(self, interaction: discord.Interaction):
-            view = discord.ui.View()
-            view.add_item(SelectJihanki("add_item"))
-            await interaction.response.send_message("自販機を選択してください。", view=view, ephemeral=True)
+            await interaction.response.send_message("自販機を選択してください。", view=JihankiPicker(await guild_data(interaction), "add_item"), ephemeral=True)
 
     class RemoveItemButton(discord.ui.Button):
         def __init__(self):
             super().__init__(label="🗑 商品削除", style=discord.ButtonStyle.danger, row=1)
         async def callback(self, interaction: discord.Interaction):
-            view = discord.ui.View()
-            view.add_item(SelectJihanki("remove_item"))
-            await interaction.response.send_message("自販機を選択してください。", view=view, ephemeral=True)
+            await interaction.response.send_message("自販機を選択してください。", view=JihankiPicker(await guild_data(interaction), "remove_item"), ephemeral=True)
 
     class ChangeStockButton(discord.ui.Button):
         def __init__(self):
             super().__init__(label="📦 在庫変更", style=discord.ButtonStyle.secondary, row=1)
         async def callback(self, interaction: discord.Interaction):
-            view = discord.ui.View()
-            view.add_item(SelectJihanki("change_stock"))
-            await interaction.response.send_message("自販機を選択してください。", view=view, ephemeral=True)
+            await interaction.response.send_message("自販機を選択してください。", view=JihankiPicker(await guild_data(interaction), "change_stock"), ephemeral=True)
 
     class SendEmbedButton(discord.ui.Button):
         def __init__(self):
             super().__init__(label="📤 自販機を送信", style=discord.ButtonStyle.primary, row=2)
         async def callback(self, interaction: discord.Interaction):
-            view = discord.ui.View()
-            view.add_item(SelectJihanki("send_embed"))
-            await interaction.response.send_message("自販機を選択してください。", view=view, ephemeral=True)
+            await interaction.response.send_message("自販機を選択してください。", view=JihankiPicker(await guild_data(interaction), "send_embed"), ephemeral=True)
 
     class CreateJihankiButton(discord.ui.Button):
         def __init__(self):
@@ -670,7 +1201,147 @@ class ManageView(discord.ui.View):
             await interaction.response.send_modal(AddJihankiModal())
 
 @bot.tree.command(name="jihanki_manage", description="自販機を管理する")
+@app_commands.guild_only()
 async def jihanki_manage(interaction: discord.Interaction):
     await interaction.response.send_message("🛠 自販機管理パネル", view=ManageView(), ephemeral=True)
 
-bot.run(TOKEN)
+@bot.tree.command(name="jihanki_import", description="CSV / JSON から商品を一括登録・補充する")
+@app_commands.describe(file="machine,item,price,stock,dm_content の列を持つファイル（stock は +10 のように増減も可）")
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+async def jihanki_import(interaction: discord.Interaction, file: discord.Attachment):
+    guild = await guild_data(interaction)
+    store = guild.store
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        rows = bulk.parse(file.filename, await file.read())
+        machines, count = await bulk.apply(store, rows, user_id=interaction.user.id)
+    except bulk.BulkError as e:
+        # 1 件でも問題があれば何も反映しない
+        errors = "\n".join(e.errors[:20])
+        if len(e.errors) > 20:
+            errors += f"\n…ほか {len(e.errors) - 20} 件"
+        await interaction.followup.send(f"❌ 取り込みを中止しました。\n{errors}", ephemeral=True)
+        return
+    
+    # まとめて保存し、自販機メッセージは自販機ごとに 1 回だけ更新する
+    await store.flush()
+    for jihanki_name in machines:
+        schedule_refresh(guild, jihanki_name)
+    
+    await interaction.followup.send(f"✅ {len(machines)} 台の自販機で {count} 個の商品を更新しました。", ephemeral=True)
+
+@bot.tree.command(name="jihanki_export", description="在庫を CSV / JSON で書き出す")
+@app_commands.choices(format=[
+    app_commands.Choice(name="CSV", value="csv"),
+    app_commands.Choice(name="JSON", value="json")
+])
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+async def jihanki_export(interaction: discord.Interaction, format: str = "csv"):
+    data = bulk.export((await guild_data(interaction)).store, format)
+    file = discord.File(io.BytesIO(data), filename=f"jihanki_export.{format}")
+    await interaction.response.send_message("📤 現在の在庫です。", file=file, ephemeral=True)
+
+@bot.tree.command(name="jihanki_approvals", description="承認待ちの購入リクエストをまとめて処理する")
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+async def jihanki_approvals(interaction: discord.Interaction):
+    guild = await guild_data(interaction)
+    view = ApprovalDashboard(guild)
+    await interaction.response.send_message(embed=view.build_embed(guild), view=view, ephemeral=True)
+
+@bot.tree.command(name="jihanki_settings", description="承認チャンネルと実績チャンネルを設定する")
+@app_commands.describe(approval_channel="PayPay 決済の承認リクエストを送るチャンネル", achievement_channel="購入実績を送るチャンネル")
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+async def jihanki_settings(interaction: discord.Interaction, approval_channel: discord.TextChannel = None, achievement_channel: discord.TextChannel = None):
+    guild = await guild_data(interaction)
+    if approval_channel is not None:
+        guild.set_setting("approval_channel_id", approval_channel.id)
+    if achievement_channel is not None:
+        guild.set_setting("achievement_channel_id", achievement_channel.id)
+    
+    def mention(channel_id):
+        return f"<#{channel_id}>" if channel_id else "未設定"
+    await interaction.response.send_message(
+        f"⚙️ 承認チャンネル: {mention(guild.approval_channel_id)}\n🏆 実績チャンネル: {mention(guild.achievement_channel_id)}",
+        ephemeral=True
+    )
+
+@bot.tree.command(name="jihanki_stats", description="売上の集計を表示する")
+@app_commands.describe(jihanki="自販機を指定するとその自販機の集計を表示する")
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+async def jihanki_stats(interaction: discord.Interaction, jihanki: str = None):
+    stats = (await guild_data(interaction)).stats
+    
+    def summary(entry):
+        return f"{entry['count']}個 / {entry['revenue']}円"
+    
+    embed = discord.Embed(
+        title=f"📊 売上集計{f' - {jihanki}' if jihanki else ''}",
+        color=discord.Color.blue()
+    )
+    embed.add_field(name="🧾 累計", value=summary(stats.total(jihanki)))
+    if jihanki is None:
+        embed.add_field(name="📅 今日", value=summary(stats.day()))
+        embed.add_field(name="🕐 過去24時間", value=summary(stats.last_hours(24)))
+    
+    top_items = stats.top_items(jihanki)
+    embed.add_field(
+        name="🏆 売れ筋",
+        value="\n".join(
+            f"{rank}. {item}{'' if jihanki else f' ({name})'} - {summary(entry)}"
+            for rank, (name, item, entry) in enumerate(top_items, start=1)
+        ) or "まだ売上がありません",
+        inline=False
+    )
+    if jihanki is None:
+        embed.add_field(
+            name="👤 購入者",
+            value="\n".join(
+                f"{rank}. <@{user_id}> - {summary(entry)}"
+                for rank, (user_id, entry) in enumerate(stats.top_buyers(), start=1)
+            ) or "まだ売上がありません",
+            inline=False
+        )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@jihanki_stats.autocomplete("jihanki")
+async def jihanki_stats_autocomplete(interaction: discord.Interaction, current: str):
+    names = (await guild_data(interaction)).store.machine_names()
+    return [app_commands.Choice(name=name, value=name) for name in names if current.casefold() in name.casefold()][:25]
+
+@bot.tree.command(name="buy", description="商品を購入する")
+@app_commands.describe(item="購入する商品")
+@app_commands.guild_only()
+async def buy(interaction: discord.Interaction, item: str):
+    guild = await guild_data(interaction)
+    # 候補から選ばれた場合は商品の識別子が渡される
+    entry = guild.store.index.get(item)
+    if entry is None:
+        await interaction.response.send_message("❌ 商品が見つかりません。候補から選んでください。", ephemeral=True)
+        return
+    jihanki_name, item_name = entry
+    if await throttled(interaction, jihanki_name, "buy"):
+        return
+    await start_purchase(interaction, guild, jihanki_name, item_name)
+
+@buy.autocomplete("item")
+async def buy_autocomplete(interaction: discord.Interaction, current: str):
+    store = (await guild_data(interaction)).store
+    choices = []
+    for key, jihanki_name, item in store.index.search(current):
+        info = store.get_item(jihanki_name, item)
+        if info is None:
+            continue
+        available = store.available(jihanki_name, item)
+        stock = "在庫切れ" if available <= 0 else f"在庫{available}"
+        label = f"{item} ({jihanki_name}) - {info.price}円 / {stock}"
+        choices.append(app_commands.Choice(name=label[:100], value=key))
+    return choices
+
+# bench.py などから読み込んだときは起動しない
+if __name__ == "__main__":
+    bot.run(TOKEN)
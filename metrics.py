@@ -0,0 +1,213 @@
+# metrics.py
+# Prometheus のテキスト形式で出す簡易メトリクス（/metrics で公開する）
+import functools
+import logging
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 3.0, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _number(value):
+    if value != value:
+        return "NaN"
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    # 保存処理のスレッドからも値が更新されるのでロックで守る
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for metric in self.metrics:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.lock = registry.lock
+        self.values = {}
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [f"{self.name}{_labels(key)} {_number(value)}" for key, value in self.values.items()]
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.lock = registry.lock
+        self.values = {}
+        self.functions = {}
+        registry.register(self)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, func, **labels):
+        # キューの長さなど、読み出すときに値を取りに行くもの
+        with self.lock:
+            self.functions[tuple(sorted(labels.items()))] = func
+
+    def samples(self):
+        lines = [f"{self.name}{_labels(key)} {_number(value)}" for key, value in self.values.items()]
+        for key, func in self.functions.items():
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f"{self.name}{_labels(key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.lock = registry.lock
+        self.values = {}
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', _number(bound)),))} {bucket_count}")
+            lines.append(f"{self.name}_sum{_labels(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def timed(histogram, **labels):
+    # async 関数の実行時間を記録するデコレーター
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ---- このボットで使うメトリクス ----
+
+HANDLER_SECONDS = Histogram("jihanki_handler_seconds", "インタラクション処理にかかった時間")
+STORAGE_SECONDS = Histogram("jihanki_storage_seconds", "保存先の読み書きにかかった時間")
+STORAGE_BYTES = Counter("jihanki_storage_bytes_total", "保存先に読み書きしたバイト数")
+REST_REQUESTS = Counter("jihanki_rest_requests_total", "Discord REST API の呼び出し回数")
+REST_RATE_LIMITS = Counter("jihanki_rest_rate_limits_total", "Discord REST API で 429 を受けた回数")
+QUEUE_DEPTH = Gauge("jihanki_queue_depth", "キューに溜まっている件数")
+GUILDS_LOADED = Gauge("jihanki_guilds_loaded", "メモリに読み込んでいるサーバーの数")
+GATEWAY_LATENCY = Gauge("jihanki_gateway_latency_seconds", "ゲートウェイの heartbeat の遅延")
+DELIVERY_WAIT_SECONDS = Histogram("jihanki_delivery_wait_seconds", "配送キューで送信を待った時間")
+DELIVERY_DROPPED = Counter("jihanki_delivery_dropped_total", "まとめた・後回しで捨てた配送の数")
+THROTTLED = Counter("jihanki_throttled_total", "連打の制限で断った操作の数")
+DEDUP_DROPPED = Counter("jihanki_dedup_dropped_total", "処理済みとして捨てた重複操作の数")
+
+
+def instrument_http(http):
+    # discord.py の HTTPClient.request を包んで、ルートとステータスごとに数える
+    request = http.request
+
+    @functools.wraps(request)
+    async def wrapper(route, **kwargs):
+        status = "ok"
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            status = str(getattr(e, "status", "error"))
+            raise
+        finally:
+            REST_REQUESTS.inc(method=route.method, route=route.path, status=status)
+    http.request = wrapper
+
+
+class RateLimitHandler(logging.Handler):
+    # discord.py は 429 を内部で待って再送し、ログに警告を出すだけなのでそれを数える
+    # listener は全体のレート制限に当たったときに呼ばれる関数（配送キューが低優先度の送信を控えるのに使う）
+    # ルートごとの 429 は discord.py がそのルートだけ待つので、他の送信は控えない
+    def __init__(self, level=logging.NOTSET, listener=None):
+        super().__init__(level)
+        self.listener = listener
+
+    def emit(self, record):
+        message = record.getMessage()
+        if "429" in message or "rate limit" in message.lower():
+            REST_RATE_LIMITS.inc()
+            if self.listener is not None and "global" in message.lower():
+                self.listener()
+
+
+def install_rate_limit_counter(listener=None):
+    logging.getLogger("discord.http").addHandler(RateLimitHandler(logging.WARNING, listener))
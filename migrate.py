@@ -0,0 +1,26 @@
+# migrate.py
+# 既存の jihanki.json を SQLite データベースに取り込む
+#   python migrate.py [jihanki.json] [jihanki.db]
+import json
+import sys
+
+from storage import SqliteBackend
+
+def main():
+    json_path = sys.argv[1] if len(sys.argv) > 1 else "jihanki.json"
+    db_path = sys.argv[2] if len(sys.argv) > 2 else "jihanki.db"
+
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+
+    backend = SqliteBackend(db_path)
+    try:
+        backend.import_data(data)
+    finally:
+        backend.close()
+
+    items = sum(1 for machine in data.values() for key in machine if key != "message_ids")
+    print(f"✅ {len(data)} 台の自販機と {items} 個の商品を {db_path} に移行しました")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# models.py
+# 在庫データの型。読み込み時に一度だけ検証・変換し、以降は検証なしでそのまま使う
+# ファイルや SQLite には従来どおり {自販機名: {商品名: {...}, "message_ids": [...]}} の形で保存する
+
+
+class Item:
+    __slots__ = ("stock", "price", "dm_content")
+
+    def __init__(self, stock, price, dm_content=""):
+        self.stock = stock
+        self.price = price
+        self.dm_content = dm_content
+
+    def to_dict(self):
+        return {"stock": self.stock, "price": self.price, "dm_content": self.dm_content}
+
+
+class MessageRef:
+    # 自販機を送信したメッセージ
+    __slots__ = ("channel_id", "message_id")
+
+    def __init__(self, channel_id, message_id):
+        self.channel_id = channel_id
+        self.message_id = message_id
+
+    def to_dict(self):
+        return {"channel_id": self.channel_id, "message_id": self.message_id}
+
+
+class Machine:
+    # unparsed は読み込めなかった商品の元の値。使わずに、保存するときにそのまま書き戻す
+    __slots__ = ("name", "items", "messages", "unparsed")
+
+    def __init__(self, name, items=None, messages=None, unparsed=None):
+        self.name = name
+        self.items = items if items is not None else {}
+        self.messages = messages if messages is not None else []
+        self.unparsed = unparsed if unparsed is not None else {}
+
+    def to_dict(self):
+        data = dict(self.unparsed)
+        data.update((item, info.to_dict()) for item, info in self.items.items())
+        if self.messages:
+            data["message_ids"] = [ref.to_dict() for ref in self.messages]
+        return data
+
+
+def _parse_item(info):
+    # 古いデータでは数値が文字列のことや dm_content がないことがある
+    if not isinstance(info, dict) or "stock" not in info or "price" not in info:
+        return None
+    try:
+        stock = int(info["stock"])
+        price = int(info["price"])
+    except (TypeError, ValueError):
+        return None
+    dm_content = info.get("dm_content") or ""
+    return Item(stock, price, str(dm_content))
+
+
+def _parse_messages(refs):
+    messages = []
+    seen = set()
+    for ref in refs if isinstance(refs, list) else []:
+        try:
+            channel_id, message_id = int(ref["channel_id"]), int(ref["message_id"])
+        except (TypeError, KeyError, ValueError):
+            continue
+        if message_id in seen:
+            continue
+        seen.add(message_id)
+        messages.append(MessageRef(channel_id, message_id))
+    return messages
+
+
+def load_machines(data):
+    # 保存形式の辞書から Machine の辞書を作る。読み込めなかった項目の数も返す
+    # 読み込めなかった商品は Machine.unparsed に残し、次の保存で消えないようにする
+    # （値がオブジェクトでない自販機は Machine にできないので、保存先の側で残す）
+    machines = {}
+    skipped = 0
+    for name, raw in data.items():
+        if not isinstance(raw, dict):
+            skipped += 1
+            continue
+        machine = Machine(name, messages=_parse_messages(raw.get("message_ids")))
+        for item, info in raw.items():
+            if item == "message_ids":
+                continue
+            parsed = _parse_item(info)
+            if parsed is None:
+                machine.unparsed[item] = info
+                skipped += 1
+                continue
+            machine.items[item] = parsed
+        machines[name] = machine
+    return machines, skipped
+
+
+def dump_machines(machines):
+    return {name: machine.to_dict() for name, machine in machines.items()}
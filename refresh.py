@@ -0,0 +1,47 @@
+# refresh.py
+import asyncio
+
+
+class RefreshScheduler:
+    # 自販機ごとに更新要求をまとめ、delay 秒以内の連続した変更を 1 回の更新にする
+    def __init__(self, refresh, delay=1.0):
+        self.refresh = refresh
+        self.delay = delay
+        self._tasks = {}
+        self._requested = set()
+
+    @property
+    def pending(self):
+        return len(self._tasks)
+
+    def schedule(self, name):
+        self._requested.add(name)
+        task = self._tasks.get(name)
+        if task is None or task.done():
+            self._tasks[name] = asyncio.get_running_loop().create_task(self._run(name))
+
+    async def _run(self, name):
+        try:
+            # 更新中に来た要求は、更新が終わった後にもう一度まとめて反映する
+            while name in self._requested:
+                await asyncio.sleep(self.delay)
+                self._requested.discard(name)
+                try:
+                    await self.refresh(name)
+                except Exception as e:
+                    print(f"メッセージ更新エラー: {e}")
+        finally:
+            if self._tasks.get(name) is asyncio.current_task():
+                del self._tasks[name]
+
+    async def close(self):
+        # 待ち時間中の要求は捨てずに、待たずにそのまま反映してから止める
+        pending, self._requested = self._requested, set()
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        for key in pending:
+            try:
+                await self.refresh(key)
+            except Exception as e:
+                print(f"メッセージ更新エラー: {e}")
@@ -0,0 +1,168 @@
+# render.py
+import discord
+
+
+# Discord の埋め込みフィールド数・セレクトの選択肢数の上限
+PAGE_SIZE = 25
+
+
+def paginate(entries, size=PAGE_SIZE):
+    return [entries[i:i + size] for i in range(0, len(entries), size)] or [[]]
+
+
+def stock_status(stock, reserved):
+    # 確保中（承認待ち）の分を除いた買える数で表示する
+    available = max(0, stock - reserved)
+    if available <= 0:
+        status = "❌ 在庫切れ"
+    elif available < 5:
+        status = f"⚠️ 残り{available}個"
+    else:
+        status = f"✅ 在庫あり ({available}個)"
+    if reserved:
+        status += f" | 🔒 確保中 {reserved}個"
+    return status
+
+
+def build_embeds(name, items, reserved=None):
+    reserved = reserved or {}
+    # 価格順に並べ替え
+    items = sorted(items, key=lambda x: x[1].price)
+    pages = paginate(items)
+    updated_at = discord.utils.utcnow().strftime('%Y/%m/%d %H:%M:%S')
+    
+    embeds = []
+    for index, page in enumerate(pages):
+        embed = discord.Embed(
+            title=f"🏪 {name}",
+            description="下のボタンから商品を購入できます",
+            color=discord.Color.blue()
+        )
+        
+        # 商品を下に表示
+        for item, info in page:
+            # 在庫状況に応じた絵文字
+            status = stock_status(info.stock, reserved.get(item, 0))
+                
+            # 価格表示
+            if info.price == 0:
+                price_display = "🆓 無料"
+            else:
+                price_display = f"💰 {info.price}円"
+                
+            embed.add_field(
+                name=item,
+                value=f"{price_display}\n{status}",
+                inline=True
+            )
+            
+        footer = f"最終更新: {updated_at}"
+        if len(pages) > 1:
+            footer += f" | ページ {index + 1}/{len(pages)}"
+        embed.set_footer(text=footer)
+        embeds.append(embed)
+    return embeds
+
+
+def build_options(items, reserved=None):
+    reserved = reserved or {}
+    # 商品ごとに在庫状況に応じた絵文字を追加
+    options = []
+    
+    for item, info in items:
+        # 在庫状況に応じた絵文字を設定
+        available = max(0, info.stock - reserved.get(item, 0))
+        if available <= 0:
+            emoji = "❌"
+            description = f"在庫切れ | {info.price}円"
+        elif available < 5:
+            emoji = "⚠️"
+            description = f"残り{available}個 | {info.price}円"
+        else:
+            emoji = "✅"
+            description = f"在庫あり ({available}個) | {info.price}円"
+            
+        options.append(
+            discord.SelectOption(
+                label=item,
+                value=item,
+                description=description,
+                emoji=emoji
+            )
+        )
+    
+    # オプションが空の場合はダミーオプションを追加
+    if not options:
+        options.append(
+            discord.SelectOption(
+                label="商品がありません",
+                value="no_items",
+                description="この自販機には商品がありません",
+                emoji="❌"
+            )
+        )
+    return options
+
+
+def build_machine_options(names):
+    options = [discord.SelectOption(label=name, emoji="🏪") for name in names]
+    if not options:
+        options.append(
+            discord.SelectOption(
+                label="自販機がありません",
+                value="no_jihanki",
+                description="先に自販機を作成してください",
+                emoji="❌"
+            )
+        )
+    return options
+
+
+class RenderCache:
+    # 自販機のバージョンが変わらない限り、作成済みの埋め込みと選択肢をページ単位で使い回す
+    def __init__(self, store):
+        self.store = store
+        self._embeds = {}
+        self._options = {}
+        self._machine_options = None
+
+    def embed_pages(self, name):
+        version = self.store.version(name)
+        cached = self._embeds.get(name)
+        if cached is None or cached[0] != version:
+            cached = self._embeds[name] = (version, build_embeds(name, self.store.items(name), self.store.reserved_counts(name)))
+        return cached[1]
+
+    def embed(self, name, page=0):
+        pages = self.embed_pages(name)
+        return pages[max(0, min(page, len(pages) - 1))]
+
+    def option_pages(self, name):
+        version = self.store.version(name)
+        cached = self._options.get(name)
+        if cached is None or cached[0] != version:
+            options = build_options(self.store.items(name), self.store.reserved_counts(name))
+            cached = self._options[name] = (version, options, paginate(options))
+        return cached[2]
+
+    def options(self, name, page=0):
+        pages = self.option_pages(name)
+        # 呼び出し側で変更されても影響しないようリストはコピーして渡す
+        return list(pages[max(0, min(page, len(pages) - 1))])
+
+    def search_options(self, name, query, limit=PAGE_SIZE):
+        self.option_pages(name)
+        query = query.casefold()
+        matches = [option for option in self._options[name][1]
+                   if option.value != "no_items" and query in option.label.casefold()]
+        return matches[:limit]
+
+    def machine_option_pages(self):
+        version = self.store.machines_version
+        if self._machine_options is None or self._machine_options[0] != version:
+            self._machine_options = (version, paginate(build_machine_options(self.store.machine_names())))
+        return self._machine_options[1]
+
+    def machine_options(self, page=0):
+        pages = self.machine_option_pages()
+        return list(pages[max(0, min(page, len(pages) - 1))])
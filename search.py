@@ -0,0 +1,89 @@
+# search.py
+import hashlib
+
+from store import machine_key
+
+
+def item_key(jihanki_name, item):
+    # オートコンプリートの value（100 文字まで）に収まる商品の識別子
+    return f"{machine_key(jihanki_name)}:{hashlib.sha1(item.encode('utf-8')).hexdigest()[:16]}"
+
+
+def grams(text):
+    # 1 文字と 2 文字の部分文字列（日本語の商品名も単語区切りなしで引けるようにする）
+    result = set(text)
+    result.update(text[i:i + 2] for i in range(len(text) - 1))
+    return result
+
+
+class ItemIndex:
+    # 全自販機の商品名を n-gram で引く索引。商品の追加・削除のたびに差分だけ更新する
+    def __init__(self):
+        self._entries = {}
+        self._grams = {}
+
+    def rebuild(self, store):
+        self._entries.clear()
+        self._grams.clear()
+        for jihanki_name in store.machine_names():
+            for item, _ in store.items(jihanki_name):
+                self.add(jihanki_name, item)
+
+    def add(self, jihanki_name, item):
+        key = item_key(jihanki_name, item)
+        if key in self._entries:
+            return
+        folded = item.casefold()
+        self._entries[key] = (jihanki_name, item, folded)
+        for gram in grams(folded):
+            self._grams.setdefault(gram, set()).add(key)
+
+    def remove(self, jihanki_name, item):
+        key = item_key(jihanki_name, item)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for gram in grams(entry[2]):
+            keys = self._grams.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._grams[gram]
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        return None if entry is None else entry[:2]
+
+    def search(self, query, limit=25):
+        query = query.strip().casefold()
+        if not query:
+            keys = list(self._entries)[:limit]
+            return [(key, *self._entries[key][:2]) for key in keys]
+
+        # 2 文字ずつの候補集合を小さい順に絞り込み、最後に部分一致を確認する
+        query_grams = [query[i:i + 2] for i in range(len(query) - 1)] or [query]
+        candidate_sets = []
+        for gram in query_grams:
+            keys = self._grams.get(gram)
+            if not keys:
+                return []
+            candidate_sets.append(keys)
+        candidate_sets.sort(key=len)
+        candidates = set(candidate_sets[0])
+        for keys in candidate_sets[1:]:
+            candidates &= keys
+            if not candidates:
+                return []
+
+        matches = []
+        for key in candidates:
+            jihanki_name, item, folded = self._entries[key]
+            position = folded.find(query)
+            if position >= 0:
+                # 前方一致を優先し、次に名前順
+                matches.append((position != 0, folded, key, jihanki_name, item))
+        matches.sort()
+        return [(key, jihanki_name, item) for _, _, key, jihanki_name, item in matches[:limit]]
+
+    def __len__(self):
+        return len(self._entries)
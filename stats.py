@@ -0,0 +1,98 @@
+# stats.py
+import heapq
+import time
+
+from storage import JsonFile
+
+# 時間別は 2 日分、日別は 90 日分だけ残す
+HOURLY_KEEP = 48
+DAILY_KEEP = 90
+
+
+def _add(rollup, key, price):
+    entry = rollup.get(key)
+    if entry is None:
+        entry = rollup[key] = {"count": 0, "revenue": 0}
+    entry["count"] += 1
+    entry["revenue"] += price
+
+
+class SalesStats:
+    # 購入が確定するたびに更新する売上の集計。/jihanki_stats は集計を読むだけで履歴を数え直さない
+    def __init__(self, path, flush_delay=1.0):
+        self.file = JsonFile(path, {
+            "total": {"count": 0, "revenue": 0},
+            "items": {},
+            "machines": {},
+            "buyers": {},
+            "hourly": {},
+            "daily": {}
+        }, flush_delay=flush_delay)
+
+    def load(self):
+        self.file.load()
+
+    @property
+    def data(self):
+        return self.file.data
+
+    def record(self, jihanki_name, item, user_id, price, now=None):
+        now = time.time() if now is None else now
+        local = time.localtime(now)
+        data = self.data
+        _add(data, "total", price)
+        _add(data["items"].setdefault(jihanki_name, {}), item, price)
+        _add(data["machines"], jihanki_name, price)
+        _add(data["buyers"], str(user_id), price)
+        hour = time.strftime("%Y-%m-%d %H", local)
+        day = time.strftime("%Y-%m-%d", local)
+        # 新しい時間・日の最初の購入のときだけ古い区間を消す
+        if hour not in data["hourly"]:
+            self._trim(data["hourly"], HOURLY_KEEP - 1)
+        if day not in data["daily"]:
+            self._trim(data["daily"], DAILY_KEEP - 1)
+        _add(data["hourly"], hour, price)
+        _add(data["daily"], day, price)
+        self.file.mark_dirty()
+
+    @staticmethod
+    def _trim(buckets, keep):
+        # キーは日時の文字列なので、文字列順がそのまま時間順になる
+        for key in sorted(buckets)[:max(0, len(buckets) - keep)]:
+            del buckets[key]
+
+    def total(self, jihanki_name=None):
+        if jihanki_name is None:
+            return self.data["total"]
+        return self.data["machines"].get(jihanki_name, {"count": 0, "revenue": 0})
+
+    def day(self, now=None):
+        key = time.strftime("%Y-%m-%d", time.localtime(time.time() if now is None else now))
+        return self.data["daily"].get(key, {"count": 0, "revenue": 0})
+
+    def last_hours(self, hours=24, now=None):
+        now = time.time() if now is None else now
+        result = {"count": 0, "revenue": 0}
+        for i in range(hours):
+            entry = self.data["hourly"].get(time.strftime("%Y-%m-%d %H", time.localtime(now - i * 3600)))
+            if entry is not None:
+                result["count"] += entry["count"]
+                result["revenue"] += entry["revenue"]
+        return result
+
+    def top_items(self, jihanki_name=None, limit=5):
+        # (自販機名, 商品名, 集計) を売上個数の多い順に返す
+        machines = self.data["items"]
+        if jihanki_name is not None:
+            machines = {jihanki_name: machines.get(jihanki_name, {})}
+        entries = ((name, item, entry) for name, items in machines.items() for item, entry in items.items())
+        return heapq.nlargest(limit, entries, key=lambda e: (e[2]["count"], e[2]["revenue"]))
+
+    def top_buyers(self, limit=5):
+        return heapq.nlargest(limit, self.data["buyers"].items(), key=lambda e: (e[1]["revenue"], e[1]["count"]))
+
+    async def flush(self):
+        await self.file.flush()
+
+    async def close(self):
+        await self.file.close()
@@ -0,0 +1,417 @@
+# storage.py
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+from metrics import STORAGE_BYTES, STORAGE_SECONDS
+from models import dump_machines, load_machines
+
+
+def atomic_write(path, text):
+    # 一時ファイルに書き込み、fsync してから rename で置き換える（途中で落ちても元ファイルは壊れない）
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # rename 自体もディスクに残るようディレクトリを fsync
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class JsonFile:
+    # 承認待ちなど小さな JSON ファイル用。変更はまとめて遅延保存する
+    def __init__(self, path, default, flush_delay=1.0):
+        self.path = path
+        self.default = default
+        self.flush_delay = flush_delay
+        self.target = os.path.basename(path)
+        self.data = None
+        self._dirty = False
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with STORAGE_SECONDS.time(target=self.target, op="read"):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                self.data = json.loads(text)
+            STORAGE_BYTES.inc(len(text.encode('utf-8')), target=self.target, op="read")
+        else:
+            self.data = json.loads(json.dumps(self.default))
+        return self.data
+
+    def mark_dirty(self):
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+
+    async def flush(self):
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            text = json.dumps(self.data, ensure_ascii=False)
+            try:
+                await asyncio.to_thread(self._write, text)
+            except Exception as e:
+                self._dirty = True
+                print(f"保存エラー ({self.path}): {e}")
+
+    def _write(self, text):
+        with STORAGE_SECONDS.time(target=self.target, op="write"):
+            atomic_write(self.path, text)
+        STORAGE_BYTES.inc(len(text.encode('utf-8')), target=self.target, op="write")
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+
+# バックエンドは次の 4 つを実装する
+#   load()                  -> 自販機名をキーにした辞書（jihanki.json と同じ形）を返す
+#   prepare(data, changes)  -> イベントループ上で呼ばれ、書き込む内容を確定させる（data は 自販機名 -> Machine）
+#   write(payload)          -> スレッド上で呼ばれ、prepare の結果を永続化する
+#   close()
+#
+# 複数のプロセスで共有できるバックエンド（SqliteBackend）は次のものも実装する
+# 承認待ちの確保はプロセスごと（owner）にデータベースへ記録し、どのプロセスの確保も在庫から除いて判定する
+#   take(owner, name, item, amount, held) -> 在庫を条件付きで減らして (成功したか, 現在の在庫, 確保の合計) を返す
+#   reserve(owner, name, item, amount)    -> 買える数が足りれば確保して (成功したか, 現在の在庫, 確保の合計) を返す
+#   reset_holds(owner, counts)            -> owner の確保を counts で置き換え、全体の確保の合計を返す
+#   read(keys)                            -> changes と同じ形のキーごとに現在の値を返す
+# いずれもスレッド上で呼ばれる。確保を戻すのは write() の ("release", owner, 自販機名, 商品名, 個数) で行う
+#
+# changes は変更箇所のキーの集合
+#   ("machine", 自販機名)
+#   ("item", 自販機名, 商品名)
+#   ("messages", 自販機名)
+
+class JsonBackend:
+    def __init__(self, path):
+        self.path = path
+        self.target = os.path.basename(path)
+        # 値がオブジェクトでない自販機。読み込めないが、書き出すときに消さないようにそのまま残す
+        self._unparsed = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            atomic_write(self.path, "{}")
+        with STORAGE_SECONDS.time(target=self.target, op="read"):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            data = json.loads(text)
+        STORAGE_BYTES.inc(len(text.encode('utf-8')), target=self.target, op="read")
+        self._unparsed = {name: value for name, value in data.items() if not isinstance(value, dict)}
+        return data
+
+    def prepare(self, data, changes):
+        # JSON は差分を書けないので常に全体を書き出す
+        machines = dump_machines(data)
+        for name, value in self._unparsed.items():
+            machines.setdefault(name, value)
+        return json.dumps(machines, indent=2, ensure_ascii=False)
+
+    def write(self, payload):
+        with STORAGE_SECONDS.time(target=self.target, op="write"):
+            atomic_write(self.path, payload)
+        STORAGE_BYTES.inc(len(payload.encode('utf-8')), target=self.target, op="write")
+
+    def close(self):
+        pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS machines (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS items (
+    machine_id INTEGER NOT NULL REFERENCES machines(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    stock INTEGER NOT NULL,
+    price INTEGER NOT NULL,
+    dm_content TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (machine_id, name)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    machine_id INTEGER NOT NULL REFERENCES machines(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_messages_machine ON messages(machine_id);
+CREATE TABLE IF NOT EXISTS holds (
+    owner TEXT NOT NULL,
+    machine TEXT NOT NULL,
+    item TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (owner, machine, item)
+);
+"""
+
+
+class SqliteBackend:
+    def __init__(self, path):
+        self.path = path
+        self.target = os.path.basename(path)
+        # 書き込みはストアの書き込みロックで直列化されるので、スレッドをまたいで使ってよい
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        # 書き込みと在庫の確定は別々のスレッドから呼ばれるので、トランザクションが混ざらないようにする
+        self._conn_lock = threading.Lock()
+
+    def load(self):
+        with STORAGE_SECONDS.time(target=self.target, op="read"), self._conn_lock:
+            return self._load()
+
+    def _load(self):
+        data = {}
+        machine_names = {}
+        for machine_id, name in self.conn.execute("SELECT id, name FROM machines ORDER BY id"):
+            data[name] = {}
+            machine_names[machine_id] = name
+        for machine_id, name, stock, price, dm_content in self.conn.execute(
+                "SELECT machine_id, name, stock, price, dm_content FROM items ORDER BY rowid"):
+            data[machine_names[machine_id]][name] = {
+                "stock": stock,
+                "price": price,
+                "dm_content": dm_content
+            }
+        for machine_id, channel_id, message_id in self.conn.execute(
+                "SELECT machine_id, channel_id, message_id FROM messages ORDER BY rowid"):
+            data[machine_names[machine_id]].setdefault("message_ids", []).append({
+                "channel_id": channel_id,
+                "message_id": message_id
+            })
+        return data
+
+    def prepare(self, data, changes, deltas=None):
+        # 変更のあった行だけを、その時点の値で書き出す
+        # deltas（(自販機名, 商品名) -> 在庫の増減）を渡すと、既にある商品の在庫は値ではなく増減で書き込む
+        # （共有時に他のプロセスが確定させた販売を、古い在庫で上書きしないように）
+        ops = []
+        for change in sorted(changes, key=lambda c: c[0] != "machine"):
+            name = change[1]
+            machine = data.get(name)
+            if change[0] == "machine":
+                ops.append(("machine", name, machine is not None))
+            elif change[0] == "item":
+                info = machine.items.get(change[2]) if machine is not None else None
+                if info is not None:
+                    info = (info.stock, info.price, info.dm_content)
+                delta = deltas.get((name, change[2]), 0) if deltas is not None else None
+                ops.append(("item", name, change[2], info, delta))
+            elif change[0] == "messages" and machine is not None:
+                ops.append(("messages", name, [(m.channel_id, m.message_id) for m in machine.messages]))
+        return ops
+
+    def _machine_id(self, name):
+        self.conn.execute("INSERT OR IGNORE INTO machines (name) VALUES (?)", (name,))
+        return self.conn.execute("SELECT id FROM machines WHERE name = ?", (name,)).fetchone()[0]
+
+    def write(self, payload):
+        # バイト数は SQLite 側でしか分からないので時間だけ記録する
+        with STORAGE_SECONDS.time(target=self.target, op="write"), self._conn_lock:
+            self._write(payload)
+
+    def _write(self, payload):
+        # まとめて 1 トランザクションで反映する
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            for op in payload:
+                if op[0] == "reset":
+                    cur.execute("DELETE FROM machines")
+                elif op[0] == "machine":
+                    _, name, exists = op
+                    if exists:
+                        self._machine_id(name)
+                    else:
+                        cur.execute("DELETE FROM machines WHERE name = ?", (name,))
+                elif op[0] == "item":
+                    _, name, item, info, delta = op
+                    if info is None:
+                        cur.execute(
+                            "DELETE FROM items WHERE machine_id = (SELECT id FROM machines WHERE name = ?) AND name = ?",
+                            (name, item))
+                    elif delta is None:
+                        cur.execute(
+                            "INSERT INTO items (machine_id, name, stock, price, dm_content) VALUES (?, ?, ?, ?, ?) "
+                            "ON CONFLICT (machine_id, name) DO UPDATE SET "
+                            "stock = excluded.stock, price = excluded.price, dm_content = excluded.dm_content",
+                            (self._machine_id(name), item, *info))
+                    else:
+                        # 新しい商品はその在庫で作り、既にある商品は在庫を増減させる
+                        cur.execute(
+                            "INSERT INTO items (machine_id, name, stock, price, dm_content) VALUES (?, ?, ?, ?, ?) "
+                            "ON CONFLICT (machine_id, name) DO UPDATE SET "
+                            "stock = MAX(0, stock + ?), price = excluded.price, dm_content = excluded.dm_content",
+                            (self._machine_id(name), item, *info, delta))
+                elif op[0] == "release":
+                    _, owner, name, item, amount = op
+                    cur.execute(
+                        "UPDATE holds SET count = count - ? WHERE owner = ? AND machine = ? AND item = ?",
+                        (amount, owner, name, item))
+                    cur.execute("DELETE FROM holds WHERE count <= 0")
+                elif op[0] == "messages":
+                    _, name, refs = op
+                    machine_id = self._machine_id(name)
+                    cur.execute("DELETE FROM messages WHERE machine_id = ?", (machine_id,))
+                    cur.executemany(
+                        "INSERT OR REPLACE INTO messages (message_id, channel_id, machine_id) VALUES (?, ?, ?)",
+                        [(message_id, channel_id, machine_id) for channel_id, message_id in refs])
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+
+    def _immediate(self, op, func):
+        # 他のプロセスも同じ行を読み書きするので、確認と更新を 1 つの BEGIN IMMEDIATE の中で行う
+        with STORAGE_SECONDS.time(target=self.target, op=op), self._conn_lock:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(cur)
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+        return result
+
+    @staticmethod
+    def _stock(cur, name, item):
+        row = cur.execute(
+            "SELECT stock FROM items WHERE machine_id = (SELECT id FROM machines WHERE name = ?) AND name = ?",
+            (name, item)).fetchone()
+        return row[0] if row is not None else None
+
+    @staticmethod
+    def _held(cur, name, item, owner=None):
+        # owner を指定するとそのプロセスの確保だけ、指定しなければ全体の合計
+        if owner is None:
+            row = cur.execute(
+                "SELECT COALESCE(SUM(count), 0) FROM holds WHERE machine = ? AND item = ?", (name, item)).fetchone()
+        else:
+            row = cur.execute(
+                "SELECT COALESCE(SUM(count), 0) FROM holds WHERE owner = ? AND machine = ? AND item = ?",
+                (owner, name, item)).fetchone()
+        return row[0]
+
+    def take(self, owner, name, item, amount, held=False):
+        # held=True なら owner の確保を在庫ごと減らす（確保が残っていなければ通常の購入と同じ条件で減らす）
+        def take(cur):
+            stock, total = self._stock(cur, name, item), self._held(cur, name, item)
+            if stock is None:
+                return False, None, total
+            use_hold = held and self._held(cur, name, item, owner) >= amount
+            # 確保を使うなら在庫さえあればよく、使わないなら他の確保の分を残す
+            if stock - (0 if use_hold else total) < amount:
+                return False, stock, total
+            cur.execute(
+                "UPDATE items SET stock = stock - ? WHERE machine_id = (SELECT id FROM machines WHERE name = ?) AND name = ?",
+                (amount, name, item))
+            if use_hold:
+                cur.execute(
+                    "UPDATE holds SET count = count - ? WHERE owner = ? AND machine = ? AND item = ?",
+                    (amount, owner, name, item))
+                cur.execute("DELETE FROM holds WHERE count <= 0")
+                total -= amount
+            return True, stock - amount, total
+        return self._immediate("take", take)
+
+    def reserve(self, owner, name, item, amount=1):
+        def reserve(cur):
+            stock, total = self._stock(cur, name, item), self._held(cur, name, item)
+            if stock is None or stock - total < amount:
+                return False, stock, total
+            cur.execute(
+                "INSERT INTO holds (owner, machine, item, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (owner, machine, item) DO UPDATE SET count = count + excluded.count",
+                (owner, name, item, amount))
+            return True, stock, total + amount
+        return self._immediate("reserve", reserve)
+
+    def reset_holds(self, owner, counts):
+        # 起動時に承認待ちから復元した確保で、前回このプロセスが記録した確保を置き換える
+        # counts は 自販機名 -> 商品名 -> 個数。戻り値も同じ形で、全プロセスの合計
+        def reset(cur):
+            cur.execute("DELETE FROM holds WHERE owner = ?", (owner,))
+            cur.executemany(
+                "INSERT INTO holds (owner, machine, item, count) VALUES (?, ?, ?, ?)",
+                [(owner, name, item, count) for name, items in counts.items() for item, count in items.items()])
+            totals = {}
+            for name, item, count in cur.execute("SELECT machine, item, SUM(count) FROM holds GROUP BY machine, item"):
+                totals.setdefault(name, {})[item] = count
+            return totals
+        return self._immediate("write", reset)
+
+    def read(self, keys):
+        # 他のプロセスが変更した箇所の現在の値を読む
+        result = {}
+        with STORAGE_SECONDS.time(target=self.target, op="read"), self._conn_lock:
+            for key in keys:
+                if key[0] == "machine":
+                    row = self.conn.execute("SELECT 1 FROM machines WHERE name = ?", (key[1],)).fetchone()
+                    result[key] = row is not None
+                elif key[0] == "item":
+                    # 商品の値と、全プロセスの確保の合計
+                    row = self.conn.execute(
+                        "SELECT stock, price, dm_content FROM items "
+                        "WHERE machine_id = (SELECT id FROM machines WHERE name = ?) AND name = ?",
+                        (key[1], key[2])).fetchone()
+                    result[key] = (row, self._held(self.conn, key[1], key[2])) if row is not None else None
+                elif key[0] == "messages":
+                    result[key] = self.conn.execute(
+                        "SELECT channel_id, message_id FROM messages "
+                        "WHERE machine_id = (SELECT id FROM machines WHERE name = ?) ORDER BY rowid",
+                        (key[1],)).fetchall()
+        return result
+
+    def import_data(self, data):
+        # jihanki.json の内容で全体を置き換える（移行用）
+        machines, _ = load_machines(data)
+        changes = []
+        for name, machine in machines.items():
+            changes.append(("machine", name))
+            changes.append(("messages", name))
+            for item in machine.items:
+                changes.append(("item", name, item))
+        self.write([("reset",)] + self.prepare(machines, changes))
+
+    def close(self):
+        self.conn.close()
+
+
+def open_backend(kind, path):
+    if kind == "json":
+        return JsonBackend(path)
+    if kind == "sqlite":
+        return SqliteBackend(path)
+    raise ValueError(f"unknown storage backend: {kind}")
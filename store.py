@@ -0,0 +1,430 @@
+# store.py
+import asyncio
+import hashlib
+from contextlib import AsyncExitStack
+
+from models import Item, Machine, MessageRef, dump_machines, load_machines
+
+
+def machine_key(name):
+    # custom_id に入れる自販機の短い識別子（名前に _ や長い文字列が含まれても壊れない）
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+
+
+class JihankiStore:
+    def __init__(self, backend, flush_delay=1.0, ledger=None, index=None, bus=None, owner=None):
+        self.backend = backend
+        self.ledger = ledger
+        self.index = index
+        # bus を渡すと他のプロセスと在庫を共有する。在庫の確定はデータベース上で行い、変更を通知し合う
+        self.bus = bus
+        # 共有時に確保をデータベースへ記録するときの名前（再起動しても同じ名前にする）
+        self.owner = owner if owner is not None else getattr(bus, "origin", None)
+        self.flush_delay = flush_delay
+        # 自販機名 -> Machine
+        self.data = {}
+        self._dirty = False
+        self._changes = set()
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+        self._locks = {}
+        self._versions = {}
+        self.machines_version = 0
+        self._keys = {}
+        self.loaded = False
+        # 承認待ちの購入で確保している数（自販機名 -> 商品名 -> 個数）。承認待ちから復元する
+        # 共有時は全プロセスの合計で、確保自体はデータベースに記録する
+        self._held = {}
+        # 共有時にまだデータベースに書き込んでいない確保の取り消しと在庫の増減（(自販機名, 商品名) -> 個数）
+        self._releases = {}
+        self._deltas = {}
+
+    def load(self):
+        # 起動時に一度だけ読み込んで検証し、以降はメモリ上のデータが正となる
+        data = self.backend.load()
+        recovered = []
+        if self.ledger is not None and self.bus is None:
+            # 保存の待ち時間中に落ちた変更は台帳にだけ残っているので、保存先の内容に重ねて戻す
+            # （共有時の台帳は自分の変更しか持たず、データベースが正なので戻さない）
+            recovered = self.ledger.replay(data)
+        self.data, skipped = load_machines(data)
+        if skipped:
+            print(f"⚠️ 読み込めない商品データが {skipped} 件あります（使わずに、ファイルにはそのまま残します）")
+        self._keys = {machine_key(name): name for name in self.data}
+        if self.ledger is not None:
+            self.ledger.open(dump_machines(self.data))
+        if recovered:
+            print(f"♻️ 台帳から保存されていなかった変更を {len(recovered)} 件戻しました")
+            for event in recovered:
+                self._changes.add(("machine", event["machine"]) if event["type"] == "add_machine"
+                                  else ("item", event["machine"], event["item"]))
+            self._dirty = True
+        if self.index is not None:
+            self.index.rebuild(self)
+        self.loaded = True
+
+    def start(self):
+        # 読み込んだ後にイベントループ上で呼ぶ
+        if self.bus is not None:
+            self.bus.subscribe(self._apply_remote)
+            self.bus.start()
+        if self._dirty and self.ledger is not None:
+            # 台帳から戻した変更を保存し、戻した状態でスナップショットを作り直す
+            self.mark_dirty()
+            self.ledger.schedule_compaction(lambda: dump_machines(self.data))
+
+    # ---- 参照 ----
+
+    def machine_names(self):
+        return list(self.data.keys())
+
+    def has_machine(self, name):
+        return name in self.data
+
+    def machine_by_key(self, key):
+        return self._keys.get(key)
+
+    def get_item(self, name, item):
+        machine = self.data.get(name)
+        return machine.items.get(item) if machine is not None else None
+
+    def items(self, name):
+        machine = self.data.get(name)
+        return list(machine.items.items()) if machine is not None else []
+
+    def message_ids(self, name):
+        machine = self.data.get(name)
+        return machine.messages if machine is not None else []
+
+    def reserved(self, name, item):
+        return self._held.get(name, {}).get(item, 0)
+
+    def reserved_counts(self, name):
+        return self._held.get(name, {})
+
+    def available(self, name, item):
+        # 確保中の分を除いた、今すぐ買える数
+        info = self.get_item(name, item)
+        if info is None:
+            return 0
+        return max(0, info.stock - self.reserved(name, item))
+
+    def version(self, name):
+        # 商品や在庫が変わるたびに増える番号（表示キャッシュの判定に使う）
+        return self._versions.get(name, 0)
+
+    # ---- 更新 ----
+
+    def add_machine(self, name):
+        if name in self.data:
+            return False
+        self.data[name] = Machine(name)
+        self._keys[machine_key(name)] = name
+        self._changed("machine", name)
+        self._record("add_machine", name)
+        return True
+
+    def set_item(self, name, item, stock, price, dm_content=""):
+        current = self.get_item(name, item)
+        if current is not None:
+            self._add_delta(name, item, stock - current.stock)
+        self.data[name].items[item] = Item(stock, price, dm_content)
+        self._changed("item", name, item)
+        self._record("set_item", name, item, stock=stock, price=price, dm_content=dm_content)
+        if self.index is not None:
+            self.index.add(name, item)
+
+    def remove_item(self, name, item):
+        if self.get_item(name, item) is None:
+            return False
+        del self.data[name].items[item]
+        self._deltas.pop((name, item), None)
+        self._held.get(name, {}).pop(item, None)
+        self._changed("item", name, item)
+        self._record("remove_item", name, item)
+        if self.index is not None:
+            self.index.remove(name, item)
+        return True
+
+    def lock(self, name):
+        # 自販機ごとのロック（別の自販機の購入同士は待たせない）
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        return lock
+
+    def _keep(self, name, item, amount, held):
+        # 他の承認待ちのために残しておく数（自分で確保している分は買える数に含める）
+        return max(0, self.reserved(name, item) - (amount if held else 0))
+
+    def _take(self, name, item, amount, held, reason, event):
+        # 呼び出し側で自販機のロックを取っていること
+        info = self.get_item(name, item)
+        if info is None or info.stock - self._keep(name, item, amount, held) < amount:
+            return None
+        if held:
+            self.release(name, item, amount)
+        info.stock -= amount
+        self._changed("item", name, item)
+        self._record(reason, name, item, stock=info.stock, delta=-amount, price=info.price, **event)
+        return info.stock
+
+    def _sync_shared(self, name, item, stock, total):
+        # データベースで確定した在庫と確保の合計にメモリを合わせる（まだ書き込んでいない増減は足しておく）
+        info = self.get_item(name, item)
+        if info is not None and stock is not None:
+            stock += self._deltas.get((name, item), 0)
+            if stock != info.stock:
+                info.stock = stock
+                self._bump(name)
+        if total != self.reserved(name, item):
+            self._set_held(name, item, total)
+
+    async def _take_shared(self, name, item, amount, held, reason, event):
+        # 他のプロセスも同じ在庫を減らすので、データベース上で条件付きで減らしてその結果に合わせる
+        # 他のプロセスの確保もデータベースにあるので、同じ場所で判定される
+        info = self.get_item(name, item)
+        if info is None:
+            return None
+        taken, stock, total = await asyncio.to_thread(self.backend.take, self.owner, name, item, amount, held)
+        self._sync_shared(name, item, stock, total)
+        if not taken:
+            return None
+        self.bus.publish([("item", name, item)])
+        self._record(reason, name, item, stock=stock, delta=-amount, price=info.price, **event)
+        return stock
+
+    async def decrement_stock(self, name, item, amount=1, reason="purchase", held=False, **event):
+        # 在庫が足りる場合だけ減らして残り在庫を返す。足りなければ None を返し何も変更しない
+        # held=True なら reserve() で確保済みの分を確定させる
+        async with self.lock(name):
+            if self.bus is not None:
+                return await self._take_shared(name, item, amount, held, reason, event)
+            return self._take(name, item, amount, held, reason, event)
+
+    async def decrement_many(self, requests, reason="purchase", held=False):
+        # 複数の購入をまとめて確定する。requests は (自販機名, 商品名, 台帳に残す情報) のリスト
+        # 関係する自販機のロックを名前順に取ってから処理するので、単発の購入と混ざっても売り越さない
+        results = []
+        async with AsyncExitStack() as stack:
+            for name in sorted({name for name, _, _ in requests}):
+                await stack.enter_async_context(self.lock(name))
+            for name, item, event in requests:
+                if self.bus is not None:
+                    results.append(await self._take_shared(name, item, 1, held, reason, event))
+                else:
+                    results.append(self._take(name, item, 1, held, reason, event))
+        return results
+
+    async def reserve(self, name, item, amount=1):
+        # 買える数が足りる場合だけ確保する。確保した分は承認で確定、拒否や期限切れで release() する
+        async with self.lock(name):
+            if self.bus is not None:
+                if self.get_item(name, item) is None:
+                    return False
+                reserved, stock, total = await asyncio.to_thread(self.backend.reserve, self.owner, name, item, amount)
+                self._sync_shared(name, item, stock, total)
+                if reserved:
+                    self.bus.publish([("item", name, item)])
+                return reserved
+            if self.available(name, item) < amount:
+                return False
+            self._set_held(name, item, self.reserved(name, item) + amount)
+            return True
+
+    def restore_holds(self, holds):
+        # 起動時に承認待ちから確保を復元する。holds は (自販機名, 商品名) の並び
+        counts = {}
+        for name, item in holds:
+            items = counts.setdefault(name, {})
+            items[item] = items.get(item, 0) + 1
+        if self.bus is not None:
+            # 前回このプロセスが記録した確保を置き換え、他のプロセスの分も含めた合計を使う
+            counts = self.backend.reset_holds(self.owner, counts)
+        self._held = counts
+        for name in counts:
+            self._bump(name)
+
+    def release(self, name, item, amount=1):
+        self._set_held(name, item, self.reserved(name, item) - amount)
+        if self.bus is not None:
+            # データベースの確保は次の保存でまとめて戻す（それまでは他のプロセスから少なめに見えるだけで売り越さない）
+            key = (name, item)
+            self._releases[key] = self._releases.get(key, 0) + amount
+            self.mark_dirty()
+
+    def _add_delta(self, name, item, delta):
+        if self.bus is not None and delta:
+            key = (name, item)
+            self._deltas[key] = self._deltas.get(key, 0) + delta
+
+    def _set_held(self, name, item, count):
+        held = self._held.setdefault(name, {})
+        if count > 0:
+            held[item] = count
+        else:
+            held.pop(item, None)
+        self._bump(name)
+
+    def set_stock(self, name, item, stock, reason="set_stock", **event):
+        # 共有時はこのプロセスで見えていた在庫からの増減としてデータベースに書き込む
+        # （その間に他のプロセスで売れた分は売れたまま残る）
+        info = self.data[name].items[item]
+        delta = stock - info.stock
+        self._add_delta(name, item, delta)
+        info.stock = stock
+        self._changed("item", name, item)
+        self._record(reason, name, item, stock=stock, delta=delta, **event)
+
+    def add_message(self, name, channel_id, message_id):
+        self.data[name].messages.append(MessageRef(channel_id, message_id))
+        self._changed("messages", name)
+
+    def remove_message(self, name, message_id):
+        machine = self.data.get(name)
+        if machine is None or not machine.messages:
+            return
+        machine.messages = [m for m in machine.messages if m.message_id != message_id]
+        self._changed("messages", name)
+
+    # ---- 永続化（write-behind） ----
+
+    def _record(self, kind, name, item=None, **fields):
+        # 在庫に関わる変更を台帳に追記する
+        if self.ledger is None:
+            return
+        event = {"type": kind, "machine": name}
+        if item is not None:
+            event["item"] = item
+        event.update(fields)
+        self.ledger.append(event)
+        if self.ledger.needs_compaction():
+            # スナップショットは台帳を書き切った時点の状態で作る
+            self.ledger.schedule_compaction(lambda: dump_machines(self.data))
+
+    def _bump(self, name):
+        self._versions[name] = self._versions.get(name, 0) + 1
+
+    def _invalidate(self, key):
+        # 表示キャッシュを作り直させる
+        if key[0] == "machine":
+            self.machines_version += 1
+        if key[0] != "messages":
+            self._bump(key[1])
+
+    def _changed(self, *key):
+        self._changes.add(key)
+        self._invalidate(key)
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        # 変更をまとめて書き込むため、保存は遅延タスクに任せる
+        self._dirty = True
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # 書き込み中に来た変更や失敗した書き込みは次の周回でまとめて保存する
+        while self._dirty:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+
+    async def flush(self):
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            changes, self._changes = self._changes, set()
+            # 保存先が台帳より先に進まないように、台帳を先に書き切る（読み込み時に台帳から戻せるように）
+            # 書いている間に増えたイベントも書き切り、そのまま await せずに書き込む内容を確定させる
+            while self.ledger is not None and self.ledger.pending:
+                if not await self.ledger.flush():
+                    break
+            # 書き込む内容はイベントループ上で確定させ、実際の I/O だけスレッドで行う
+            if self.bus is None:
+                payload = self.backend.prepare(self.data, changes)
+            else:
+                releases, self._releases = self._releases, {}
+                deltas, self._deltas = self._deltas, {}
+                payload = self.backend.prepare(self.data, changes, deltas)
+                payload += [("release", self.owner, name, item, amount) for (name, item), amount in releases.items()]
+            try:
+                await asyncio.to_thread(self.backend.write, payload)
+            except Exception as e:
+                self._changes |= changes
+                if self.bus is not None:
+                    for pending, done in ((self._releases, releases), (self._deltas, deltas)):
+                        for key, amount in done.items():
+                            pending[key] = pending.get(key, 0) + amount
+                self._dirty = True
+                print(f"保存エラー: {e}")
+                return
+            if self.bus is None:
+                return
+            keys = changes | {("item", name, item) for name, item in releases}
+            self.bus.publish(sorted(keys, key=lambda c: c[0] != "machine"))
+        # 増減させた在庫は他のプロセスの販売も含めた値を読み直す
+        if deltas:
+            await self._apply_remote([("item", name, item) for name, item in deltas])
+
+    # ---- 他のプロセスの変更 ----
+
+    async def _apply_remote(self, keys):
+        # 他のプロセスが書き込んだ箇所をデータベースから読み直す
+        # 自販機のロックで在庫の確定と、書き込みロックで自分の保存と重ならないようにする
+        async with AsyncExitStack() as stack:
+            for name in sorted({key[1] for key in keys}):
+                await stack.enter_async_context(self.lock(name))
+            await stack.enter_async_context(self._write_lock)
+            values = await asyncio.to_thread(self.backend.read, [key for key in keys if key not in self._changes])
+            for key, value in values.items():
+                # 読んでいる間に自分が変更した箇所は、自分の書き込みを優先する
+                if key not in self._changes:
+                    self._apply_value(key, value)
+
+    def _apply_value(self, key, value):
+        name = key[1]
+        if key[0] == "machine":
+            if value and name not in self.data:
+                self.data[name] = Machine(name)
+                self._keys[machine_key(name)] = name
+            elif not value and name in self.data:
+                for item in self.data.pop(name).items:
+                    if self.index is not None:
+                        self.index.remove(name, item)
+                self._keys.pop(machine_key(name), None)
+            else:
+                return
+        elif key[0] == "item":
+            machine = self.data.get(name)
+            if machine is None:
+                machine = self.data[name] = Machine(name)
+                self._keys[machine_key(name)] = name
+                self._invalidate(("machine", name))
+            if value is None:
+                self._deltas.pop((name, key[2]), None)
+                if machine.items.pop(key[2], None) is None:
+                    return
+                self._held.get(name, {}).pop(key[2], None)
+                if self.index is not None:
+                    self.index.remove(name, key[2])
+            else:
+                # 商品の値と、全プロセスの確保の合計
+                row, total = value
+                machine.items[key[2]] = Item(*row)
+                self._set_held(name, key[2], total)
+                if self.index is not None:
+                    self.index.add(name, key[2])
+        elif key[0] == "messages" and name in self.data:
+            self.data[name].messages = [MessageRef(channel_id, message_id) for channel_id, message_id in value]
+        self._invalidate(key)
+
+    async def close(self):
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+        if self.bus is not None:
+            await self.bus.close()
+        self.backend.close()
+        if self.ledger is not None:
+            await self.ledger.close()
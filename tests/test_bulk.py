@@ -0,0 +1,36 @@
+import pytest
+
+from bulk import BulkError, parse
+
+
+def test_csv_rows_with_relative_stock():
+    rows = parse("items.csv", "﻿machine,item,price,stock\nm,x,100,5\nm,y,,+3\n".encode('utf-8'))
+    assert [(row["item"], row["price"], row["stock"], row["delta"]) for row in rows] == [
+        ("x", 100, 5, None),
+        ("y", None, None, 3),
+    ]
+    assert rows[1]["line"] == 3
+
+
+def test_json_machine_mapping():
+    raw = '{"m": {"x": {"stock": 1, "price": 50}, "message_ids": []}}'.encode('utf-8')
+    rows = parse("items.json", raw)
+    assert [(row["machine"], row["item"], row["stock"]) for row in rows] == [("m", "x", 1)]
+
+
+def test_errors_are_collected_per_line():
+    with pytest.raises(BulkError) as error:
+        parse("items.jsonl", b'{"machine": "m", "item": "x", "stock": "a"}\n{"machine": "m"}\n')
+    assert len(error.value.errors) == 2
+    assert error.value.errors[0].startswith("1行目")
+
+
+@pytest.mark.parametrize("raw", [b'{"m": 1}', b'"text"', b'{"m": '])
+def test_malformed_json_is_reported(raw):
+    with pytest.raises(BulkError):
+        parse("items.json", raw)
+
+
+def test_unknown_extension():
+    with pytest.raises(BulkError):
+        parse("items.txt", b"")
@@ -0,0 +1,23 @@
+from dedup import DedupTable, normalize_link
+
+
+def test_dedup_claims_once_until_released_or_expired():
+    table = DedupTable(ttl=10)
+    assert table.claim("k", now=0)
+    assert not table.claim("k", now=5)
+    table.release("k")
+    assert table.claim("k", now=5)
+    assert table.claim("k", now=15)
+
+
+def test_dedup_forgets_oldest_beyond_maxsize():
+    table = DedupTable(ttl=10, maxsize=2)
+    for key in ("a", "b", "c"):
+        table.claim(key, now=0)
+    assert len(table) == 2
+    assert table.claim("a", now=0)
+
+
+def test_normalize_link_ignores_case_slash_and_query():
+    assert normalize_link(" https://PAY.paypay.ne.jp/AbC/?x=1 ") == normalize_link("https://pay.paypay.ne.jp/AbC")
+    assert normalize_link("https://pay.paypay.ne.jp/abc") != normalize_link("https://pay.paypay.ne.jp/ABC")
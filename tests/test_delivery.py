@@ -0,0 +1,87 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+discord = pytest.importorskip("discord")
+
+from delivery import DeliveryQueue, retry_after
+
+
+class FakeResponse:
+    status = 429
+    reason = "Too Many Requests"
+
+    def __init__(self, retry_after=None):
+        self.headers = {} if retry_after is None else {"Retry-After": str(retry_after)}
+
+
+def rate_limited(retry_after=None):
+    return discord.HTTPException(FakeResponse(retry_after), "You are being rate limited.")
+
+
+def test_rate_limited_route_defers_low_priority_instead_of_dropping(tmp_path):
+    async def scenario():
+        queue = DeliveryQueue(workers=2, backoff=0, dead_letter_path=str(tmp_path / "dead.jsonl"), pressure_window=0.2)
+        queue.start()
+        sent = []
+        failures = [rate_limited()]
+
+        async def send(name):
+            if name == "first" and failures:
+                raise failures.pop()
+            sent.append(name)
+
+        queue.submit("achievement", lambda: send("first"), route=("channel", 1))
+        await asyncio.sleep(0.05)
+        # 429 を受けたルートの実績投稿は待たされ、他のルートや DM は待たされない
+        queue.submit("achievement", lambda: send("same"), route=("channel", 1))
+        queue.submit("achievement", lambda: send("other"), route=("channel", 2))
+        queue.submit("dm", lambda: send("dm"))
+        await asyncio.sleep(0.05)
+        assert "same" not in sent
+        assert {"first", "other", "dm"} <= set(sent)
+        await queue.close()
+        assert sent[-1] == "same"
+        assert not (tmp_path / "dead.jsonl").exists()
+    asyncio.run(scenario())
+
+
+def test_rate_limit_without_route_only_slows_low_priority(tmp_path):
+    queue = DeliveryQueue(workers=4, dead_letter_path=str(tmp_path / "dead.jsonl"))
+    queue.note_rate_limit()
+    assert queue.under_pressure
+    assert queue._budget("low") == 1
+    assert queue._budget("high") == 4
+
+
+def test_rate_limit_uses_retry_after_and_never_shortens_the_wait(tmp_path):
+    queue = DeliveryQueue(dead_letter_path=str(tmp_path / "dead.jsonl"), pressure_window=10)
+    route = ("channel", 1)
+    assert retry_after(rate_limited(0.5)) == 0.5
+    assert retry_after(rate_limited()) is None
+    queue.note_rate_limit(route, 0.5)
+    first = queue._route_limited_until[route]
+    assert first - time.monotonic() <= 0.5
+    queue.note_rate_limit(route, 0.01)
+    assert queue._route_limited_until[route] == first
+
+
+def test_close_ignores_new_limits_and_dead_letters_leftovers(tmp_path):
+    async def scenario():
+        dead = tmp_path / "dead.jsonl"
+        queue = DeliveryQueue(workers=1, retries=100, backoff=0, dead_letter_path=str(dead))
+        queue.start()
+
+        async def send():
+            raise rate_limited(0.01)
+
+        for n in range(3):
+            queue.submit("achievement", send, route=("channel", 1), n=n)
+        await asyncio.sleep(0.05)
+        await queue.close(timeout=0.05)
+        assert not queue._route_limited_until
+        entries = [json.loads(line) for line in dead.read_text(encoding="utf-8").splitlines()]
+        assert sorted(entry["n"] for entry in entries) == [0, 1, 2]
+    asyncio.run(scenario())
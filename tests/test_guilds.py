@@ -0,0 +1,67 @@
+import asyncio
+import threading
+
+import pytest
+
+from guilds import GuildRegistry
+
+
+class FakeGuild:
+    def __init__(self, guild_id, fail=False):
+        self.id = guild_id
+        self.fail = fail
+        self.load_threads = []
+        self.started = False
+        self.closed = False
+
+    def load(self):
+        self.load_threads.append(threading.get_ident())
+        if self.fail:
+            raise OSError("broken")
+
+    def start(self):
+        self.started = True
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+
+def test_concurrent_gets_share_one_load_off_the_loop():
+    async def scenario():
+        opened = []
+
+        def open_guild(guild_id):
+            opened.append(FakeGuild(guild_id))
+            return opened[-1]
+
+        registry = GuildRegistry(open_guild)
+        first, second = await asyncio.gather(registry.get(1), registry.get(1))
+        assert first is second
+        assert len(opened) == 1
+        assert first.started
+        assert first.load_threads != [threading.get_ident()]
+        assert await registry.get(1) is first
+        assert len(registry) == 1
+    asyncio.run(scenario())
+
+
+def test_failed_load_is_closed_and_retried():
+    async def scenario():
+        opened = []
+
+        def open_guild(guild_id):
+            opened.append(FakeGuild(guild_id, fail=not opened))
+            return opened[-1]
+
+        registry = GuildRegistry(open_guild)
+        with pytest.raises(OSError):
+            await registry.get(1)
+        assert opened[0].closed
+        assert len(registry) == 0
+        guild = await registry.get(1)
+        assert guild is opened[1]
+        assert not guild.closed
+    asyncio.run(scenario())
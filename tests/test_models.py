@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+from models import dump_machines, load_machines
+from storage import JsonBackend
+from store import JihankiStore
+
+
+def test_old_values_are_converted_once():
+    machines, skipped = load_machines({
+        "m": {
+            "x": {"stock": "3", "price": "100"},
+            "message_ids": [{"channel_id": "1", "message_id": "2"}, {"channel_id": 1, "message_id": 2}, {"bad": 1}],
+        }
+    })
+    item = machines["m"].items["x"]
+    assert (item.stock, item.price, item.dm_content) == (3, 100, "")
+    assert [(ref.channel_id, ref.message_id) for ref in machines["m"].messages] == [(1, 2)]
+    assert skipped == 0
+
+
+def test_unparsed_items_are_kept_for_writing_back():
+    data = {
+        "m": {"x": {"stock": 1, "price": 100, "dm_content": "secret"}, "broken": {"stock": "many"}, "note": "text"},
+        "n": ["not", "a", "machine"],
+    }
+    machines, skipped = load_machines(data)
+    assert skipped == 3
+    assert list(machines) == ["m"]
+    assert list(machines["m"].items) == ["x"]
+    assert dump_machines(machines)["m"] == data["m"]
+
+
+def test_json_store_keeps_unparsed_entries_after_an_edit(tmp_path):
+    path = tmp_path / "jihanki.json"
+    data = {"m": {"x": {"stock": 1, "price": 100, "dm_content": ""}, "broken": None}, "n": "text"}
+    path.write_text(json.dumps(data), encoding='utf-8')
+
+    async def scenario():
+        store = JihankiStore(JsonBackend(str(path)), flush_delay=0)
+        store.load()
+        store.set_stock("m", "x", 5)
+        await store.close()
+    asyncio.run(scenario())
+
+    saved = json.loads(path.read_text(encoding='utf-8'))
+    assert saved["m"]["x"]["stock"] == 5
+    assert saved["m"]["broken"] is None
+    assert saved["n"] == "text"
@@ -0,0 +1,77 @@
+import asyncio
+
+from refresh import RefreshScheduler
+
+
+def test_requests_within_delay_are_coalesced():
+    async def scenario():
+        calls = []
+
+        async def refresh(name):
+            calls.append(name)
+
+        scheduler = RefreshScheduler(refresh, delay=0.01)
+        for _ in range(5):
+            scheduler.schedule("a")
+        scheduler.schedule("b")
+        assert scheduler.pending == 2
+        await asyncio.sleep(0.05)
+        assert sorted(calls) == ["a", "b"]
+        assert scheduler.pending == 0
+    asyncio.run(scenario())
+
+
+def test_request_during_refresh_runs_again():
+    async def scenario():
+        calls = []
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def refresh(name):
+            calls.append(name)
+            if len(calls) == 1:
+                started.set()
+                await release.wait()
+
+        scheduler = RefreshScheduler(refresh, delay=0)
+        scheduler.schedule("a")
+        await started.wait()
+        scheduler.schedule("a")
+        scheduler.schedule("a")
+        release.set()
+        await asyncio.sleep(0.01)
+        assert calls == ["a", "a"]
+    asyncio.run(scenario())
+
+
+def test_failed_refresh_does_not_stop_the_scheduler():
+    async def scenario():
+        calls = []
+
+        async def refresh(name):
+            calls.append(name)
+            if len(calls) == 1:
+                raise RuntimeError("boom")
+
+        scheduler = RefreshScheduler(refresh, delay=0)
+        scheduler.schedule("a")
+        await asyncio.sleep(0.01)
+        scheduler.schedule("a")
+        await asyncio.sleep(0.01)
+        assert calls == ["a", "a"]
+    asyncio.run(scenario())
+
+
+def test_close_flushes_pending_requests():
+    async def scenario():
+        calls = []
+
+        async def refresh(name):
+            calls.append(name)
+
+        scheduler = RefreshScheduler(refresh, delay=60)
+        scheduler.schedule("a")
+        await scheduler.close()
+        assert calls == ["a"]
+        assert scheduler.pending == 0
+    asyncio.run(scenario())
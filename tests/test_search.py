@@ -0,0 +1,46 @@
+from search import ItemIndex, item_key
+
+
+def make_index(*entries):
+    index = ItemIndex()
+    for jihanki_name, item in entries:
+        index.add(jihanki_name, item)
+    return index
+
+
+def names(results):
+    return [item for _, _, item in results]
+
+
+def test_prefix_matches_come_before_substring_matches():
+    index = make_index(("m", "コーラ"), ("m", "ダイエットコーラ"), ("m", "お茶"), ("n", "コーヒー"))
+    assert names(index.search("コー")) == ["コーヒー", "コーラ", "ダイエットコーラ"]
+
+
+def test_search_is_case_insensitive_and_single_character():
+    index = make_index(("m", "Cola"), ("m", "Tea"))
+    assert names(index.search("COLA")) == ["Cola"]
+    assert names(index.search("a")) == ["Cola", "Tea"]
+
+
+def test_removed_items_are_not_found():
+    index = make_index(("m", "コーラ"), ("n", "コーラ"))
+    index.remove("m", "コーラ")
+    assert index.search("コーラ") == [(item_key("n", "コーラ"), "n", "コーラ")]
+    index.remove("n", "コーラ")
+    assert index.search("コーラ") == []
+    assert len(index) == 0
+    assert not index._grams
+
+
+def test_add_is_idempotent_and_get_resolves_key():
+    index = make_index(("m", "お茶"), ("m", "お茶"))
+    assert len(index) == 1
+    assert index.get(item_key("m", "お茶")) == ("m", "お茶")
+    assert index.get("missing") is None
+
+
+def test_empty_query_lists_up_to_limit():
+    index = make_index(*(("m", f"item{i}") for i in range(30)))
+    assert len(index.search("", limit=25)) == 25
+    assert index.search("zz") == []
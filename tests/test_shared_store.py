@@ -0,0 +1,148 @@
+# SHARED_STORE=1 相当：2 つのストアが同じ SQLite を使い、LocalBus で変更を通知し合う
+import asyncio
+
+import pytest
+
+import bulk
+from bus import LocalBus
+from storage import SqliteBackend
+from store import JihankiStore
+
+
+def open_store(path, hub, owner):
+    store = JihankiStore(SqliteBackend(str(path)), flush_delay=0, bus=LocalBus(hub, origin=owner))
+    store.load()
+    store.restore_holds([])
+    store.start()
+    return store
+
+
+async def settle():
+    # LocalBus の通知や遅延保存はタスクで動くので、残っているタスクが終わるまで待つ
+    while True:
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if not tasks:
+            return
+        await asyncio.gather(*tasks)
+
+
+@pytest.fixture
+def stores(tmp_path):
+    async def make(stock):
+        hub = []
+        path = tmp_path / "jihanki.db"
+        a = open_store(path, hub, "a")
+        a.add_machine("m")
+        a.set_item("m", "x", stock, 100)
+        await a.flush()
+        b = open_store(path, hub, "b")
+        return a, b
+    return make
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_purchases_do_not_oversell(stores):
+    async def scenario():
+        a, b = await stores(1)
+        # b はまだ a の購入を知らない
+        first = await a.decrement_stock("m", "x")
+        second = await b.decrement_stock("m", "x")
+        await settle()
+        assert (first, second) == (0, None)
+        assert a.get_item("m", "x").stock == b.get_item("m", "x").stock == 0
+        await a.close()
+        await b.close()
+    run(scenario())
+
+
+def test_hold_in_one_process_is_kept_back_in_another(stores):
+    async def scenario():
+        a, b = await stores(1)
+        assert await a.reserve("m", "x")
+        # 通知が届く前でも、データベースの確保で判定される
+        assert await b.decrement_stock("m", "x") is None
+        assert not await b.reserve("m", "x")
+        assert await a.decrement_stock("m", "x", held=True) == 0
+        await settle()
+        assert b.get_item("m", "x").stock == 0
+        assert a.reserved("m", "x") == b.reserved("m", "x") == 0
+        await a.close()
+        await b.close()
+    run(scenario())
+
+
+def test_released_hold_becomes_available_after_flush(stores):
+    async def scenario():
+        a, b = await stores(1)
+        assert await a.reserve("m", "x")
+        await settle()
+        assert b.available("m", "x") == 0
+        a.release("m", "x")
+        await a.flush()
+        await settle()
+        assert b.available("m", "x") == 1
+        assert await b.decrement_stock("m", "x") == 0
+        await a.close()
+        await b.close()
+    run(scenario())
+
+
+def test_restore_holds_replaces_own_rows_only(stores, tmp_path):
+    async def scenario():
+        a, b = await stores(3)
+        assert await a.reserve("m", "x")
+        assert await b.reserve("m", "x")
+        await a.close()
+        # a が再起動し、承認待ちから確保を 2 つ復元した
+        a = open_store(tmp_path / "jihanki.db", [], "a")
+        a.restore_holds([("m", "x"), ("m", "x")])
+        assert a.reserved("m", "x") == 3
+        assert a.available("m", "x") == 0
+        await a.close()
+        await b.close()
+    run(scenario())
+
+
+def test_relative_restock_keeps_remote_sale(stores):
+    async def scenario():
+        a, b = await stores(5)
+        assert await a.decrement_stock("m", "x") == 4
+        # b の手元はまだ 5 のまま +10 する
+        await bulk.apply(b, bulk.parse("restock.csv", b"machine,item,stock\nm,x,+10\n"))
+        await b.flush()
+        await settle()
+        assert a.get_item("m", "x").stock == b.get_item("m", "x").stock == 14
+        await a.close()
+        await b.close()
+    run(scenario())
+
+
+def test_set_stock_is_written_as_delta(stores):
+    async def scenario():
+        a, b = await stores(5)
+        assert await a.decrement_stock("m", "x") == 4
+        # 管理者が 5 を見て 15 にした
+        b.set_stock("m", "x", 15)
+        await b.flush()
+        await settle()
+        assert a.get_item("m", "x").stock == b.get_item("m", "x").stock == 14
+        await a.close()
+        await b.close()
+    run(scenario())
+
+
+def test_remote_item_change_invalidates_version(stores):
+    async def scenario():
+        a, b = await stores(5)
+        version = b.version("m")
+        a.set_item("m", "x", 5, 200)
+        await a.flush()
+        await settle()
+        assert b.get_item("m", "x").price == 200
+        assert b.version("m") > version
+        await a.close()
+        await b.close()
+    run(scenario())
@@ -0,0 +1,48 @@
+import time
+
+from stats import DAILY_KEEP, HOURLY_KEEP, SalesStats
+
+
+def make_stats(tmp_path):
+    stats = SalesStats(str(tmp_path / "stats.json"))
+    stats.load()
+    # 遅延保存のタスクはこのテストでは使わない
+    stats.file.mark_dirty = lambda: None
+    return stats
+
+
+def test_record_updates_every_rollup(tmp_path):
+    stats = make_stats(tmp_path)
+    now = time.time()
+    stats.record("m", "コーラ", 1, 150, now=now)
+    stats.record("m", "コーラ", 2, 150, now=now)
+    stats.record("n", "お茶", 1, 100, now=now)
+    assert stats.total() == {"count": 3, "revenue": 400}
+    assert stats.total("m") == {"count": 2, "revenue": 300}
+    assert stats.total("missing") == {"count": 0, "revenue": 0}
+    assert stats.day(now) == {"count": 3, "revenue": 400}
+    assert stats.last_hours(24, now=now) == {"count": 3, "revenue": 400}
+    assert [(name, item) for name, item, _ in stats.top_items()] == [("m", "コーラ"), ("n", "お茶")]
+    assert [name for name, _, _ in stats.top_items("n")] == ["n"]
+    assert stats.top_buyers()[0] == ("1", {"count": 2, "revenue": 250})
+
+
+def test_old_buckets_are_trimmed(tmp_path):
+    stats = make_stats(tmp_path)
+    start = time.time()
+    for hour in range(HOURLY_KEEP + 5):
+        stats.record("m", "x", 1, 10, now=start + hour * 3600)
+    assert len(stats.data["hourly"]) == HOURLY_KEEP
+    for day in range(DAILY_KEEP + 5):
+        stats.record("m", "x", 1, 10, now=start + day * 86400)
+    assert len(stats.data["daily"]) == DAILY_KEEP
+    # 区間を消しても合計は変わらない
+    assert stats.total()["count"] == HOURLY_KEEP + 5 + DAILY_KEEP + 5
+
+
+def test_last_hours_only_counts_the_window(tmp_path):
+    stats = make_stats(tmp_path)
+    now = time.time()
+    stats.record("m", "x", 1, 10, now=now - 30 * 3600)
+    stats.record("m", "x", 1, 10, now=now)
+    assert stats.last_hours(24, now=now)["count"] == 1
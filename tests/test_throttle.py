@@ -0,0 +1,36 @@
+from throttle import Throttle, acquire
+
+
+def test_bucket_allows_burst_then_refills():
+    throttle = Throttle("user", rate=1, burst=2)
+    for _ in range(2):
+        assert throttle.wait_time("u", now=0) == 0
+        throttle.consume("u", now=0)
+    assert throttle.wait_time("u", now=0) == 1
+    assert throttle.wait_time("u", now=1) == 0
+
+
+def test_zero_rate_never_limits():
+    throttle = Throttle("user", rate=0, burst=1)
+    for _ in range(10):
+        throttle.consume("u", now=0)
+    assert throttle.wait_time("u", now=0) == 0
+    assert len(throttle) == 0
+
+
+def test_idle_buckets_are_evicted():
+    throttle = Throttle("user", rate=1, burst=2)
+    throttle.consume("a", now=0)
+    throttle.consume("b", now=5)
+    assert len(throttle) == 1
+
+
+def test_acquire_consumes_nothing_when_any_check_fails():
+    user = Throttle("user", rate=1, burst=5)
+    machine = Throttle("machine", rate=1, burst=1)
+    assert acquire((user, "u"), (machine, "m"), now=0) == (0.0, None)
+    wait, name = acquire((user, "u"), (machine, "m"), now=0)
+    assert (wait, name) == (1, "machine")
+    # 止められた回はユーザーの分も使っていない
+    assert user.wait_time("u", now=0) == 0
+    assert user._buckets["u"].tokens == 4
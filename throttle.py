@@ -0,0 +1,73 @@
+# throttle.py
+import time
+from collections import OrderedDict
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class Throttle:
+    # キーごとのトークンバケット。rate 個/秒で貯まり、最大 burst 個まで続けて使える（rate が 0 なら制限しない）
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        # 満タンに戻るまでの時間。これだけ使われなかったバケットは消しても結果が変わらない
+        self.idle_timeout = burst / rate if rate > 0 else float("inf")
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _refill(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+
+    def wait_time(self, key, now=None):
+        # 次の 1 回が使えるまでの秒数（0 ならすぐ使える）
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        tokens = self._refill(key, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def consume(self, key, now=None):
+        if self.rate <= 0:
+            return
+        now = time.monotonic() if now is None else now
+        tokens = self._refill(key, now)
+        # 最後に使われた順に並べておき、古いものから消す
+        self._buckets.pop(key, None)
+        self._buckets[key] = _Bucket(tokens - 1, now)
+        self.evict_idle(now)
+
+    def evict_idle(self, now=None):
+        now = time.monotonic() if now is None else now
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket.updated < self.idle_timeout:
+                break
+            del self._buckets[key]
+
+
+def acquire(*checks, now=None):
+    # checks は (Throttle, キー) の組。すべて通る場合だけ 1 回分ずつ使い、(0, None) を返す
+    # 通らない場合は何も使わずに、(待つ必要のある秒数, 止めた Throttle の名前) を返す
+    now = time.monotonic() if now is None else now
+    wait, name = 0.0, None
+    for throttle, key in checks:
+        throttle_wait = throttle.wait_time(key, now)
+        if throttle_wait > wait:
+            wait, name = throttle_wait, throttle.name
+    if wait > 0:
+        return wait, name
+    for throttle, key in checks:
+        throttle.consume(key, now)
+    return 0.0, None
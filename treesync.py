@@ -0,0 +1,42 @@
+# treesync.py
+# スラッシュコマンドの定義をハッシュにして保存し、前回の同期から変わったときだけ同期する
+import hashlib
+import json
+import os
+import time
+
+from storage import atomic_write
+
+
+def tree_hash(tree, guild, application_id):
+    commands = [command.to_dict(tree) for command in tree.get_commands(guild=guild)]
+    commands.sort(key=lambda c: (c.get("type", 1), c["name"]))
+    payload = {"application_id": application_id, "commands": commands}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _read_state(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+async def sync_tree(tree, guild, application_id, state_path, force=False):
+    # 同期した場合は (True, 同期にかかった秒数)、省略した場合は (False, 前回の同期にかかった秒数) を返す
+    target = str(guild.id) if guild is not None else "global"
+    digest = tree_hash(tree, guild, application_id)
+    state = _read_state(state_path)
+    previous = state.get(target, {})
+    if not force and previous.get("hash") == digest:
+        return False, previous.get("seconds", 0.0)
+
+    start = time.perf_counter()
+    await tree.sync(guild=guild)
+    seconds = time.perf_counter() - start
+    state[target] = {"hash": digest, "seconds": seconds, "synced_at": time.time()}
+    atomic_write(state_path, json.dumps(state, ensure_ascii=False))
+    return True, seconds